@@ -0,0 +1,338 @@
+"""Benchmark configured pipelines against recorded media files.
+
+Runs pipelines from the regular configuration files with a non-live
+source, as fast as the pipeline can consume frames, and writes a JSON
+report with per element latency percentiles, frames per second,
+dropped frames, memory and CPU use.
+
+Example:
+
+    python -m ambianic.bench --config config.yaml \\
+        --media tests/pipeline/avsource/test2-cam-person1.mkv \\
+        --output bench-report.json
+
+"""
+import argparse
+import json
+import logging
+import os
+import pathlib
+import platform
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from ambianic import configuration
+from ambianic.configuration import DEFAULT_DATA_DIR, get_root_config
+from ambianic.pipeline import interpreter
+
+log = logging.getLogger(__name__)
+
+LATENCY_PERCENTILES = [50, 90, 99]
+
+
+class LatencyStats:
+    """Collects latency measurements of one pipeline stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = []
+
+    def add(self, seconds=None):
+        with self._lock:
+            self._samples.append(seconds)
+
+    @property
+    def count(self) -> int:
+        return len(self._samples)
+
+    def summary(self) -> dict:
+        """Return latency percentiles, mean and max in milliseconds."""
+        with self._lock:
+            samples_ms = np.asarray(self._samples, dtype=np.float64) * 1000
+        if samples_ms.size == 0:
+            return {}
+        summary = {
+            f"p{p}": round(float(v), 3)
+            for p, v in zip(
+                LATENCY_PERCENTILES, np.percentile(samples_ms, LATENCY_PERCENTILES)
+            )
+        }
+        summary["mean"] = round(float(samples_ms.mean()), 3)
+        summary["max"] = round(float(samples_ms.max()), 3)
+        return summary
+
+
+class ElementProbe:
+    """Measures how long a pipe element spends processing each sample.
+
+    Wraps the process_sample() generator of an element instance and
+    keeps every measurement, so that exact percentiles can be reported
+    instead of the bucketed histogram of the element metrics.
+    Time spent in downstream elements while the generator is suspended
+    at a yield is not counted towards this element.
+    """
+
+    def __init__(self, element=None):
+        assert element
+        self.element = element
+        self.latency = LatencyStats()
+        self._process_sample = element.process_sample
+        element.process_sample = self._timed_process_sample
+
+    def _timed_process_sample(self, **sample):
+        elapsed = 0
+        samples = self._process_sample(**sample)
+        while True:
+            start = time.perf_counter()
+            try:
+                processed_sample = next(samples)
+            except StopIteration:
+                self.latency.add(elapsed + time.perf_counter() - start)
+                return
+            elapsed += time.perf_counter() - start
+            yield processed_sample
+
+    def report(self) -> dict:
+        return {
+            "name": self.element.name,
+            "class": self.element.__class__.__name__,
+            "samples_in": self.element.metrics.samples_in,
+            "samples_out": self.element.metrics.samples_out,
+            "dropped": self.element.dropped_samples,
+            "latency_ms": self.latency.summary(),
+        }
+
+
+class PipelineProbe:
+    """Measures frame rate and end to end latency of a pipeline run."""
+
+    def __init__(self, pipeline=None):
+        assert pipeline
+        self.pipeline = pipeline
+        self.source = pipeline.elements[0]
+        self.frame_latency = LatencyStats()
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+        self.elements = [ElementProbe(e) for e in pipeline.elements[1:]]
+        # the source passes each frame down the pipe synchronously
+        # up to the first element running in its own worker thread
+        self._receive_next_sample = self.source.receive_next_sample
+        self.source.receive_next_sample = self._timed_receive_next_sample
+
+    def _timed_receive_next_sample(self, **sample):
+        start = time.perf_counter()
+        self._receive_next_sample(**sample)
+        self.frame_latency.add(time.perf_counter() - start)
+
+    def run(self):
+        self.start_time = time.monotonic()
+        try:
+            self.pipeline.start()
+        except Exception as e:
+            log.exception("Pipeline %s failed", self.pipeline.name)
+            self.error = repr(e)
+        self.end_time = time.monotonic()
+
+    def report(self) -> dict:
+        duration = (self.end_time or time.monotonic()) - self.start_time
+        frames = self.frame_latency.count
+        report = {
+            "frames": frames,
+            "duration_sec": round(duration, 3),
+            "fps": round(frames / duration, 3) if duration > 0 else 0,
+            "dropped_frames": self.source.dropped_samples
+            + sum(p.element.dropped_samples for p in self.elements),
+            "frame_latency_ms": self.frame_latency.summary(),
+            "elements": [p.report() for p in self.elements],
+        }
+        if self.error:
+            report["error"] = self.error
+        return report
+
+
+def _media_uri(media=None) -> str:
+    if "://" in media:
+        return media
+    return pathlib.Path(os.path.abspath(media)).as_uri()
+
+
+def get_bench_pipelines_config(pipelines_config=None, names=None, media=None):
+    """Return pipeline definitions with their sources switched to non-live.
+
+    :Parameters:
+    ----------
+    pipelines_config : dict
+        Pipelines section of the configuration.
+    names : list
+        Names of the pipelines to benchmark. All pipelines if empty.
+    media : string
+        Optional. Path or URI of a recorded media file that replaces
+        the configured source URI of every pipeline.
+
+    """
+    root_config = get_root_config()
+    bench_config = {}
+    for pname, pdef in pipelines_config.items():
+        if names and pname not in names:
+            continue
+        pdef = [dict(element_def) for element_def in pdef]
+        source = pdef[0].get("source", None)
+        assert source, f"Pipeline {pname} must begin with a source element"
+        if isinstance(source, str):
+            source = {"source_id": source}
+        source = dict(source)
+        source_id = source.get("source_id", None)
+        if source_id:
+            # resolve source references here so that the overrides below stick
+            source = {**root_config.sources[source_id], **source}
+            del source["source_id"]
+        if media:
+            source["uri"] = _media_uri(media)
+            source["type"] = "video"
+        source["live"] = False
+        pdef[0] = {"source": source}
+        bench_config[pname] = pdef
+    return bench_config
+
+
+def _resource_usage() -> dict:
+    # children only include gst processes that already exited
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF),
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN),
+    }
+
+
+def run_benchmark(pipelines_config=None, data_dir=None, timeout=None) -> dict:
+    """Run pipelines concurrently until their sources end and report stats.
+
+    :Parameters:
+    ----------
+    pipelines_config : dict
+        Pipeline definitions with non-live sources.
+    data_dir : string
+        Directory for files saved by pipeline elements.
+    timeout : float
+        Optional. Stop the pipelines after this many seconds.
+
+    :Returns:
+    -------
+    dict
+        Benchmark report.
+
+    """
+    pipelines = interpreter.get_pipelines(pipelines_config, data_dir=data_dir)
+    probes = []
+    for p in pipelines:
+        if p.elements:
+            probes.append(PipelineProbe(p))
+        else:
+            log.warning("Pipeline %s has no elements, skipping.", p.name)
+    usage_start = _resource_usage()
+    start_time = time.monotonic()
+    threads = [
+        threading.Thread(target=probe.run, name=probe.pipeline.name, daemon=True)
+        for probe in probes
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        remaining = None
+        if timeout is not None:
+            remaining = max(0, timeout - (time.monotonic() - start_time))
+        t.join(timeout=remaining)
+    if any(t.is_alive() for t in threads):
+        log.warning("Benchmark timed out after %s seconds.", timeout)
+        for probe in probes:
+            probe.pipeline.stop()
+        for t in threads:
+            t.join()
+    duration = time.monotonic() - start_time
+    usage_end = _resource_usage()
+    cpu = {}
+    for name in ("self", "children"):
+        start, end = usage_start[name], usage_end[name]
+        cpu[f"{name}_user_sec"] = round(end.ru_utime - start.ru_utime, 3)
+        cpu[f"{name}_system_sec"] = round(end.ru_stime - start.ru_stime, 3)
+    cpu_total = sum(cpu.values())
+    cpu["percent"] = round(100 * cpu_total / duration, 1) if duration > 0 else 0
+    return {
+        "version": configuration.__version__,
+        "created": datetime.now().isoformat(),
+        "platform": {
+            "system": platform.system(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "duration_sec": round(duration, 3),
+        "cpu": cpu,
+        "memory": {
+            # ru_maxrss is in kilobytes on Linux
+            "max_rss_mb": round(usage_end["self"].ru_maxrss / 1024, 1),
+            "children_max_rss_mb": round(usage_end["children"].ru_maxrss / 1024, 1),
+        },
+        "pipelines": {probe.pipeline.name: probe.report() for probe in probes},
+    }
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m ambianic.bench",
+        description="Benchmark configured pipelines against recorded media.",
+    )
+    parser.add_argument("-c", "--config", help="Specify config YAML file location.")
+    parser.add_argument(
+        "--pipeline",
+        action="append",
+        default=[],
+        help="Name of a pipeline to benchmark. Repeat for more. Default: all.",
+    )
+    parser.add_argument(
+        "--media",
+        help="Path or URI of a recorded media file to use as source "
+        "for all pipelines instead of the configured sources.",
+    )
+    parser.add_argument("-o", "--output", help="JSON report file. Default: stdout.")
+    parser.add_argument(
+        "--timeout", type=float, help="Stop the benchmark after this many seconds."
+    )
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    # the --config option is picked up by the configuration module
+    config = configuration.init_config()
+    pipelines_config = get_bench_pipelines_config(
+        pipelines_config=config.get("pipelines", None) or {},
+        names=args.pipeline,
+        media=args.media,
+    )
+    if not pipelines_config:
+        log.error("No pipelines to benchmark.")
+        return 1
+    report = run_benchmark(
+        pipelines_config=pipelines_config,
+        data_dir=config.get("data_dir", DEFAULT_DATA_DIR),
+        timeout=args.timeout,
+    )
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json)
+        log.info("Benchmark report saved to %s", args.output)
+    else:
+        print(report_json)
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -7,41 +7,56 @@ from dynaconf import Dynaconf, loaders
 
 log = logging.getLogger()
 
-parser = ArgumentParser()
-parser.add_argument("-c", "--config", help="Specify config YAML file location.")
-parser.add_argument(
-    "-p",
-    "--peerfile",
-    help="Specify file location with peerfetch values such as current peerid.",
-)
-
-args, unknown = parser.parse_known_args()
-
 # default path locations
 DEFAULT_WORK_DIR: str = "/workspace"
 DEFAULT_DATA_DIR: str = "./data"
 
-CONFIG_FILE_PATH: str = args.config or "config.yaml"
-PEER_FILE_PATH: str = args.peerfile or ".peerjsrc"
+CONFIG_FILE_PATH: str = "config.yaml"
+PEER_FILE_PATH: str = ".peerjsrc"
 SECRETS_FILE_PATH: str = "secrets.yaml"
 
 CONFIG_DEFAULTS_FILE_PATH: str = "config.defaults.yaml"
 
-# actual local file locations
+# actual local file locations, resolved on first use
 __config_file: str = None
+__peer_file: str = None
 __secrets_file: str = None
 
-# package version
-__version__: str = metadata.version("ambianic-edge")
+# command line arguments, parsed on first use
+__args = None
 
 # refernce to system global config instance
 __config: Dynaconf = "Not Initialized Yet!"
 
 
+def __getattr__(name):
+    # package version, looked up on first use to keep startup fast
+    if name == "__version__":
+        global __version__
+        __version__ = metadata.version("ambianic-edge")
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def get_root_config() -> Dynaconf:
     return __config
 
 
+def _get_args():
+    """Parse the config file locations passed on the command line."""
+    global __args
+    if __args is None:
+        parser = ArgumentParser()
+        parser.add_argument("-c", "--config", help="Specify config YAML file location.")
+        parser.add_argument(
+            "-p",
+            "--peerfile",
+            help="Specify file location with peerfetch values such as current peerid.",
+        )
+        __args, _ = parser.parse_known_args()
+    return __args
+
+
 def get_config_defaults_file() -> str:
     return CONFIG_DEFAULTS_FILE_PATH
 
@@ -51,6 +66,10 @@ def get_config_file() -> str:
     This is typically the file with baseline configuration settings
     across a fleet of similar devices.
     """
+    global __config_file
+    if __config_file is None:
+        config_file = _get_args().config or CONFIG_FILE_PATH
+        __config_file = os.path.join(get_work_dir(), config_file)
     return __config_file
 
 
@@ -65,6 +84,10 @@ def get_local_config_file() -> str:
 
 def get_peerid_file():
     """Return path to the file where peerfetch Peer ID for this device is stored."""
+    global __peer_file
+    if __peer_file is None:
+        peer_file = _get_args().peerfile or PEER_FILE_PATH
+        __peer_file = os.path.join(get_work_dir(), peer_file)
     return __peer_file
 
 
@@ -102,7 +125,9 @@ def init_config() -> Dynaconf:
         # settings_files read from SETTINGS_FILE_FOR_DYNACONF
         environments=False,
     )
-    log.debug(f"Config settings: {get_root_config().as_dict()}")
+    if log.isEnabledFor(logging.DEBUG):
+        # as_dict() loads all settings files
+        log.debug(f"Config settings: {get_root_config().as_dict()}")
     return __config
 
 
@@ -134,9 +159,5 @@ def get_work_dir() -> str:
     return env_work_dir
 
 
-__config_file = os.path.join(get_work_dir(), CONFIG_FILE_PATH)
-__peer_file = os.path.join(get_work_dir(), PEER_FILE_PATH)
-
-
 # initial config init
 init_config()
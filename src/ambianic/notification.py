@@ -1,12 +1,15 @@
 """Utilities to send notifications."""
 
 import hashlib
+import heapq
+import itertools
 import logging
 import os
+import threading
+import time
 import urllib
 from string import Template
 
-import ambianic
 import apprise
 from ambianic.configuration import get_root_config
 from ambianic.util import jsonify
@@ -15,6 +18,9 @@ log = logging.getLogger(__name__)
 
 UI_BASE_URL_DEFAULT = "https://ui.ambianic.ai"
 
+DEFAULT_TITLE_TEMPLATE = "[Ambianic.ai] New event - ${event_type}: ${event_labels}"
+DEFAULT_MESSAGE_TEMPLATE = "New event\n ${event_type}: ${event_labels}"
+
 
 class Notification:
     def __init__(self, envelope: dict = {}, providers: list = ["all"]):
@@ -30,14 +36,49 @@ class Notification:
     def to_dict(self) -> dict:
         return dict(vars(self))
 
+    @property
+    def labels(self) -> tuple:
+        """Sorted unique labels of the detections in the notification."""
+        inference_result = self.envelope["args"]["inference_result"] or []
+        return tuple(sorted({i["label"] for i in inference_result}))
+
+
+class _ProviderSettings:
+    """Notification settings of a provider tag, resolved once."""
+
+    def __init__(self, cfg: dict = None):
+        self.enabled = cfg.get("enabled", True)
+        self.include_attachments = cfg.get("include_attachments", False)
+        templates = cfg.get("templates", {})
+        self.title = Template(templates.get("title", DEFAULT_TITLE_TEMPLATE))
+        self.message = Template(templates.get("message", DEFAULT_MESSAGE_TEMPLATE))
+        # max messages per minute, 0 for no limit
+        rate_limit = cfg.get("rate_limit", 0)
+        assert rate_limit >= 0, "rate_limit must be a positive number"
+        self.min_interval = 60 / rate_limit if rate_limit else 0
+        self.retries = cfg.get("retries", 3)
+        self.retry_backoff = cfg.get("retry_backoff", 1)
+        self.max_retry_backoff = cfg.get("max_retry_backoff", 60)
+        # seconds to wait for more events with the same labels
+        # before sending them out as one message
+        self.coalesce_window = cfg.get("coalesce_window", 0)
+
 
 class NotificationHandler:
     def __init__(self, config: dict = None):
         if config is None:
-            config = ambianic.configuration.get_root_config()
+            config = get_root_config()
         self.apobj = apprise.Apprise(debug=True)
         self.config = config.get("notifications", {})
+        # read the settings used to format messages once,
+        # the pipeline server restarts on config changes
+        self._peer_id = config.get("peerId", None)
+        ui_config = config.get("ui", {})
+        self._ui_base_url = ui_config.get("baseurl", UI_BASE_URL_DEFAULT)
+        self._display_name = config.get("display_name", "My Ambianic Edge Device")
+        self.providers = {}
         for name, cfg in self.config.items():
+            self.providers[name] = _ProviderSettings(cfg)
             providers = cfg.get("providers", [])
             for provider in providers:
                 if not self.apobj.add(provider, tag=name):
@@ -47,117 +88,333 @@ class NotificationHandler:
                 else:
                     log.info(f"Apprise: added notification provider: {name}={provider}")
 
+    def render(self, notification: Notification, provider: str, event_count=1):
+        """Resolve title, message and attachments of a notification.
+
+        :Parameters:
+        ----------
+        notification : Notification
+            The notification to send.
+        provider : string
+            Tag of the configured notification provider.
+        event_count : int
+            Number of events the message stands for.
+
+        :Returns:
+        -------
+        tuple
+            title, message and list of attachments.
+
+        """
+        settings = self.providers[provider]
+        title = settings.title
+        if notification.title is not None:
+            title = Template(notification.title)
+
+        message = settings.message
+        if notification.message is not None:
+            message = Template(notification.message)
+
+        attachments = []
+        if settings.include_attachments:
+            for a in notification.attach:
+                if not os.path.exists(a) or not os.path.isfile(a):
+                    log.warning("Attachment is not a valid file %s", a)
+                    continue
+                attachments.append(a)
+
+        url_params = {**notification.envelope}
+
+        if self._peer_id is None:
+            log.warning(
+                "peerId not found. Notification will not include link back to peer."
+            )
+        else:
+            peerid_hash_input = self._peer_id + notification.envelope["args"]["id"]
+            peerid_hash = hashlib.sha256(peerid_hash_input.encode("utf-8")).hexdigest()
+            # send peerid hashed with event_id as salt to avoid replay attacks
+            # UI can lookup the actual peerid be going over its stored peerid's
+            # and generating salted hashes for each
+            # until one matches the URL paramter.
+            url_params["peerid_hash"] = peerid_hash
+
+        # convert args values to JSON format to ensure
+        # smooth conversion to JavaScript values on the UI side
+        # Fix for bug: https://github.com/ambianic/ambianic-edge/issues/397
+        args = url_params["args"]
+        url_params["args"] = jsonify(args)
+        # URL encode all parameters
+        url_query = urllib.parse.urlencode(url_params)
+
+        event_labels = list(
+            map(
+                lambda i: i["label"],
+                notification.envelope["args"]["inference_result"],
+            )
+        )
+        event_labels_str = ",".join(event_labels)
+
+        template_args = {
+            "event_source": self._display_name,
+            "event_type": notification.envelope["args"]["inference_meta"]["display"],
+            "event_labels": self._display_name + ": " + event_labels_str,
+            "event_details_url": f"{self._ui_base_url}/event?{url_query}",
+            "event_count": event_count,
+        }
+
+        log.debug(f"template_args: {template_args}")
+
+        # resolve template references for title and message
+        title = title.safe_substitute(template_args)
+        message = message.safe_substitute(template_args)
+
+        log.debug(f"template resolved title: {title}")
+        log.debug(f"template resolved message: {message}")
+        return title, message, attachments
+
+    def notify(self, provider: str, title=None, message=None, attachments=None):
+        """Send a rendered message to a provider. Return True on success."""
+        ok = self.apobj.notify(
+            title=title,
+            body=message,
+            tag=provider,
+            attach=attachments or [],
+        )
+        if ok:
+            log.debug(f"Sent notification {title} to {provider}")
+        else:
+            log.warning(f"Error sending notification {title} to {provider}")
+        return ok
+
+    def enabled_providers(self, notification: Notification) -> list:
+        """Return the configured and enabled providers of a notification."""
+        providers = []
+        for provider in notification.providers:
+            settings = self.providers.get(provider, None)
+            if settings is None:
+                log.warning("Skipping unknown provider %s" % provider)
+            elif not settings.enabled:
+                log.debug(f"notification disabled for provider {provider}")
+            else:
+                providers.append(provider)
+        return providers
+
     def send(self, notification: Notification):
+        """Send a notification right away, without retries."""
         log.debug("preparing notification")
-        for provider in notification.providers:
+        for provider in self.enabled_providers(notification):
             log.debug(f"preparing notification payload for provider {provider}")
-            cfg = self.config.get(provider, None)
+            title, message, attachments = self.render(notification, provider)
+            self.notify(provider, title=title, message=message, attachments=attachments)
 
-            if cfg:
-                enabled = cfg.get("enabled", True)
-                if not enabled:
-                    log.debug(f"notification disabled for provider {provider}")
-                    return
-                else:
-                    log.debug(f"notification enabled for provider {provider}")
 
-                templates = cfg.get("templates", {})
+class _Message:
+    """A notification waiting to be sent to one provider."""
 
-                title = notification.title
-                if title is None:
-                    title = templates.get(
-                        "title",
-                        "[Ambianic.ai] New event - ${event_type}: ${event_labels}",
-                    )
+    def __init__(self, notification=None, provider=None):
+        self.notification = notification
+        self.provider = provider
+        self.event_count = 1
+        self.attempts = 0
 
-                log.debug(f"template title: {title}")
+    @property
+    def key(self):
+        return self.provider, self.notification.labels
 
-                message = notification.message
-                if message is None:
-                    message = templates.get(
-                        "message", "New event\n ${event_type}: ${event_labels}"
-                    )
 
-                log.debug(f"template message: {message}")
+class NotificationDispatcher:
+    """Sends notifications from a pool of worker threads.
 
-                attachments = []
-                for a in notification.attach:
-                    if not os.path.exists(a) or not os.path.isfile(a):
-                        log.warning("Attachment is not a valid file %s")
-                        continue
-                    attachments.append(a)
+    submit() returns right away, so slow notification endpoints
+    do not hold back the pipeline. Each provider tag can set in its
+    notifications config section:
 
-                url_params = {**notification.envelope}
+    rate_limit: max messages per minute, messages above the limit wait
+    retries: resend attempts of failed messages with exponential backoff,
+        starting at retry_backoff seconds and up to max_retry_backoff
+    coalesce_window: seconds to wait for more events with the same labels,
+        which are then sent out as one message.
+        Templates can refer to the number of events as ${event_count}.
 
-                peer_id = get_root_config().get("peerId", None)
-                if peer_id is None:
-                    log.warning(
-                        "peerId not found. Notification will not include link back to peer."
+    :Parameters:
+    ----------
+    handler : NotificationHandler
+        Formats and sends messages.
+    workers : int
+        Number of worker threads.
+    queue_size : int
+        Max number of messages waiting to be sent.
+        New messages are dropped when the queue is full.
+
+    """
+
+    def __init__(self, handler: NotificationHandler = None, workers=2, queue_size=100):
+        assert handler
+        assert workers > 0
+        assert queue_size > 0
+        self._handler = handler
+        self._workers = workers
+        self._queue_size = queue_size
+        self._cond = threading.Condition()
+        # (due time, sequence number, message) ordered by due time
+        self._schedule = []
+        self._sequence = itertools.count()
+        # messages not sent out yet, which new events can be coalesced into
+        self._pending = {}
+        self._next_send_time = {}
+        self._threads = []
+        self._stopping = False
+        self._dropped = 0
+
+    @property
+    def dropped_count(self) -> int:
+        """Number of messages dropped because the queue was full."""
+        return self._dropped
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._schedule)
+
+    def _start(self):
+        for i in range(self._workers):
+            t = threading.Thread(
+                target=self._run, name=f"Notification dispatcher {i}", daemon=True
+            )
+            self._threads.append(t)
+            t.start()
+
+    def _put(self, due=None, message=None):
+        heapq.heappush(self._schedule, (due, next(self._sequence), message))
+        self._cond.notify()
+
+    def submit(self, notification: Notification):
+        """Queue a notification for sending to its providers."""
+        now = time.monotonic()
+        with self._cond:
+            if self._stopping:
+                log.warning("Notification dispatcher stopped, dropping notification")
+                return
+            if not self._threads:
+                self._start()
+            for provider in self._handler.enabled_providers(notification):
+                message = _Message(notification=notification, provider=provider)
+                pending = self._pending.get(message.key, None)
+                if pending is not None:
+                    # keep the latest event, the link points to it
+                    pending.notification = notification
+                    pending.event_count += 1
+                    log.debug(
+                        "Coalesced notification for %s into a pending message",
+                        provider,
                     )
-                else:
-                    peerid_hash_input = peer_id + notification.envelope["args"]["id"]
-                    peerid_hash = hashlib.sha256(
-                        peerid_hash_input.encode("utf-8")
-                    ).hexdigest()
-                    # send peerid hashed with event_id as salt to avoid replay attacks
-                    # UI can lookup the actual peerid be going over its stored peerid's
-                    # and generating salted hashes for each
-                    # until one matches the URL paramter.
-                    url_params["peerid_hash"] = peerid_hash
-
-                # convert args values to JSON format to ensure
-                # smooth conversion to JavaScript values on the UI side
-                # Fix for bug: https://github.com/ambianic/ambianic-edge/issues/397
-                args = url_params["args"]
-                url_params["args"] = jsonify(args)
-                # URL encode all parameters
-                url_query = urllib.parse.urlencode(url_params)
-
-                ui_config = get_root_config().get("ui", {})
-                ui_base_url = ui_config.get("baseurl", UI_BASE_URL_DEFAULT)
-
-                event_labels = list(
-                    map(
-                        lambda i: i["label"],
-                        notification.envelope["args"]["inference_result"],
+                    continue
+                if len(self._schedule) >= self._queue_size:
+                    self._dropped += 1
+                    log.warning(
+                        "Notification queue is full, dropping message for %s",
+                        provider,
                     )
-                )
-                event_labels_str = ",".join(event_labels)
-                event_source_str = get_root_config().get(
-                    "display_name", "My Ambianic Edge Device"
-                )
+                    continue
+                settings = self._handler.providers[provider]
+                self._pending[message.key] = message
+                self._put(due=now + settings.coalesce_window, message=message)
+
+    def _next_message(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._schedule:
+                    due = self._schedule[0][0]
+                    if due <= now or self._stopping:
+                        message = heapq.heappop(self._schedule)[2]
+                        if self._stopping or self._rate_limit_passed(message, now):
+                            return message
+                        continue
+                elif self._stopping:
+                    return None
+                self._cond.wait(timeout=due - now if self._schedule else None)
+
+    def _rate_limit_passed(self, message=None, now=None) -> bool:
+        """Reserve a send slot for message or reschedule it to the next free slot.
+
+        Called with the lock held.
+        """
+        provider = message.provider
+        next_send_time = self._next_send_time.get(provider, 0)
+        if next_send_time > now:
+            self._put(due=next_send_time, message=message)
+            return False
+        settings = self._handler.providers[provider]
+        self._next_send_time[provider] = now + settings.min_interval
+        return True
+
+    def _run(self):
+        while True:
+            message = self._next_message()
+            if message is None:
+                return
+            with self._cond:
+                # new events are not coalesced into a message already being sent
+                if self._pending.get(message.key, None) is message:
+                    del self._pending[message.key]
+            try:
+                self._send(message)
+            except Exception:
+                log.exception("Error sending notification to %s", message.provider)
+
+    def _send(self, message: _Message):
+        handler = self._handler
+        title, body, attachments = handler.render(
+            message.notification, message.provider, event_count=message.event_count
+        )
+        message.attempts += 1
+        if handler.notify(
+            message.provider, title=title, message=body, attachments=attachments
+        ):
+            return
+        settings = handler.providers[message.provider]
+        if message.attempts > settings.retries or self._stopping:
+            log.warning(
+                "Giving up on notification to %s after %d attempts",
+                message.provider,
+                message.attempts,
+            )
+            return
+        backoff = min(
+            settings.retry_backoff * 2 ** (message.attempts - 1),
+            settings.max_retry_backoff,
+        )
+        log.info(
+            "Retrying notification to %s in %.1f seconds", message.provider, backoff
+        )
+        with self._cond:
+            self._put(due=time.monotonic() + backoff, message=message)
 
-                template_args = {
-                    "event_source": event_source_str,
-                    "event_type": notification.envelope["args"]["inference_meta"][
-                        "display"
-                    ],
-                    "event_labels": event_source_str + ": " + event_labels_str,
-                    "event_details_url": f"{ui_base_url}/event?{url_query}",
-                }
-
-                log.debug(f"template_args: {template_args}")
-
-                # resolve template references for title and message
-                title = Template(title).safe_substitute(template_args)
-                message = Template(message).safe_substitute(template_args)
-
-                log.debug(f"template resolved title: {title}")
-                log.debug(f"template resolved message: {message}")
-
-                include_attachments = cfg.get("include_attachments", False)
-                ok = self.apobj.notify(
-                    title=title,
-                    body=message,
-                    tag=provider,
-                    attach=attachments if include_attachments else [],
+    def stop(self, timeout=10):
+        """Send out waiting messages without further delays and stop.
+
+        Waits up to timeout seconds for the worker threads to finish.
+        Notifications submitted while stopping are dropped.
+        If a worker is still busy sending after the timeout,
+        the dispatcher stays stopped until a later stop() call
+        finds all workers finished.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(timeout=max(0, deadline - time.monotonic()))
+        with self._cond:
+            alive = [t for t in self._threads if t.is_alive()]
+            if alive:
+                log.warning(
+                    "%d notification dispatcher threads did not stop in %.1f seconds",
+                    len(alive),
+                    timeout,
                 )
-                if ok:
-                    log.debug(f"Sent notification {template_args} to {provider}")
-                else:
-                    log.warning(
-                        f"Error sending notification {template_args} to {provider}"
-                    )
-            else:
-                log.warning("Skipping unknown provider %s" % provider)
-                continue
+                self._threads = alive
+                return
+            self._threads = []
+            # worker threads start again with the next submitted notification
+            self._stopping = False
@@ -1,8 +1,11 @@
 """Main module for Ambianic AI pipelines."""
 import logging
+import queue
+import threading
 import time
 from typing import Iterable
 
+from ambianic.pipeline.metrics import ElementMetrics
 from ambianic.pipeline.pipeline_event import PipelineContext
 from ambianic.util import ManagedService
 
@@ -13,6 +16,157 @@ PIPE_STATE_STOPPED = 0
 PIPE_STATE_RUNNING = 10
 PIPE_STATES = [PIPE_STATE_RUNNING, PIPE_STATE_STOPPED]
 
+# What an asynchronous pipe element does with a new sample
+# when its input queue is full
+WORKER_OVERFLOW_DROP_OLDEST = "drop_oldest"
+WORKER_OVERFLOW_DROP_NEWEST = "drop_newest"
+WORKER_OVERFLOW_BLOCK = "block"
+WORKER_OVERFLOW_POLICIES = [
+    WORKER_OVERFLOW_DROP_OLDEST,
+    WORKER_OVERFLOW_DROP_NEWEST,
+    WORKER_OVERFLOW_BLOCK,
+]
+
+# queue item that tells a worker thread to exit
+_WORKER_STOP = None
+
+
+class PipeElementWorker:
+    """Runs a pipe element in its own thread fed by a bounded queue.
+
+    Decouples a pipe element from the element before it, so that
+    a slow element (e.g. disk or network IO) does not hold back
+    the source and the other elements of the pipeline.
+
+    :Parameters:
+    ----------
+    name : string
+        Worker thread name.
+    target : function
+        Invoked in the worker thread with each sample as keyword arguments.
+    queue_size : int
+        Max number of samples waiting to be processed.
+    overflow : string
+        What to do with a new sample when the queue is full:
+        drop_oldest - discard the oldest waiting sample (default),
+        drop_newest - discard the new sample,
+        block - wait until there is room in the queue.
+
+    """
+
+    def __init__(
+        self,
+        name=None,
+        target=None,
+        queue_size=1,
+        overflow=WORKER_OVERFLOW_DROP_OLDEST,
+    ):
+        assert target
+        assert queue_size > 0
+        assert (
+            overflow in WORKER_OVERFLOW_POLICIES
+        ), f"Worker overflow policy must be one of {WORKER_OVERFLOW_POLICIES}"
+        self._name = name
+        self._target = target
+        self._overflow = overflow
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        # set by stop(), new samples are dropped until start()
+        self._stopped = False
+        self._dropped_count = 0
+
+    @property
+    def dropped_count(self) -> int:
+        """Number of samples discarded on a full queue or after stop()."""
+        return self._dropped_count
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of samples waiting to be processed."""
+        return self._queue.qsize()
+
+    def _start(self) -> bool:
+        """Start the worker thread unless it is running or stopped."""
+        with self._lock:
+            if self._stopped:
+                return False
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=self._name, daemon=True
+                )
+                self._thread.start()
+            return True
+
+    def start(self):
+        """Start processing samples again after stop()."""
+        with self._lock:
+            self._stopped = False
+        self._start()
+
+    def _run(self):
+        while True:
+            sample = self._queue.get()
+            if sample is _WORKER_STOP:
+                return
+            try:
+                self._target(**sample)
+            except Exception:
+                # keep serving samples, same as a pipeline
+                # source would keep feeding the next sample
+                log.exception("Error in %s worker thread.", self._name)
+
+    def put(self, sample: dict = None):
+        """Queue a sample for processing in the worker thread.
+
+        Samples are dropped while the worker is stopped.
+        """
+        if not self._start():
+            self._dropped_count += 1
+            log.debug("%s stopped, dropping sample.", self._name)
+            return
+        if self._overflow == WORKER_OVERFLOW_BLOCK:
+            self._queue.put(sample)
+            return
+        try:
+            self._queue.put_nowait(sample)
+            return
+        except queue.Full:
+            self._dropped_count += 1
+        if self._overflow == WORKER_OVERFLOW_DROP_NEWEST:
+            log.debug("%s queue full, dropping new sample.", self._name)
+            return
+        log.debug("%s queue full, dropping oldest sample.", self._name)
+        try:
+            self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(sample)
+        except queue.Full:
+            pass
+
+    def stop(self, timeout=None, drain=False):
+        """Discard waiting samples and stop the worker thread.
+
+        Waits up to timeout seconds for the sample in progress.
+        With drain=True waiting samples are processed instead of discarded.
+        Samples put after stop() are dropped until start() is called.
+        """
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        while not drain:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put(_WORKER_STOP)
+        thread.join(timeout=timeout)
+
 
 class PipeElement(ManagedService):
     """The basic building block of an Ambianic pipeline."""
@@ -22,9 +176,22 @@ class PipeElement(ManagedService):
         element_name=None,
         context: PipelineContext = None,
         event_log: logging.Logger = None,
-        **kwargs
+        worker: dict = None,
+        **kwargs,
     ):
-        """Create a PipeElement instance."""
+        """Create a PipeElement instance.
+
+        :Parameters:
+        ----------
+        worker : dict
+            Optional. Run this element in its own thread, fed by a bounded
+            queue of samples from the previous element. For example:
+            {'queue_size': 1, 'overflow': 'drop_oldest'}
+            See PipeElementWorker for supported settings.
+            By default elements process samples synchronously in the
+            thread of the previous element.
+
+        """
         super().__init__()
         self._name = element_name
         self._state = PIPE_STATE_STOPPED
@@ -32,12 +199,43 @@ class PipeElement(ManagedService):
         self._latest_heartbeat = time.monotonic()
         self._context = context
         self._timeline_event_log = event_log
+        self._metrics = ElementMetrics()
+        self._worker = None
+        if worker is not None:
+            self._worker = PipeElementWorker(
+                name=f"{element_name or self.__class__.__name__} worker",
+                target=self._process_next_sample,
+                **worker,
+            )
 
     @property
     def name(self) -> str:
         """Return this element's reference name in pipeline definitions."""
         return self._name
 
+    @property
+    def dropped_samples(self) -> int:
+        """Number of input samples this element dropped without processing.
+
+        Only elements running in their own worker thread drop samples,
+        when their queue overflows.
+        """
+        if self._worker is None:
+            return 0
+        return self._worker.dropped_count
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of input samples waiting in the worker queue."""
+        if self._worker is None:
+            return 0
+        return self._worker.queue_depth
+
+    @property
+    def metrics(self) -> ElementMetrics:
+        """Sample counters and processing latency of this element."""
+        return self._metrics
+
     @property
     def context(self) -> PipelineContext:
         """Pipeline execution context.
@@ -103,6 +301,8 @@ class PipeElement(ManagedService):
 
         """
         self._state = PIPE_STATE_RUNNING
+        if self._worker is not None:
+            self._worker.start()
 
     def heal(self):  # pragma: no cover
         """Override with adequate implementation of a healing procedure.
@@ -150,6 +350,8 @@ class PipeElement(ManagedService):
 
         """
         self._state = PIPE_STATE_STOPPED
+        if self._worker is not None:
+            self._worker.stop(timeout=10)
 
     def connect_to_next_element(self, next_element=None):
         """Connect this element to the next element in the pipe.
@@ -180,13 +382,32 @@ class PipeElement(ManagedService):
 
         """
         self.heartbeat()
-        for processed_sample in self.process_sample(**sample):
-            if self._next_element:
-                if processed_sample:
-                    self._next_element.receive_next_sample(**processed_sample)
-                else:
-                    self._next_element.receive_next_sample()
-                self.heartbeat()
+        self._metrics.samples_in += 1
+        if self._worker is not None:
+            self._worker.put(sample)
+        else:
+            self._process_next_sample(**sample)
+
+    def _process_next_sample(self, **sample):
+        self.heartbeat()
+        # time spent in downstream elements is not counted
+        # towards the latency of this element
+        elapsed = 0
+        start = time.perf_counter()
+        try:
+            for processed_sample in self.process_sample(**sample):
+                elapsed += time.perf_counter() - start
+                self._metrics.samples_out += 1
+                if self._next_element:
+                    if processed_sample:
+                        self._next_element.receive_next_sample(**processed_sample)
+                    else:
+                        self._next_element.receive_next_sample()
+                    self.heartbeat()
+                start = time.perf_counter()
+        finally:
+            elapsed += time.perf_counter() - start
+            self._metrics.latency.observe(elapsed)
 
     def process_sample(self, **sample) -> Iterable[dict]:
         """Override and implement as generator.
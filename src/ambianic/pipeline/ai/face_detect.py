@@ -69,9 +69,7 @@ class FaceDetector(TFBoundingBoxDetection):
                     )
                     for box in person_regions:
                         person_image = self.crop_image(image, box)
-                        thumbnail, tensor_image, inference_result = self.detect(
-                            image=person_image
-                        )
+                        thumbnail, inference_result = self.detect(image=person_image)
 
                         inference_result = self.convert_inference_result(
                             inference_result
@@ -5,18 +5,37 @@ import time
 from pathlib import Path
 
 from ambianic.configuration import DEFAULT_DATA_DIR
-from ambianic.pipeline.ai.pose_engine import PoseEngine
+from ambianic.pipeline.ai.pose_engine import (
+    ROTATE_0,
+    ROTATE_90,
+    ROTATE_270,
+    PoseEngine,
+)
 from ambianic.pipeline.ai.tf_detect import TFDetectionModel
 from PIL import Image, ImageDraw
 
 log = logging.getLogger(__name__)
 
+# How to look for poses of a fallen person
+# rotate, resize and pad the original image for each rotation
+ROTATION_MODE_IMAGE = "image"
+# resize the image once and rotate the input tensor image
+ROTATION_MODE_TENSOR = "tensor"
+ROTATION_MODES = [ROTATION_MODE_IMAGE, ROTATION_MODE_TENSOR]
+
 
 class FallDetector(TFDetectionModel):
 
     """Detects falls comparing two images spaced about 1-2 seconds apart."""
 
-    def __init__(self, model=None, confidence_threshold=0.15, **kwargs):
+    def __init__(
+        self,
+        model=None,
+        confidence_threshold=0.15,
+        rotation_mode=ROTATION_MODE_IMAGE,
+        rotation_batch=False,
+        **kwargs,
+    ):
         """Initialize detector with config parameters.
         :Parameters:
         ----------
@@ -27,6 +46,15 @@ class FallDetector(TFDetectionModel):
             'edgetpu':
                 'ai_models/posenet_mobilenet_v1_075_721_1281_quant_decoder_edgetpu.tflite'
         }
+        rotation_mode: image
+            How to look for a fallen person when the upright pose score is low.
+            image - rotate, resize and pad the original image +/- 90'.
+            tensor - resize and pad the image once and rotate the small
+            input tensor image. Starts with the rotation that found
+            the pose in the previous frame. Requires a square input tensor.
+        rotation_batch: false
+            With the tensor rotation mode, run inference on all
+            rotations at once, as one batch if the AI model supports it.
         """
         super().__init__(
             model=model, confidence_threshold=confidence_threshold, **kwargs
@@ -64,6 +92,20 @@ class FallDetector(TFDetectionModel):
         self._prev_data[0] = self._prev_data[1] = _dix
 
         self._pose_engine = PoseEngine(self._tfengine, context=self.context)
+        assert (
+            rotation_mode in ROTATION_MODES
+        ), f"rotation_mode must be one of {ROTATION_MODES}"
+        _, tensor_height, tensor_width, _ = self._pose_engine.get_input_tensor_shape()
+        if rotation_mode == ROTATION_MODE_TENSOR and tensor_height != tensor_width:
+            log.warning(
+                "Tensor rotation mode requires a square input tensor. "
+                "Falling back to image rotation mode."
+            )
+            rotation_mode = ROTATION_MODE_IMAGE
+        self._rotation_mode = rotation_mode
+        self._rotation_batch = rotation_batch
+        # rotation that found the pose in the latest frame
+        self._latest_rotation = ROTATE_0
         self._fall_factor = 60
         self.confidence_threshold = confidence_threshold
         log.debug(
@@ -116,6 +158,9 @@ class FallDetector(TFDetectionModel):
                     "inference_result": inference_result,
                     "inference_meta": inf_meta,
                 }
+                image_jpeg = sample.get("image_jpeg", None)
+                if image_jpeg is not None:
+                    processed_sample["image_jpeg"] = image_jpeg
                 yield processed_sample
             except Exception as e:
                 log.exception(
@@ -167,8 +212,53 @@ class FallDetector(TFDetectionModel):
 
         return test
 
+    def _find_keypoints_in_rotated_tensors(self, image):
+        min_score = self.confidence_threshold
+        thumbnail, template_image = self._pose_engine.resize_to_input_tensor(image)
+        # same search order as in image rotation mode, except that
+        # the rotation that worked for the latest frame goes first
+        # since a person that fell is likely to stay in the same position
+        rotations = [ROTATE_0, ROTATE_90, ROTATE_270]
+        rotations.remove(self._latest_rotation)
+        rotations.insert(0, self._latest_rotation)
+        if self._rotation_batch:
+            results = self._pose_engine.detect_rotated_poses(
+                template_image, rotations=rotations, batch=True
+            )
+        else:
+            # lazily detect one rotation at a time
+            results = (
+                self._pose_engine.detect_rotated_poses(
+                    template_image, rotations=[rotation]
+                )[0]
+                for rotation in rotations
+            )
+        best = None
+        for rotation, (poses, _) in zip(rotations, results):
+            spinal_vector_score, pose_dix = self.estimate_spinal_vector_score(poses[0])
+            if best is None or spinal_vector_score > best[1]:
+                best = (poses[0], spinal_vector_score, pose_dix, rotation)
+            if spinal_vector_score >= min_score:
+                break
+        pose, spinal_vector_score, pose_dix, rotation = best
+        if spinal_vector_score >= min_score:
+            self._latest_rotation = rotation
+            log.info(
+                f"""A pose detected with
+                    spinal_vector_score={spinal_vector_score} >= {min_score}
+                    confidence threshold.
+                    Pose keypoints: {pose_dix}"
+                """
+            )
+        else:
+            pose = None
+        return pose, thumbnail, spinal_vector_score, pose_dix
+
     def find_keypoints(self, image):
 
+        if self._rotation_mode == ROTATION_MODE_TENSOR:
+            return self._find_keypoints_in_rotated_tensors(image)
+
         # this score value should be related to the configuration \
         # confidence_threshold parameter
         min_score = self.confidence_threshold
@@ -5,34 +5,270 @@ import time
 import numpy as np
 
 # from importlib import import_module
-from ambianic.pipeline.ai.tf_detect import TFDetectionModel
+from ambianic.pipeline.ai.tf_detect import TFDetectionModel, fit_image
+from ambianic.pipeline.object_track import box_iou
+from PIL import Image, ImageDraw
 
 log = logging.getLogger(__name__)
 
 
+def parse_roi(roi=None) -> list:
+    """Validate regions of interest from the element config.
+
+    :Returns:
+    -------
+    list
+        (box, polygon) per region. box is (xmin, ymin, xmax, ymax)
+        relative to the image size. polygon is None for rectangles,
+        otherwise a list of (x, y) points relative to the region box.
+    """
+    regions = []
+    for region in roi or []:
+        if "polygon" in region:
+            points = np.asarray(region["polygon"], dtype=np.float64)
+            assert (
+                points.ndim == 2 and points.shape[1] == 2 and len(points) >= 3
+            ), "roi polygon must have at least 3 [x, y] points"
+            assert (
+                (points >= 0) & (points <= 1)
+            ).all(), "roi polygon points must be between 0 and 1"
+            box = (*points.min(axis=0), *points.max(axis=0))
+            size = np.array([box[2] - box[0], box[3] - box[1]])
+            polygon = [tuple(p) for p in (points - box[:2]) / size]
+        else:
+            box = (region["xmin"], region["ymin"], region["xmax"], region["ymax"])
+            polygon = None
+        box = tuple(float(v) for v in box)
+        xmin, ymin, xmax, ymax = box
+        assert (
+            0 <= xmin < xmax <= 1 and 0 <= ymin < ymax <= 1
+        ), f"roi {region} must be a non empty area between 0 and 1"
+        regions.append((box, polygon))
+    return regions
+
+
+def crop_region(image=None, box=None, polygon=None):
+    """Crop a region of interest out of image.
+
+    :Parameters:
+    ----------
+    image : PIL.Image
+        Input image.
+    box : tuple
+        (xmin, ymin, xmax, ymax) relative to the image size.
+    polygon : list
+        Optional. (x, y) points relative to box. Pixels outside
+        of the polygon are blacked out.
+
+    :Returns:
+    -------
+    PIL.Image
+        Region of the image at its original resolution.
+    """
+    width, height = image.size
+    xmin, ymin, xmax, ymax = box
+    pixel_box = (
+        round(xmin * width),
+        round(ymin * height),
+        max(round(xmax * width), round(xmin * width) + 1),
+        max(round(ymax * height), round(ymin * height) + 1),
+    )
+    region_image = image.crop(pixel_box)
+    if polygon:
+        w, h = region_image.size
+        mask = Image.new("L", (w, h), 0)
+        ImageDraw.Draw(mask).polygon([(x * w, y * h) for x, y in polygon], fill=255)
+        masked = Image.new(region_image.mode, (w, h))
+        masked.paste(region_image, mask=mask)
+        region_image = masked
+    return region_image
+
+
+def map_box_from_region(box=None, region_box=None) -> tuple:
+    """Map a box relative to a region of interest to the whole image."""
+    xmin, ymin, xmax, ymax = region_box
+    w = xmax - xmin
+    h = ymax - ymin
+    x0, y0, x1, y1 = box
+    return (xmin + x0 * w, ymin + y0 * h, xmin + x1 * w, ymin + y1 * h)
+
+
+def _tile_offsets(length=None, tile_size=None, overlap=None) -> list:
+    if length <= tile_size:
+        return [0]
+    stride = tile_size * (1 - overlap)
+    count = int(np.ceil((length - tile_size) / stride)) + 1
+    # spread the tiles evenly, with at least the requested overlap
+    return np.linspace(0, length - tile_size, count).round().astype(int).tolist()
+
+
+def tile_boxes(size=None, tile_size=None, overlap=None) -> list:
+    """Split an image of size (width, height) into overlapping tiles.
+
+    :Returns:
+    -------
+    list
+        (x0, y0, x1, y1) pixel box of each tile, row by row.
+    """
+    width, height = size
+    tile_width = min(tile_size, width)
+    tile_height = min(tile_size, height)
+    return [
+        (x, y, x + tile_width, y + tile_height)
+        for y in _tile_offsets(height, tile_height, overlap)
+        for x in _tile_offsets(width, tile_width, overlap)
+    ]
+
+
+def non_max_suppression(boxes=None, scores=None, labels=None, iou_threshold=0.5):
+    """Return indices of the boxes kept after non-maximum suppression.
+
+    A box is dropped if it overlaps a box with the same label
+    and a higher score by more than iou_threshold.
+
+    :Parameters:
+    ----------
+    boxes : numpy.ndarray
+        Array of shape (N, 4) with xmin, ymin, xmax, ymax per box.
+    scores : numpy.ndarray
+        Confidence score per box.
+    labels : numpy.ndarray
+        Optional. Label per box. Boxes with different labels
+        do not suppress each other.
+    iou_threshold : float
+        Max intersection over union of boxes kept.
+
+    :Returns:
+    -------
+    list
+        Indices of kept boxes ordered by descending score.
+    """
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    boxes = np.asarray(boxes, dtype=np.float64)[order]
+    overlaps = box_iou(boxes, boxes) > iou_threshold
+    if labels is not None:
+        labels = np.asarray(labels)[order]
+        overlaps &= labels[:, None] == labels[None, :]
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(int(order[i]))
+        suppressed |= overlaps[i]
+    return keep
+
+
 class TFBoundingBoxDetection(TFDetectionModel):
     """Applies Tensorflow image detection."""
 
-    def __init__(self, model=None, **kwargs):
+    def __init__(self, model=None, roi=None, tiling=None, **kwargs):
         """Initialize detector with config parameters.
         :Parameters:
         ----------
         model: ai_models/mobilenet_ssd_v2_face.tflite
+        roi: # optional. Regions of interest in the image.
+                Only these regions are passed to the AI model,
+                each cropped at the full resolution of the input image.
+                Detection boxes are mapped back to the full image.
+                Coordinates are relative to the image size, between 0 and 1.
+                For example:
+                - xmin: 0.5 # a rectangle
+                  ymin: 0.2
+                  xmax: 0.8
+                  ymax: 1.0
+                - polygon: [[0.1, 0.1], [0.4, 0.1], [0.3, 0.6]]
+                  # pixels outside of the polygon are blacked out
+        tiling: # optional. Split high resolution images (or regions of
+                interest) into overlapping tiles, run them through the
+                AI model as one batch and merge the results, so that
+                small, distant objects are detected. For example:
+                tile_size: 300 # tile width and height in image pixels.
+                    Defaults to the input tensor size.
+                overlap: 0.25 # fraction of a tile overlapping its neighbors
+                full_frame: true # also run the whole downscaled image,
+                    which finds objects larger than a tile
+                nms_threshold: 0.5 # min intersection over union of two
+                    boxes with the same label to keep only the more
+                    confident one
+                top_k applies to each tile.
         """
 
         super().__init__(model, **kwargs)
+        self._regions = parse_roi(roi)
+        self._tiling = None
+        if tiling is not None:
+            tiling = dict(tiling)
+            self._tiling = {
+                "tile_size": tiling.pop("tile_size", None)
+                or max(self.input_tensor_size),
+                "overlap": tiling.pop("overlap", 0.25),
+                "full_frame": tiling.pop("full_frame", True),
+                "nms_threshold": tiling.pop("nms_threshold", 0.5),
+            }
+            assert not tiling, f"Unknown tiling options: {list(tiling)}"
+            assert self._tiling["tile_size"] > 0
+            assert 0 <= self._tiling["overlap"] < 1, "overlap must be in [0, 1)"
+            assert 0 < self._tiling["nms_threshold"] <= 1
+
+    def _detect_regions(self, image=None):
+        """Resize each region of interest or tile into an input tensor.
+
+        :Returns:
+        -------
+        list
+            (region box, input tensor data, thumbnail) per region.
+            The region box of the whole image is (0, 0, 1, 1).
+        """
+        regions = self._regions or [((0, 0, 1, 1), None)]
+        views = []
+
+        def add_view(view_image=None, box=None):
+            input_data, thumbnail = self.prepare_input_tensor(
+                image=view_image, buffer_index=len(views)
+            )
+            views.append((box, input_data, thumbnail))
+
+        for box, polygon in regions:
+            if self._regions:
+                region_image = crop_region(image=image, box=box, polygon=polygon)
+            else:
+                region_image = image
+            tiles = []
+            if self._tiling is not None:
+                tiles = tile_boxes(
+                    size=region_image.size,
+                    tile_size=self._tiling["tile_size"],
+                    overlap=self._tiling["overlap"],
+                )
+                if len(tiles) == 1:
+                    # the region fits in one tile
+                    tiles = []
+            if not tiles or self._tiling["full_frame"]:
+                add_view(region_image, box)
+            width, height = region_image.size
+            for tile in tiles:
+                x0, y0, x1, y1 = tile
+                tile_box = map_box_from_region(
+                    (x0 / width, y0 / height, x1 / width, y1 / height), box
+                )
+                add_view(region_image.crop(tile), tile_box)
+        return views
 
     def detect(self, image=None):
         """Detect objects in image.
         :Parameters:
         ----------
         image : PIL.Image
-            Input image in raw RGB format
-            with the exact size of the input tensor.
+            Input image of any size. It is resized to fit
+            the input tensor of the AI model.
         :Returns:
         -------
-        list of tuples
-            List of top_k detections above confidence_threshold.
+        tuple
+            (thumbnail, inference_result):
+            the image resized to fit the input tensor
+            and a list of top_k detections above confidence_threshold
+            per region of interest or tile.
             Each detection is a tuple of:
             (label, confidence, (x0, y0, x1, y1))
         """
@@ -42,59 +278,68 @@ class TFBoundingBoxDetection(TFDetectionModel):
 
         tfe = self._tfengine
 
-        # NxHxWxC, H:1, W:2
-        height = tfe.input_details[0]["shape"][1]
-        width = tfe.input_details[0]["shape"][2]
-
-        desired_size = (width, height)
-
-        new_im, thumbnail = self.resize_to_input_tensor(
-            image=image, desired_size=desired_size
-        )
-
-        # calculate what fraction of the new image is the thumbnail size
-        # we will use these factors to adjust detection box coordinates
-        w_factor = thumbnail.size[0] / new_im.size[0]
-        h_factor = thumbnail.size[1] / new_im.size[1]
-
-        # add N dim
-        input_data = np.expand_dims(new_im, axis=0)
-        # log.warning('input_data.shape: %r', input_data.shape)
-        # log.warning('input_data.dtype: %r', input_data.dtype)
-        # input_data = input_data.astype(np.uint8)
-        # log.warning('input_data.dtype: %r', input_data.dtype)
-        # input_data = np.asarray(input_data).flatten()
+        desired_size = self.input_tensor_size
 
         # Note: Floating models are not tested thoroughly yet.
         # Its not clear yet whether floating models will be a good fit
         # for Ambianic use cases. Optimized quantized models seem to do
         # a good job in terms of accuracy and speed.
-        if not tfe.is_quantized:  # pragma: no cover
-            # normalize floating point values
-            input_mean = 127.5
-            input_std = 127.5
-            input_data = (np.float32(input_data) - input_mean) / input_std
+        views = self._detect_regions(image=image)
 
-        tfe.set_tensor(tfe.input_details[0]["index"], input_data)
+        inputs_list = [
+            {tfe.input_details[0]["index"]: input_data} for _, input_data, _ in views
+        ]
 
-        # invoke inference on the new input data
-        # with the configured model
-        tfe.infer()
+        output_indexes = [tfe.output_details[i]["index"] for i in range(4)]
+        if len(inputs_list) == 1:
+            [(index, input_data)] = inputs_list[0].items()
+            tfe.set_tensor(index, input_data)
+            # invoke inference on the new input data
+            # with the configured model
+            tfe.infer()
+            outputs_list = [{i: tfe.get_tensor(i) for i in output_indexes}]
+        else:
+            # regions of interest run as one batch if the model supports it
+            outputs_list = tfe.infer_batch(inputs_list)
 
         self.log_stats(start_time=start_time)
 
-        # log.debug('output_details: %r', tfe.output_details)
-        # od = tfe.output_details[0]['index']
-        # log.debug('output_data[0]: %r',
-        #             tfe.get_tensor(od))
-        # log.debug('output_data[0]: %r',
-        #             tfe._tf_interpreter.get_tensor(od))
+        inference_result = []
+        for (region_box, _, thumbnail), outputs in zip(views, outputs_list):
+            for label, confidence, box in self._decode_detections(
+                outputs=[outputs[i] for i in output_indexes],
+                tensor_size=desired_size,
+                thumbnail=thumbnail,
+            ):
+                inference_result.append(
+                    (label, confidence, map_box_from_region(box, region_box))
+                )
+        if self._tiling is not None and len(inference_result) > 1:
+            # drop duplicates of objects found in overlapping tiles
+            keep = non_max_suppression(
+                boxes=np.array([box for _, _, box in inference_result]),
+                scores=np.array([confidence for _, confidence, _ in inference_result]),
+                labels=np.array([label for label, _, _ in inference_result]),
+                iou_threshold=self._tiling["nms_threshold"],
+            )
+            inference_result = [inference_result[i] for i in keep]
+        if len(views) > 1 or self._regions:
+            # the saved event thumbnail shows the whole image
+            # that the detection boxes refer to
+            thumbnail = fit_image(image=image, desired_size=desired_size)
+        return thumbnail, inference_result
+
+    def _decode_detections(self, outputs=None, tensor_size=None, thumbnail=None):
+        """Return detections in coordinates relative to the thumbnail."""
+        tfe = self._tfengine
+
+        # calculate what fraction of the new image is the thumbnail size
+        # we will use these factors to adjust detection box coordinates
+        w_factor = thumbnail.size[0] / tensor_size[0]
+        h_factor = thumbnail.size[1] / tensor_size[1]
 
         # get output tensor
-        boxes = tfe.get_tensor(tfe.output_details[0]["index"])
-        label_codes = tfe.get_tensor(tfe.output_details[1]["index"])
-        scores = tfe.get_tensor(tfe.output_details[2]["index"])
-        num = tfe.get_tensor(tfe.output_details[3]["index"])
+        boxes, label_codes, scores, num = outputs
         # log.warning('Detections:\n num: %r\n label_codes: %r\n scores: %r\n',
         #             num, label_codes, scores)
         # log.warning('Required confidence: %r',
@@ -134,7 +379,7 @@ class TFBoundingBoxDetection(TFDetectionModel):
                         log.debug(
                             "thumbnail image size: %r , " "tensor image size: %r",
                             thumbnail.size,
-                            new_im.size,
+                            tensor_size,
                         )
                         log.debug(
                             "resizing detection box (x0, y0, x1, y1) " "from: %r to %r",
@@ -142,4 +387,4 @@ class TFBoundingBoxDetection(TFDetectionModel):
                             (x0, y0, x1, y1),
                         )
                         inference_result.append((label, confidence, (x0, y0, x1, y1)))
-        return thumbnail, new_im, inference_result
+        return inference_result
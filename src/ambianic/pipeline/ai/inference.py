@@ -1,6 +1,12 @@
 """Tensorflow inference engine wrapper."""
+import gc
 import logging
 import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
 
 import numpy as np
 from tflite_runtime.interpreter import Interpreter, load_delegate
@@ -26,6 +32,349 @@ def _get_edgetpu_interpreter(model=None):  # pragma: no cover
     return tf_interpreter
 
 
+# upper limit of frames stacked into one batched inference
+MAX_BATCH_SIZE = 8
+# seconds to wait for the rest of a batch queued at once by infer_batch
+BATCH_SUBMIT_WINDOW = 0.001
+
+
+class _InferenceWorker:
+    """Serves inference requests one batch at a time on a single interpreter.
+
+    Requests that allow batching and arrive within the batch window
+    of the first one are stacked along the batch dimension of the input
+    tensor and run with a single invoke. If the model does not accept
+    a resized batch dimension, requests are run one at a time.
+
+    Intentionally does not hold a reference to the SharedInterpreter
+    so that it can be garbage collected when no engine uses it anymore.
+    """
+
+    def __init__(self, tf_interpreter=None, requests=None):
+        assert tf_interpreter
+        assert requests
+        self._tf_interpreter = tf_interpreter
+        self._requests = requests
+        input_details = tf_interpreter.get_input_details()
+        self._input_index = input_details[0]["index"]
+        self._input_shape = list(input_details[0]["shape"])
+        self._batch_size = 1
+        # None until a batched invoke has been tried
+        self._batchable = None if len(input_details) == 1 else False
+
+    def _collect_batch(self, request=None):
+        """Gather requests that arrive within the first request batch window.
+
+        :Returns:
+        -------
+        (list, bool)
+            Batch of requests and whether the worker should stop after it.
+        """
+        batch = [request]
+        batch_window = request[3]
+        if not batch_window or self._batchable is False:
+            return batch, False
+        deadline = time.monotonic() + batch_window
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                next_request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if next_request is None:
+                return batch, True
+            batch.append(next_request)
+        return batch, False
+
+    def _resize_batch(self, batch_size=None):
+        if batch_size == self._batch_size:
+            return
+        self._tf_interpreter.resize_tensor_input(
+            self._input_index, [batch_size] + self._input_shape[1:]
+        )
+        # track the new size even if allocation fails so it can be undone
+        self._batch_size = batch_size
+        self._tf_interpreter.allocate_tensors()
+
+    def _invoke_one(self, inputs=None, output_indexes=None):
+        self._resize_batch(1)
+        for index, tensor_data in inputs.items():
+            self._tf_interpreter.set_tensor(index, tensor_data)
+        self._tf_interpreter.invoke()
+        # get_tensor returns a copy that is safe to hand over
+        return {
+            index: self._tf_interpreter.get_tensor(index) for index in output_indexes
+        }
+
+    def _invoke_batch(self, batch=None):
+        """Run a batch of requests with one invoke.
+
+        :Returns:
+        -------
+        list
+            Outputs per request or None if the model can not run batches.
+        """
+        try:
+            self._resize_batch(len(batch))
+            input_data = np.concatenate(
+                [inputs[self._input_index] for inputs, _, _, _ in batch]
+            )
+            self._tf_interpreter.set_tensor(self._input_index, input_data)
+            self._tf_interpreter.invoke()
+            output_indexes = batch[0][1]
+            outputs = {
+                index: self._tf_interpreter.get_tensor(index)
+                for index in output_indexes
+            }
+            for output_data in outputs.values():
+                if output_data.shape[0] != len(batch):
+                    raise ValueError(
+                        f"Output batch size {output_data.shape[0]} "
+                        f"does not match input batch size {len(batch)}"
+                    )
+        except (ValueError, RuntimeError) as e:
+            log.info("AI model does not support batched inference: %s", e)
+            self._batchable = False
+            self._resize_batch(1)
+            return None
+        self._batchable = True
+        return [
+            {index: output_data[i : i + 1] for index, output_data in outputs.items()}
+            for i in range(len(batch))
+        ]
+
+    def _run(self, batch=None):
+        batch = [
+            request for request in batch if request[2].set_running_or_notify_cancel()
+        ]
+        batchable = self._batchable is not False and all(
+            list(inputs.keys()) == [self._input_index] for inputs, _, _, _ in batch
+        )
+        if len(batch) > 1 and batchable:
+            results = self._invoke_batch(batch)
+            if results is not None:
+                for request, outputs in zip(batch, results):
+                    request[2].set_result(outputs)
+                return
+        for inputs, output_indexes, future, _ in batch:
+            try:
+                outputs = self._invoke_one(inputs=inputs, output_indexes=output_indexes)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(outputs)
+
+    def serve(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch, stop = self._collect_batch(request)
+            try:
+                self._run(batch)
+            except Exception as e:
+                # keep serving the other pipelines that share this model
+                log.exception("Error running inference requests")
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            if stop:
+                return
+
+
+class SharedInterpreter:
+    """Inference broker that owns a single TFLite interpreter for a model.
+
+    A TFLite interpreter is not thread safe and an EdgeTPU can only be
+    opened once, so instead of each pipeline element loading its own copy
+    of a model, inference requests from all pipelines are put on a queue
+    and served in order by a dedicated worker thread.
+    Requests that allow it are batched together, see _InferenceWorker.
+
+    :Parameters:
+    ----------
+    model_tflite : string
+        Location of the TFLite model file.
+    model_edgetpu : string
+        Location of the EdgeTPU compiled model file. Optional.
+    warm_up : bool
+        Run one inference on blank input right after loading the model,
+        so that the first frame does not pay for delegate setup and
+        memory allocation. Defaults to True.
+
+    """
+
+    def __init__(self, model_tflite=None, model_edgetpu=None, warm_up=True):
+        assert model_tflite
+        # EdgeTPU is not available in testing and other environments
+        # load dynamically as needed
+        tf_interpreter = _get_edgetpu_interpreter(model=model_edgetpu)
+        if not tf_interpreter:
+            log.debug("EdgeTPU not available. Will use TFLite CPU runtime.")
+            tf_interpreter = Interpreter(model_path=model_tflite)
+        assert tf_interpreter
+        tf_interpreter.allocate_tensors()
+        self._input_details = tf_interpreter.get_input_details()
+        self._output_details = tf_interpreter.get_output_details()
+        self._output_indexes = [od["index"] for od in self._output_details]
+        if warm_up:
+            _warm_up(tf_interpreter, model_tflite)
+        # engines using this interpreter
+        self._engines = weakref.WeakSet()
+        self._requests = queue.Queue()
+        worker = _InferenceWorker(
+            tf_interpreter=tf_interpreter, requests=self._requests
+        )
+        self._worker = threading.Thread(
+            target=worker.serve,
+            name=f"inference {os.path.basename(model_tflite)}",
+            daemon=True,
+        )
+        self._worker.start()
+        # stop the worker once the model is unloaded
+        # and the last engine using it is gone
+        weakref.finalize(self, self._requests.put, None)
+
+    @property
+    def input_details(self):
+        return self._input_details
+
+    @property
+    def output_details(self):
+        return self._output_details
+
+    @property
+    def in_use(self) -> bool:
+        """Whether any engine uses this interpreter."""
+        return len(self._engines) > 0
+
+    def add_engine(self, engine=None):
+        """Register an engine that sends its requests to this interpreter."""
+        self._engines.add(engine)
+
+    def submit(self, inputs=None, batch_window=None) -> Future:
+        """Queue an inference request.
+
+        :Parameters:
+        ----------
+        inputs : dict
+            Input tensor data keyed by tensor index.
+        batch_window : float
+            Seconds to wait for requests from other pipelines
+            to batch with this one. None or 0 runs the request right away.
+
+        :Returns:
+        -------
+        concurrent.futures.Future
+            Resolves to a dict of output tensor data keyed by tensor index.
+
+        """
+        assert inputs
+        future = Future()
+        self._requests.put((inputs, self._output_indexes, future, batch_window))
+        return future
+
+    def run(self, inputs=None, batch_window=None) -> dict:
+        """Run inference and wait for the output tensors."""
+        return self.submit(inputs=inputs, batch_window=batch_window).result()
+
+
+def _warm_up(tf_interpreter=None, model_tflite=None):
+    start = time.monotonic()
+    try:
+        for input_details in tf_interpreter.get_input_details():
+            tf_interpreter.set_tensor(
+                input_details["index"],
+                np.zeros(input_details["shape"], dtype=input_details["dtype"]),
+            )
+        tf_interpreter.invoke()
+    except Exception as e:
+        log.warning("Failed to warm up AI model %r: %r", model_tflite, e)
+        return
+    log.info(
+        "Warmed up AI model %r in %.3f seconds",
+        model_tflite,
+        time.monotonic() - start,
+    )
+
+
+def _model_signature(*paths):
+    """Size and modification time of model files, to detect changes."""
+    signature = []
+    for path in paths:
+        if path:
+            stat = os.stat(path)
+            signature.append((stat.st_size, stat.st_mtime_ns))
+        else:
+            signature.append(None)
+    return tuple(signature)
+
+
+# interpreters shared by all pipelines, keyed by model files.
+# Values are (model files signature, SharedInterpreter).
+_shared_interpreters = {}
+_shared_interpreters_lock = threading.Lock()
+
+
+def get_shared_interpreter(model_tflite=None, model_edgetpu=None):
+    """Return the SharedInterpreter for a model, loading it on first use.
+
+    Pipelines that refer to the same ai_models entry resolve to the
+    same model files and therefore share one interpreter.
+    Loaded interpreters are kept in a process wide registry keyed by
+    model files, including the EdgeTPU model for the EdgeTPU delegate,
+    so that they survive pipeline restarts on config changes.
+    A model is loaded again only if its files changed on disk.
+    See release_unused_interpreters() for unloading.
+    """
+    key = (
+        os.path.realpath(model_tflite),
+        os.path.realpath(model_edgetpu) if model_edgetpu else None,
+    )
+    signature = _model_signature(model_tflite, model_edgetpu)
+    with _shared_interpreters_lock:
+        loaded = _shared_interpreters.get(key, None)
+        if loaded is not None and loaded[0] == signature:
+            log.info("Reusing loaded AI model %r", model_tflite)
+            return loaded[1]
+        if loaded is not None:
+            # engines still using the old model keep their interpreter
+            log.info("AI model %r changed on disk. Reloading.", model_tflite)
+        shared = SharedInterpreter(
+            model_tflite=model_tflite, model_edgetpu=model_edgetpu
+        )
+        _shared_interpreters[key] = (signature, shared)
+        return shared
+
+
+def release_unused_interpreters() -> int:
+    """Unload shared interpreters that no engine uses anymore.
+
+    Called after pipelines are (re)loaded, so that models removed
+    from the configuration do not stay in memory.
+
+    :Returns:
+    -------
+    int
+        Number of unloaded interpreters.
+
+    """
+    # engines of stopped pipelines may be held in reference cycles
+    gc.collect()
+    with _shared_interpreters_lock:
+        unused = [
+            key
+            for key, (_, shared) in _shared_interpreters.items()
+            if not shared.in_use
+        ]
+        for key in unused:
+            log.info("Unloading unused AI model %r", key[0])
+            del _shared_interpreters[key]
+    return len(unused)
+
+
 class TFInferenceEngine:
     """Thin wrapper around TFLite Interpreter.
 
@@ -34,10 +383,22 @@ class TFInferenceEngine:
 
     It dynamically detects if EdgeTPU is available and uses it.
     Otherwise falls back to TFLite Runtime.
+
+    Engines for the same model share one interpreter via SharedInterpreter.
+    Input tensors set on an engine are kept with the engine and only sent
+    to the shared interpreter together with the inference request,
+    so that concurrent pipelines do not overwrite each other's tensors.
     """
 
     def __init__(
-        self, model=None, labels=None, confidence_threshold=0.8, top_k=10, **kwargs
+        self,
+        model=None,
+        labels=None,
+        confidence_threshold=0.8,
+        top_k=10,
+        shared=True,
+        batch_window_ms=0,
+        **kwargs,
     ):
         """Create an instance of Tensorflow inference engine.
 
@@ -56,6 +417,13 @@ class TFInferenceEngine:
             Inference confidence threshold.
         top_k : type
             Inference top-k threshold.
+        shared : bool
+            Share the model interpreter with other engines
+            that use the same model. Defaults to True.
+        batch_window_ms : float
+            Milliseconds to wait for frames from other pipelines
+            sharing the model so that they are inferred as one batch.
+            Defaults to 0, which disables batching.
 
         """
         assert model
@@ -78,6 +446,8 @@ class TFInferenceEngine:
         self._model_labels_path = labels
         self._confidence_threshold = confidence_threshold
         self._top_k = top_k
+        assert batch_window_ms >= 0
+        self._batch_window = batch_window_ms / 1000
         log.info(
             "Loading AI model:\n"
             "TFLite graph: %r\n"
@@ -91,22 +461,21 @@ class TFInferenceEngine:
             confidence_threshold * 100,
             top_k,
         )
-        # EdgeTPU is not available in testing and other environments
-        # load dynamically as needed
-        #        edgetpu_class = 'DetectionEngine'
-        #        module_object = import_module('edgetpu.detection.engine',
-        #                                      packaage=edgetpu_class)
-        #        target_class = getattr(module_object, edgetpu_class)
-        self._tf_interpreter = _get_edgetpu_interpreter(model=model_edgetpu)
-        if not self._tf_interpreter:
-            log.debug("EdgeTPU not available. Will use TFLite CPU runtime.")
-            self._tf_interpreter = Interpreter(model_path=model_tflite)
-        assert self._tf_interpreter
-        self._tf_interpreter.allocate_tensors()
+        if shared:
+            self._tf_interpreter = get_shared_interpreter(
+                model_tflite=model_tflite, model_edgetpu=model_edgetpu
+            )
+        else:
+            self._tf_interpreter = SharedInterpreter(
+                model_tflite=model_tflite, model_edgetpu=model_edgetpu
+            )
+        self._tf_interpreter.add_engine(self)
         # check the type of the input tensor
-        self._tf_input_details = self._tf_interpreter.get_input_details()
-        self._tf_output_details = self._tf_interpreter.get_output_details()
+        self._tf_input_details = self._tf_interpreter.input_details
+        self._tf_output_details = self._tf_interpreter.output_details
         self._tf_is_quantized_model = self.input_details[0]["dtype"] != np.float32
+        self._inputs = {}
+        self._outputs = {}
 
     @property
     def input_details(self):
@@ -164,14 +533,45 @@ class TFInferenceEngine:
 
     def infer(self):
         """Invoke model inference on current input tensor."""
-        return self._tf_interpreter.invoke()
+        self._outputs = self._tf_interpreter.run(
+            inputs=dict(self._inputs), batch_window=self._batch_window
+        )
+
+    def infer_batch(self, inputs_list=None):
+        """Invoke model inference on several sets of input tensors.
+
+        The requests are queued together, so that the shared interpreter
+        runs them as one batch if the model supports it.
+        Does not change the engine current input and output tensors.
+
+        :Parameters:
+        ----------
+        inputs_list : list
+            A dict of input tensor data keyed by tensor index
+            for each inference.
+
+        :Returns:
+        -------
+        list
+            A dict of output tensor data keyed by tensor index
+            for each inference.
+
+        """
+        assert inputs_list
+        futures = [
+            self._tf_interpreter.submit(
+                inputs=inputs, batch_window=max(self._batch_window, BATCH_SUBMIT_WINDOW)
+            )
+            for inputs in inputs_list
+        ]
+        return [future.result() for future in futures]
 
     def set_tensor(self, index=None, tensor_data=None):
         """Set tensor data at given reference index."""
         assert isinstance(index, int)
-        self._tf_interpreter.set_tensor(index, tensor_data)
+        self._inputs[index] = tensor_data
 
     def get_tensor(self, index=None):
         """Return tensor data at given reference index."""
         assert isinstance(index, int)
-        return self._tf_interpreter.get_tensor(index)
+        return self._outputs[index]
@@ -20,7 +20,7 @@ class ObjectDetector(TFBoundingBoxDetection):
         else:
             try:
                 image = sample["image"]
-                thumbnail, tensor_image, inference_result = self.detect(image=image)
+                thumbnail, inference_result = self.detect(image=image)
 
                 inference_result = self.convert_inference_result(inference_result)
                 log.debug("Object detection inference_result: %r", inference_result)
@@ -34,6 +34,9 @@ class ObjectDetector(TFBoundingBoxDetection):
                     "inference_result": inference_result,
                     "inference_meta": inf_meta,
                 }
+                image_jpeg = sample.get("image_jpeg", None)
+                if image_jpeg is not None:
+                    processed_sample["image_jpeg"] = image_jpeg
                 yield processed_sample
             except Exception as e:
                 log.error(
@@ -5,7 +5,7 @@ from pathlib import Path
 import numpy as np
 from ambianic.configuration import DEFAULT_DATA_DIR
 from ambianic.pipeline.ai.tf_detect import TFDetectionModel
-from PIL import ImageDraw
+from PIL import Image, ImageDraw
 
 log = logging.getLogger(__name__)
 
@@ -30,7 +30,22 @@ KEYPOINTS = (
 )
 
 
+# rotations of the input tensor image, same as the PIL.Image constants
+ROTATE_0 = 0
+ROTATE_90 = Image.ROTATE_90
+ROTATE_270 = Image.ROTATE_270
+# number of counter clockwise turns for numpy.rot90
+_ROT90_TURNS = {ROTATE_0: 0, ROTATE_90: 1, ROTATE_270: 3}
+
+
 class Keypoint:
+    """A single pose keypoint.
+
+    yx holds the [x, y] image coordinates of the keypoint.
+    For keypoints of a Pose, yx is a view into the pose coordinates array,
+    so updating it in place updates the pose.
+    """
+
     __slots__ = ["k", "yx", "score"]
 
     def __init__(self, k, yx, score=None):
@@ -43,12 +58,39 @@ class Keypoint:
 
 
 class Pose:
-    __slots__ = ["keypoints", "score"]
-
-    def __init__(self, keypoints, score=None):
-        assert len(keypoints) == len(KEYPOINTS)
-        self.keypoints = keypoints
+    """A pose backed by arrays of keypoint coordinates and scores.
+
+    :Parameters:
+    ----------
+    keypoint_coords : numpy.ndarray
+        Array of shape (len(KEYPOINTS), 2) with the [x, y] image coordinates
+        of each keypoint in KEYPOINTS order.
+    keypoint_scores : numpy.ndarray
+        Array of shape (len(KEYPOINTS),) with the score of each keypoint.
+    score : float
+        Overall pose score.
+
+    """
+
+    __slots__ = ["keypoint_coords", "keypoint_scores", "score", "_keypoints"]
+
+    def __init__(self, keypoint_coords, keypoint_scores, score=None):
+        assert len(keypoint_coords) == len(KEYPOINTS)
+        assert len(keypoint_scores) == len(KEYPOINTS)
+        self.keypoint_coords = keypoint_coords
+        self.keypoint_scores = keypoint_scores
         self.score = score
+        self._keypoints = None
+
+    @property
+    def keypoints(self):
+        """Keypoints by name, created on first access."""
+        if self._keypoints is None:
+            self._keypoints = {
+                name: Keypoint(name, self.keypoint_coords[i], self.keypoint_scores[i])
+                for i, name in enumerate(KEYPOINTS)
+            }
+        return self._keypoints
 
     def __repr__(self):
         return f"Pose({self.keypoints}, {self.score})"
@@ -98,57 +140,54 @@ class PoseEngine:
         return self._tfengine.input_details[0]["shape"]
 
     def parse_output(self, heatmap_data, offset_data, threshold):
-        joint_num = heatmap_data.shape[-1]
-        pose_kps = np.zeros((joint_num, 4), np.float32)
+        """Decode keypoints from the model output tensors.
 
-        for i in range(heatmap_data.shape[-1]):
+        All joints are decoded at once: one argmax over the flattened
+        heatmaps locates the most likely position of each joint and
+        the offsets at these positions refine the coordinates.
 
-            joint_heatmap = heatmap_data[..., i]
-            max_val_pos = np.squeeze(
-                np.argwhere(joint_heatmap == np.max(joint_heatmap))
-            )
-            remap_pos = np.array(
-                max_val_pos / 8 * self._tensor_image_height, dtype=np.int32
-            )
-            pose_kps[i, 0] = int(
-                remap_pos[0] + offset_data[max_val_pos[0], max_val_pos[1], i]
-            )
-            pose_kps[i, 1] = int(
-                remap_pos[1]
-                + offset_data[max_val_pos[0], max_val_pos[1], i + joint_num]
-            )
-            max_prob = np.max(joint_heatmap)
-            pose_kps[i, 3] = max_prob
-            if max_prob > threshold:
-                if (
-                    pose_kps[i, 0] < self._tensor_image_height
-                    and pose_kps[i, 1] < self._tensor_image_width
-                ):
-                    pose_kps[i, 2] = 1
+        :Returns:
+        -------
+        numpy.ndarray
+            Array of shape (joint_num, 4) with one row per joint:
+            y, x, 1 if the joint is within the image and scores
+            above threshold (0 otherwise), heatmap score.
+        """
+        heatmap_height, heatmap_width, joint_num = heatmap_data.shape
+        joints = np.arange(joint_num)
+        # argmax returns the first maximum position in row-major order
+        max_val_idx = np.argmax(heatmap_data.reshape(-1, joint_num), axis=0)
+        max_val_y, max_val_x = np.divmod(max_val_idx, heatmap_width)
+        max_prob = heatmap_data[max_val_y, max_val_x, joints]
+        remap_y = (max_val_y / 8 * self._tensor_image_height).astype(np.int32)
+        remap_x = (max_val_x / 8 * self._tensor_image_height).astype(np.int32)
 
+        pose_kps = np.zeros((joint_num, 4), np.float32)
+        pose_kps[:, 0] = np.trunc(remap_y + offset_data[max_val_y, max_val_x, joints])
+        pose_kps[:, 1] = np.trunc(
+            remap_x + offset_data[max_val_y, max_val_x, joints + joint_num]
+        )
+        pose_kps[:, 2] = (
+            (max_prob > threshold)
+            & (pose_kps[:, 0] < self._tensor_image_height)
+            & (pose_kps[:, 1] < self._tensor_image_width)
+        )
+        pose_kps[:, 3] = max_prob
         return pose_kps
 
     def sigmoid(self, x):
         return 1 / (1 + np.exp(-x))
 
-    def tf_interpreter(self):
-        return self._tfengine._tf_interpreter
+    def resize_to_input_tensor(self, img):
+        """Resize and pad an image to the input tensor size.
 
-    def detect_poses(self, img):
-        """
-        Detects poses in a given image.
-        :Parameters:
-        ----------
-        img : PIL.Image
-            Input Image for AI model detection.
         :Returns:
         -------
-        poses:
-            A list of Pose objects with keypoints and confidence scores
         PIL.Image
-            Resized image fitting the AI model input tensor.
+            Proportionately resized image.
+        PIL.Image
+            The resized image padded to the exact input tensor size.
         """
-
         _tensor_input_size = (self._tensor_image_width, self._tensor_image_height)
 
         # thumbnail is a proportionately resized image
@@ -161,56 +200,59 @@ class PoseEngine:
         template_image = TFDetectionModel.resize(
             image=thumbnail, desired_size=_tensor_input_size
         )
+        return thumbnail, template_image
 
-        template_input = np.expand_dims(template_image.copy(), axis=0)
+    def _input_tensor(self, template_array):
+        template_input = np.expand_dims(template_array, axis=0)
         floating_model = self._tfengine.input_details[0]["dtype"] == np.float32
 
         if floating_model:
             template_input = (np.float32(template_input) - 127.5) / 127.5
+        return template_input
+
+    def _keypoints_from_outputs(self, template_output_data, template_offset_data):
+        template_heatmaps = np.squeeze(template_output_data)
+        template_offsets = np.squeeze(template_offset_data)
 
-        self.tf_interpreter().set_tensor(
+        return self.parse_output(template_heatmaps, template_offsets, 0.3)
+
+    def _infer_keypoints(self, template_input):
+        self._tfengine.set_tensor(
             self._tfengine.input_details[0]["index"], template_input
         )
-        self.tf_interpreter().invoke()
+        self._tfengine.infer()
 
-        template_output_data = self.tf_interpreter().get_tensor(
+        template_output_data = self._tfengine.get_tensor(
             self._tfengine.output_details[0]["index"]
         )
-        template_offset_data = self.tf_interpreter().get_tensor(
+        template_offset_data = self._tfengine.get_tensor(
             self._tfengine.output_details[1]["index"]
         )
+        return self._keypoints_from_outputs(template_output_data, template_offset_data)
 
-        template_heatmaps = np.squeeze(template_output_data)
-        template_offsets = np.squeeze(template_offset_data)
-
-        kps = self.parse_output(template_heatmaps, template_offsets, 0.3)
-
+    def _poses_from_keypoints(self, kps, template_image, keypoint_coords=None):
         poses = []
 
-        keypoint_dict = {}
-        cnt = 0
-
+        if keypoint_coords is None:
+            # keypoint coordinates in x, y order
+            keypoint_coords = kps[:, 1::-1].copy()
+        keypoint_scores = self.sigmoid(kps[:, 3])
         keypoint_count = kps.shape[0]
-        for point_i in range(keypoint_count):
-            x, y = kps[point_i, 1], kps[point_i, 0]
-            prob = self.sigmoid(kps[point_i, 3])
-
-            if prob > self.confidence_threshold:
-                cnt += 1
-                if log.getEffectiveLevel() <= logging.DEBUG:
-                    # development mode
-                    # draw on image and save it for debugging
-                    draw = ImageDraw.Draw(template_image)
-                    draw.line(((0, 0), (x, y)), fill="blue")
+        detected = keypoint_scores > self.confidence_threshold
+        cnt = int(np.count_nonzero(detected))
 
-            keypoint = Keypoint(KEYPOINTS[point_i], [x, y], prob)
-            keypoint_dict[KEYPOINTS[point_i]] = keypoint
+        if cnt > 0 and log.getEffectiveLevel() <= logging.DEBUG:
+            # development mode
+            # draw on image and save it for debugging
+            draw = ImageDraw.Draw(template_image)
+            for x, y in kps[detected, 1::-1]:
+                draw.line(((0, 0), (x, y)), fill="blue")
 
         # overall pose score is calculated as the average of all
         # individual keypoint scores
         pose_score = cnt / keypoint_count
         log.debug(f"Overall pose score (keypoint score average): {pose_score}")
-        poses.append(Pose(keypoint_dict, pose_score))
+        poses.append(Pose(keypoint_coords, keypoint_scores, pose_score))
         if cnt > 0 and log.getEffectiveLevel() <= logging.DEBUG:
             # development mode
             # save template_image for debugging
@@ -227,4 +269,103 @@ class PoseEngine:
                 Path(self._sys_data_dir, debug_image_file_name), format="JPEG"
             )
             log.debug(f"Debug image saved: {debug_image_file_name}")
+        return poses, pose_score
+
+    def detect_poses(self, img):
+        """
+        Detects poses in a given image.
+        :Parameters:
+        ----------
+        img : PIL.Image
+            Input Image for AI model detection.
+        :Returns:
+        -------
+        poses:
+            A list of Pose objects with keypoints and confidence scores
+        PIL.Image
+            Resized image fitting the AI model input tensor.
+        """
+        thumbnail, template_image = self.resize_to_input_tensor(img)
+        template_input = self._input_tensor(np.asarray(template_image))
+        kps = self._infer_keypoints(template_input)
+        poses, pose_score = self._poses_from_keypoints(kps, template_image)
         return poses, thumbnail, pose_score
+
+    def _unrotate_coords(self, kps, rotation):
+        """Map [x, y] keypoint coordinates back to the upright tensor image."""
+        # index of the last pixel row and column
+        last = self._tensor_image_width - 1
+        x_r, y_r = kps[:, 1], kps[:, 0]
+        if rotation == ROTATE_90:
+            # rotated 90' counter clockwise
+            return np.stack([last - y_r, x_r], axis=1)
+        if rotation == ROTATE_270:
+            # rotated 90' clockwise
+            return np.stack([y_r, last - x_r], axis=1)
+        return np.stack([x_r, y_r], axis=1)
+
+    def detect_rotated_poses(self, template_image, rotations=None, batch=False):
+        """Detect poses in 90 degree rotations of an input tensor image.
+
+        The rotated inputs are derived from the already resized and padded
+        image with numpy, instead of rotating, resizing and padding
+        the original image again for each rotation.
+        Requires a square input tensor.
+
+        :Parameters:
+        ----------
+        template_image : PIL.Image
+            Image with the exact input tensor size,
+            as returned by resize_to_input_tensor().
+        rotations : list
+            Rotations to detect poses in. Each one of
+            ROTATE_0, ROTATE_90 (counter clockwise) or ROTATE_270 (clockwise).
+        batch : bool
+            Submit all rotations to the inference engine at once, so that
+            they run as one batch if the AI model supports it.
+
+        :Returns:
+        -------
+        list
+            (poses, pose_score) for each rotation. Keypoint coordinates
+            are mapped back to the upright image.
+        """
+        assert self._tensor_image_width == self._tensor_image_height
+        if rotations is None:
+            rotations = [ROTATE_0]
+        template_array = np.asarray(template_image)
+        rotated_arrays = [
+            np.ascontiguousarray(np.rot90(template_array, k=_ROT90_TURNS[rotation]))
+            for rotation in rotations
+        ]
+        template_inputs = [self._input_tensor(arr) for arr in rotated_arrays]
+        if batch and len(rotations) > 1:
+            input_index = self._tfengine.input_details[0]["index"]
+            outputs = self._tfengine.infer_batch(
+                [{input_index: template_input} for template_input in template_inputs]
+            )
+            heatmap_index = self._tfengine.output_details[0]["index"]
+            offset_index = self._tfengine.output_details[1]["index"]
+            all_kps = [
+                self._keypoints_from_outputs(out[heatmap_index], out[offset_index])
+                for out in outputs
+            ]
+        else:
+            all_kps = [
+                self._infer_keypoints(template_input)
+                for template_input in template_inputs
+            ]
+        results = []
+        for rotation, rotated_array, kps in zip(rotations, rotated_arrays, all_kps):
+            if rotation == ROTATE_0:
+                debug_image = template_image
+            else:
+                debug_image = Image.fromarray(rotated_array)
+            results.append(
+                self._poses_from_keypoints(
+                    kps,
+                    debug_image,
+                    keypoint_coords=self._unrotate_coords(kps, rotation),
+                )
+            )
+        return results
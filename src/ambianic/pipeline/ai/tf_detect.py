@@ -1,5 +1,6 @@
 """Tensorflow image detection wrapper."""
 import logging
+import math
 import re
 import time
 
@@ -7,13 +8,50 @@ import numpy as np
 from ambianic.pipeline import PipeElement
 
 # from importlib import import_module
-from PIL import ImageOps
+from PIL import Image, ImageOps
 
 from .inference import TFInferenceEngine
 
 log = logging.getLogger(__name__)
 
 
+def thumbnail_size(size=None, desired_size=None):
+    """Return the size PIL.Image.thumbnail() would resize an image to.
+
+    Preserves the aspect ratio of size and never enlarges.
+    """
+    width, height = size
+    x, y = desired_size
+    if x >= width and y >= height:
+        return width, height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def fit_image(image=None, desired_size=None):
+    """Like TFDetectionModel.thumbnail() but without copying small images.
+
+    :Returns:
+    -------
+    PIL.Image
+        A resized image or the input image itself
+        if it already fits desired_size.
+    """
+    size = thumbnail_size(image.size, (int(desired_size[0]), int(desired_size[1])))
+    if size == image.size:
+        return image
+    # same resampling as PIL.Image.thumbnail()
+    return image.resize(size, Image.BICUBIC, reducing_gap=2.0)
+
+
 class TFDetectionModel(PipeElement):
     """Applies Tensorflow image detection."""
 
@@ -24,6 +62,7 @@ class TFDetectionModel(PipeElement):
         label_filter=None,
         confidence_threshold=0.6,
         top_k=3,
+        batch_window_ms=0,
         **kwargs,
     ):
         """Initialize detector with config parameters.
@@ -33,6 +72,10 @@ class TFDetectionModel(PipeElement):
         labels: ai_models/coco_labels.txt
         confidence_threshold: 0.6
         top_k: 3
+        batch_window_ms: 10
+            Optional. Wait up to this many milliseconds for frames
+            from other pipelines using the same model and run inference
+            on all of them as one batch. Defaults to 0 (no batching).
         """
 
         # log.warning('TFImageDetection __init__ invoked')
@@ -43,10 +86,68 @@ class TFDetectionModel(PipeElement):
             labels=labels,
             confidence_threshold=confidence_threshold,
             top_k=top_k,
+            batch_window_ms=batch_window_ms,
         )
         self._labels = self.load_labels(self._tfengine.labels_path)
         self._label_filter = label_filter
         self.last_time = time.monotonic()
+        # reused input tensors, each with the size of the image it holds
+        self._input_buffers = []
+
+    @property
+    def input_tensor_size(self):
+        """Image size (width, height) expected by the AI model input tensor."""
+        shape = self._tfengine.input_details[0]["shape"]
+        return int(shape[2]), int(shape[1])
+
+    def prepare_input_tensor(self, image=None, buffer_index=0):
+        """Resize image into a reused input tensor.
+
+        Writes the resized image straight into a preallocated array
+        matching the model input, padded with black pixels like
+        resize_to_input_tensor(). Avoids the intermediate image copies
+        of thumbnail() and resize().
+        The returned array is overwritten by the next call with the same
+        buffer_index, so it must be consumed (for example passed to
+        TFInferenceEngine.set_tensor() and inferred) before that.
+
+        :Parameters:
+        ----------
+        image : PIL.Image
+            Input image.
+        buffer_index : int
+            Use a separate buffer for each input of a batch.
+
+        :Returns:
+        -------
+        (numpy.ndarray, PIL.Image)
+            Input tensor data and the resized image without padding.
+        """
+        assert image
+        desired_size = self.input_tensor_size
+        thumbnail = fit_image(image=image, desired_size=desired_size)
+        if thumbnail.mode != "RGB":
+            thumbnail = thumbnail.convert("RGB")
+        while len(self._input_buffers) <= buffer_index:
+            details = self._tfengine.input_details[0]
+            buffer = np.zeros(details["shape"], dtype=details["dtype"])
+            self._input_buffers.append([buffer, None])
+        entry = self._input_buffers[buffer_index]
+        buffer, buffer_image_size = entry
+        quantized = self._tfengine.is_quantized
+        if buffer_image_size != thumbnail.size:
+            # clear the padding left over from an image of a different size
+            # black is -1 after normalizing floating point values
+            buffer.fill(0 if quantized else -1)
+            entry[1] = thumbnail.size
+        width, height = thumbnail.size
+        region = buffer[0, :height, :width]
+        region[...] = thumbnail
+        if not quantized:  # pragma: no cover
+            # normalize floating point values in place
+            region -= 127.5
+            region /= 127.5
+        return buffer, thumbnail
 
     def load_labels(self, label_path=None):
         """Load label mapping from integer code to text.
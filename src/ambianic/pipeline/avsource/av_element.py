@@ -7,10 +7,12 @@ import threading
 import time
 from io import BytesIO
 
-import requests
 from ambianic.pipeline import PipeElement
-from ambianic.pipeline.avsource import gst_process
+from ambianic.pipeline.avsource.mailbox import FrameMailbox
 from ambianic.pipeline.avsource.picam import Picamera
+from ambianic.pipeline.avsource.sampler import LatencySampler
+from ambianic.pipeline.avsource.shm_queue import SharedMemoryFrameQueue
+from ambianic.pipeline.metrics import Histogram
 from ambianic.util import stacktrace
 from PIL import Image
 
@@ -19,6 +21,35 @@ log = logging.getLogger(__name__)
 
 MIN_HEALING_INTERVAL = 5
 
+# Transports for raw image samples from the gstreamer process
+SAMPLE_TRANSPORT_MAILBOX = "mailbox"
+SAMPLE_TRANSPORT_QUEUE = "queue"
+SAMPLE_TRANSPORT_SHARED_MEMORY = "shared_memory"
+SAMPLE_TRANSPORTS = [
+    SAMPLE_TRANSPORT_MAILBOX,
+    SAMPLE_TRANSPORT_QUEUE,
+    SAMPLE_TRANSPORT_SHARED_MEMORY,
+]
+
+# element gauges reported while the latency sampler is on
+SAMPLER_GAUGES = (
+    "source_frame_rate",
+    "source_target_frame_rate",
+    "source_latency_budget_seconds",
+    "source_frame_latency_seconds",
+)
+
+
+def _start_gst_service(**kwargs):
+    """Run the gst service in the gst child process.
+
+    GStreamer is imported and initialized in the child process only,
+    so that the pipeline server does not pay for it at startup.
+    """
+    from ambianic.pipeline.avsource import gst_process
+
+    gst_process.start_gst_service(**kwargs)
+
 
 class AVSourceElement(PipeElement):
     """
@@ -28,7 +59,16 @@ class AVSourceElement(PipeElement):
     image samples to the next pipe element.
     """
 
-    def __init__(self, uri=None, type=None, live=False, **kwargs):
+    def __init__(
+        self,
+        uri=None,
+        type=None,
+        live=False,
+        transport=SAMPLE_TRANSPORT_MAILBOX,
+        scale_to_model=False,
+        latency_budget=None,
+        **kwargs,
+    ):
         """Create an av source element with given configuration.
 
         :Parameters:
@@ -44,10 +84,59 @@ class AVSourceElement(PipeElement):
                 keep trying to reconnect
                 in case there is disruption of the source stream
                 until explicit stop() is requested of the element.
+            transport: string (mailbox, queue or shared_memory)
+                How raw image samples travel from the gstreamer process.
+                mailbox (default) writes each frame into shared memory
+                and keeps only the latest one, a new frame replaces
+                the one waiting to be processed, so the pipeline always
+                gets the freshest frame.
+                queue pickles each frame through a multiprocessing queue.
+                shared_memory writes each frame once into a shared memory
+                ring buffer, which saves CPU for high resolution streams.
+                Both keep the oldest waiting frames and skip new ones
+                while the pipeline is busy.
+            fps: number (optional max frame rate of the samples)
+                Frames above this rate are dropped in the gstreamer
+                process before they are converted and passed on.
+            width: int (optional width of the samples in pixels)
+            height: int (optional height of the samples in pixels)
+                Frames are scaled in the gstreamer process.
+                If only one of width or height is set, the other one
+                follows the aspect ratio of the source.
+            scale_to_model: boolean (False by default)
+                When True and no explicit width or height is set, frames
+                are scaled down in the gstreamer process to fit the
+                largest input tensor of the AI models in the pipeline.
+                The aspect ratio of the source is preserved.
+            jpeg_passthrough: boolean (False by default)
+                For MJPEG cameras (/dev/video* with format: jpeg), pass on
+                the camera encoded JPEG frame with each sample as image_jpeg,
+                so that detection events save it without encoding
+                the image again, at the full camera resolution.
+            hardware_decode: boolean (True by default)
+                Decode compressed video with a hardware decoder
+                (v4l2, vaapi, omx, nvcodec) when one is available and
+                fall back to software decoding otherwise. The decoder
+                in use is reported in the ambianic_source_decoder_info
+                metric.
+            latency_budget: number (optional, in seconds)
+                Turns on the latency sampler. The time the pipeline
+                takes per frame is measured and the gstreamer process
+                is asked to deliver frames at the rate the pipeline
+                keeps up with, up to fps, lowered further while frames
+                take longer than latency_budget from delivery to the
+                end of their processing. Only the freshest waiting
+                frame is processed. The processing time is only known
+                while all elements process samples in the source thread,
+                the sampler is turned off if a downstream element runs
+                in its own worker thread.
         """
         super().__init__(**kwargs)
 
         assert uri
+        assert (
+            transport in SAMPLE_TRANSPORTS
+        ), f"Unknown sample transport {transport}. Expected one of {SAMPLE_TRANSPORTS}"
 
         element_conf = dict(kwargs)
         element_conf["uri"] = uri
@@ -57,16 +146,74 @@ class AVSourceElement(PipeElement):
         # pipeline source info
         self._source_conf = element_conf
         self._is_live = live
+        self._transport = transport
+        self._scale_to_model = scale_to_model
         self._gst_process = None
         self._gst_out_queue = None
         self._gst_process_stop_signal = None
         self._gst_process_eos_reached = None
+        # samples dropped by the current and by previous gst processes
+        self._gst_dropped_samples = 0
+        self._dropped_samples_before_restart = 0
+        # video decoder reported by the gst process
+        self._decoder = None
+        self._hardware_decode = False
+        # frame rate adapted to the pipeline latency
+        self._sampler = None
+        self._max_rate = None
+        self._skipped_samples = 0
+        # time from capture to the end of processing of live frames
+        self._capture_latency = Histogram()
+        self._metrics.histograms[
+            "source_capture_latency_seconds"
+        ] = self._capture_latency
+        if latency_budget:
+            self._sampler = LatencySampler(
+                target_fps=kwargs.get("fps", None), latency_budget=latency_budget
+            )
+            # shared with the gst process
+            self._max_rate = multiprocessing.Value("d", self._sampler.rate)
+            self._metrics.gauges.update(
+                source_frame_rate=self._sampler.rate,
+                source_target_frame_rate=self._sampler.target_fps or 0,
+                source_latency_budget_seconds=latency_budget,
+                source_frame_latency_seconds=0.0,
+            )
         # protects access to gstreamer resources in rare cases
         # such as supervised healing requests
         self._healing_in_progress = threading.RLock()
         # ensure healing requests are reasonably spaced out
         self._latest_healing = time.monotonic()
 
+    @property
+    def scale_to_model(self):
+        """True if samples should be scaled to fit the AI model input size."""
+        return self._scale_to_model
+
+    def set_max_frame_size(self, width=None, height=None):
+        """Limit the size of the samples to fit in width x height.
+
+        Takes effect the next time the gstreamer process starts.
+        """
+        assert width and height
+        log.info("Source samples will be scaled to fit %dx%d", width, height)
+        self._source_conf["max_width"] = int(width)
+        self._source_conf["max_height"] = int(height)
+
+    def _set_decoder(self, decoder=None, hardware_decode=False):
+        """Report the video decoder of the gst process in the metrics."""
+        if (decoder, hardware_decode) == (self._decoder, self._hardware_decode):
+            return
+        self._decoder = decoder
+        self._hardware_decode = hardware_decode
+        if decoder is None:
+            self._metrics.info.pop("source_decoder", None)
+        else:
+            self._metrics.info["source_decoder"] = {
+                "decoder": decoder,
+                "hardware_decode": str(bool(hardware_decode)).lower(),
+            }
+
     def _on_new_sample(self, sample=None):
         log.debug("Input stream received new gst sample.")
         assert sample
@@ -78,21 +225,98 @@ class AVSourceElement(PipeElement):
         assert sample_format == "RGB"
         width = sample["width"]
         height = sample["height"]
-        sample_bytes = sample["bytes"]
-        img = Image.frombytes(sample_format, (width, height), sample_bytes, "raw")
+        self._gst_dropped_samples = sample.get("dropped", 0)
+        self._set_decoder(
+            decoder=sample.get("decoder", None),
+            hardware_decode=sample.get("hardware_decode", False),
+        )
+        frame = sample.get("frame", None)
+        if frame is not None:
+            # read the frame in place from shared memory
+            try:
+                img = Image.fromarray(frame)
+            finally:
+                frame = None
+                self._release_sample(sample)
+        else:
+            sample_bytes = sample["bytes"]
+            img = Image.frombytes(sample_format, (width, height), sample_bytes, "raw")
         # pass image sample to next pipe element, e.g. ai inference
         log.debug("Input stream sending sample to next element.")
-        self.receive_next_sample(image=img)
+        image_jpeg = sample.get("jpeg", None)
+        if image_jpeg is not None:
+            # the camera encoded frame, saved as is with detection events
+            self.receive_next_sample(image=img, image_jpeg=image_jpeg)
+        else:
+            self.receive_next_sample(image=img)
+
+    @property
+    def dropped_samples(self) -> int:
+        """Number of source frames skipped because the pipeline was busy."""
+        return (
+            super().dropped_samples
+            + self._dropped_samples_before_restart
+            + self._gst_dropped_samples
+            + self._skipped_samples
+        )
+
+    def _latest_sample(self, sample=None):
+        """Skip to the freshest sample waiting in the gst out queue."""
+        while True:
+            try:
+                newer_sample = self._gst_out_queue.get_nowait()
+            except queue.Empty:
+                return sample
+            self._release_sample(sample)
+            self._skipped_samples += 1
+            sample = newer_sample
+
+    def _on_sample_processed(self, sample=None, start_time=None):
+        """Measure the latency of a processed sample.
+
+        Adapt the source frame rate to it if the latency sampler is on.
+        """
+        now = time.monotonic()
+        capture_time = sample.get("capture_time", None)
+        if capture_time is not None:
+            self._capture_latency.observe(max(now - capture_time, 0))
+        if self._sampler is None:
+            return
+        rate = self._sampler.observe(
+            processing_time=now - start_time,
+            latency=now - sample.get("time", start_time),
+        )
+        self._max_rate.value = rate
+        self._metrics.gauges["source_frame_rate"] = rate
+        self._metrics.gauges["source_frame_latency_seconds"] = self._sampler.latency
 
     def _get_gst_service_starter(self):
-        return gst_process.start_gst_service
+        return _start_gst_service
 
     def _get_sample_queue(self):
+        if self._transport == SAMPLE_TRANSPORT_MAILBOX:
+            return FrameMailbox()
+        if self._transport == SAMPLE_TRANSPORT_SHARED_MEMORY:
+            return SharedMemoryFrameQueue(slots=3)
         q = multiprocessing.Queue(3)
         return q
 
+    def _release_sample(self, sample=None):
+        if isinstance(self._gst_out_queue, (FrameMailbox, SharedMemoryFrameQueue)):
+            self._gst_out_queue.release(sample)
+
+    def _close_sample_queue(self):
+        # shared memory segments outlive the gst process
+        # and need to be released explicitly
+        if isinstance(self._gst_out_queue, (FrameMailbox, SharedMemoryFrameQueue)):
+            self._clear_gst_out_queue()
+            self._gst_out_queue.close()
+
     def fetch_img(self, session=None, url=None) -> Image:
         assert url
+        # only needed for http image sources
+        import requests
+
         r = requests.get(url)
         r.raise_for_status()
         img = Image.open(BytesIO(r.content))
@@ -155,20 +379,27 @@ class AVSourceElement(PipeElement):
 
     def _run_gst_service(self):
         log.debug("Starting Gst service process...")
+        # clean up after a previous gst process that exited on its own
+        self._close_sample_queue()
+        self._dropped_samples_before_restart += self._gst_dropped_samples
+        self._gst_dropped_samples = 0
         self._gst_out_queue = self._get_sample_queue()
         self._gst_process_stop_signal = multiprocessing.Event()
         self._gst_process_eos_reached = multiprocessing.Event()
         gst_service = self._get_gst_service_starter()
+        gst_kwargs = {
+            "source_conf": self._source_conf,
+            "out_queue": self._gst_out_queue,
+            "stop_signal": self._gst_process_stop_signal,
+            "eos_reached": self._gst_process_eos_reached,
+        }
+        if self._max_rate is not None:
+            gst_kwargs["max_rate"] = self._max_rate
         self._gst_process = multiprocessing.Process(
             target=gst_service,
             name="Gstreamer Service Process",
             daemon=True,
-            kwargs={
-                "source_conf": self._source_conf,
-                "out_queue": self._gst_out_queue,
-                "stop_signal": self._gst_process_stop_signal,
-                "eos_reached": self._gst_process_eos_reached,
-            },
+            kwargs=gst_kwargs,
         )
         self._gst_process.daemon = True
         self._gst_process.start()
@@ -178,7 +409,11 @@ class AVSourceElement(PipeElement):
             try:
                 next_sample = self._gst_out_queue.get(timeout=1)
                 # print('next sample received from gst queue, _on_new_sample')
+                if self._sampler is not None:
+                    next_sample = self._latest_sample(next_sample)
+                start_time = time.monotonic()
                 self._on_new_sample(sample=next_sample)
+                self._on_sample_processed(next_sample, start_time)
             except queue.Empty:
                 log.debug("no new sample available yet in gst out queue")
             except Exception as e:
@@ -192,7 +427,8 @@ class AVSourceElement(PipeElement):
         log.debug("Clearing _gst_out_queue.")
         while not self._gst_out_queue.empty():
             try:
-                self._gst_out_queue.get_nowait()
+                sample = self._gst_out_queue.get_nowait()
+                self._release_sample(sample)
             except queue.Empty:
                 log.debug("_gst_out_queue already empty.")
         log.debug("Cleared _gst_out_queue.")
@@ -270,12 +506,39 @@ class AVSourceElement(PipeElement):
                     log.debug("Gst process stopped after terminate signal.")
             else:
                 log.debug("Gst process stopped after stop signal.")
+        self._close_sample_queue()
+
+    def _check_latency_sampler(self):
+        """Turn off the latency sampler if it can not measure the pipeline.
+
+        An element running in its own worker thread returns as soon as
+        a sample is queued, so the time the pipeline takes per frame
+        would look close to zero and the frame rate would never go down.
+        """
+        if self._sampler is None:
+            return
+        element = self._next_element
+        while element is not None:
+            if element._worker is not None:
+                log.warning(
+                    "Latency sampler turned off for source %r, "
+                    "element %r runs in a worker thread.",
+                    self._source_conf["uri"],
+                    element.name or element.__class__.__name__,
+                )
+                self._sampler = None
+                self._max_rate = None
+                for gauge in SAMPLER_GAUGES:
+                    self._metrics.gauges.pop(gauge, None)
+                return
+            element = element._next_element
 
     def start(self):
         """Start processing input from the configured audio or video source."""
         super().start()
         log.info("Starting %s", self.__class__.__name__)
         self._stop_requested = False
+        self._check_latency_sampler()
 
         if self._source_conf["uri"] == "picamera":
             log.debug("Input source is picamera")
@@ -5,9 +5,13 @@ import os
 import signal
 import sys
 import threading
+import time
 import traceback
+from collections import OrderedDict
+from fractions import Fraction
 
 import gi
+from ambianic.pipeline.avsource.mailbox import FrameMailbox
 from ambianic.util import stacktrace
 
 # to prevent flake8 import reordering before setting gi versions
@@ -16,13 +20,57 @@ if "gi" in sys.modules:
     gi.require_version("GstBase", "1.0")
     from gi.repository import GLib, Gst  # ,GObject,  GLib
 
-
-Gst.init(None)
+# Gst.init() is called by GstService in the gst child process.
 # No need to call GObject.threads_init() since version 3.11
 # GObject.threads_init()
 
 log = logging.getLogger(__name__)
 
+# max number of passthrough JPEG frames waiting for their decoded frame
+JPEG_PASSTHROUGH_FRAMES = 4
+
+# video decoder elements in order of preference
+HARDWARE_DECODERS = {
+    "h264": [
+        "v4l2h264dec",
+        "vah264dec",
+        "vaapih264dec",
+        "omxh264dec",
+        "nvh264dec",
+    ],
+    "h265": [
+        "v4l2h265dec",
+        "vah265dec",
+        "vaapih265dec",
+        "omxh265dec",
+        "nvh265dec",
+    ],
+    "jpeg": ["v4l2jpegdec", "vajpegdec", "vaapijpegdec", "omxmjpegdec"],
+}
+SOFTWARE_DECODERS = {
+    "h264": ["avdec_h264", "openh264dec"],
+    "h265": ["avdec_h265"],
+    "jpeg": ["jpegdec", "avdec_mjpeg"],
+}
+
+
+def _decoder_available(name=None) -> bool:
+    """Return True if the decoder element is installed and usable.
+
+    Hardware decoders open their device when they go to the READY state,
+    so a decoder left in the registry without the hardware is not used.
+    """
+    factory = Gst.ElementFactory.find(name)
+    if factory is None:
+        return False
+    element = factory.create(None)
+    if element is None:
+        return False
+    try:
+        return element.set_state(Gst.State.READY) != Gst.StateChangeReturn.FAILURE
+    finally:
+        element.set_state(Gst.State.NULL)
+
 
 class GstService:
     """Streams audio/video samples from various network and local A/V sources.
@@ -38,7 +86,7 @@ class GstService:
         Source configuration. At this time URI schemes are supported such as
         rtsp://host:ip/path_to_stream.
 
-    out_queue : multiprocessing.Queue
+    out_queue : FrameMailbox, multiprocessing.Queue or SharedMemoryFrameQueue
         The queue where this service adds samples in a normalized format
         for its master AVElement to receive and pass on to the next Ambianic
         pipeline element.
@@ -58,14 +106,42 @@ class GstService:
             self.type = source_conf.get("type", "auto")
             self.is_live = source_conf.get("live", False)
             self.format = source_conf.get("format", None)
+            # optional max frame rate of the delivered samples
+            self.fps = source_conf.get("fps", None)
+            # optional exact size of the delivered samples
+            self.width = source_conf.get("width", None)
+            self.height = source_conf.get("height", None)
+            # optional bounding box that the delivered samples
+            # are scaled down to fit in, preserving aspect ratio
+            self.max_width = source_conf.get("max_width", None)
+            self.max_height = source_conf.get("max_height", None)
+            assert self.fps is None or self.fps > 0, "fps must be positive"
+            # pass on the compressed camera frames along with the
+            # decoded samples, supported for MJPEG cameras
+            self.jpeg_passthrough = source_conf.get("jpeg_passthrough", False)
+            # prefer hardware video decoders when available
+            self.hardware_decode = source_conf.get("hardware_decode", True)
+
+    # compressed frames keyed by buffer timestamp, None without passthrough
+    _jpeg_frames = None
+    # video decoder element in use, None for raw sources
+    _decoder = None
+    _hardware_decode = False
 
     def __init__(
-        self, source_conf=None, out_queue=None, stop_signal=None, eos_reached=None
+        self,
+        source_conf=None,
+        out_queue=None,
+        stop_signal=None,
+        eos_reached=None,
+        max_rate=None,
     ):
         assert source_conf
         assert out_queue
         assert stop_signal
         assert eos_reached
+        # idempotent, runs once in the gst child process
+        Gst.init(None)
         # pipeline source info
         log.debug("Initializing GstService with source: %s ", source_conf)
         self._out_queue = out_queue
@@ -92,6 +168,15 @@ class GstService:
         # indicates whether stop was requested via the API
         self._stop_requested = False
         self.gst_bus = None
+        # number of samples skipped because the out queue was full
+        self._dropped_samples = 0
+        self.gst_jpegsink = None
+        self._jpeg_frames_lock = threading.Lock()
+        self._deep_element_added_connect_id = None
+        # optional shared value with the max frame rate requested by
+        # the pipeline, adjusted while running
+        self._max_rate = max_rate
+        self._last_frame_pts = None
 
     def on_autoplug_continue(self, src_bin, src_pad, src_caps):
         # print('on_autoplug_continue called for uridecodebin')
@@ -149,14 +234,61 @@ class GstService:
 
     def _on_new_sample_out_queue_full(self, sink):
         log.debug("Out queue full, skipping sample.")
+        self._dropped_samples += 1
         # free appsink buffer so its not blocked waiting on app pull
         sink.emit("pull-sample")
         return Gst.FlowReturn.OK
 
+    def _on_new_jpeg_sample(self, sink):
+        """Keep the compressed frame until its decoded frame arrives."""
+        sample = sink.emit("pull-sample")
+        buf = sample.get_buffer()
+        result, mapinfo = buf.map(Gst.MapFlags.READ)
+        if result:
+            with self._jpeg_frames_lock:
+                self._jpeg_frames[buf.pts] = bytes(mapinfo.data)
+                while len(self._jpeg_frames) > JPEG_PASSTHROUGH_FRAMES:
+                    self._jpeg_frames.popitem(last=False)
+            buf.unmap(mapinfo)
+        return Gst.FlowReturn.OK
+
+    def _pop_jpeg_frame(self, pts=None):
+        """Return the compressed frame with the given timestamp or None.
+
+        Older frames are discarded, their decoded frames were dropped.
+        """
+        with self._jpeg_frames_lock:
+            jpeg = self._jpeg_frames.pop(pts, None)
+            if jpeg is not None:
+                while self._jpeg_frames:
+                    oldest_pts = next(iter(self._jpeg_frames))
+                    if oldest_pts > pts:
+                        break
+                    del self._jpeg_frames[oldest_pts]
+            return jpeg
+
+    def _capture_time(self, pts=None):
+        """Return the monotonic time when a live frame was captured or None.
+
+        Live sources timestamp buffers with the pipeline running time
+        at capture, so the age of a frame is the pipeline clock time
+        minus the base time and the buffer timestamp.
+        """
+        if self.gst_pipeline is None or not self.source.is_live:
+            return None
+        clock = self.gst_pipeline.get_clock()
+        if clock is None or pts == Gst.CLOCK_TIME_NONE:
+            return None
+        age = clock.get_time() - self.gst_pipeline.get_base_time() - pts
+        return time.monotonic() - age / Gst.SECOND
+
     def _on_new_sample(self, sink):
         log.debug("Input stream received new image sample.")
         if self._out_queue.full():
-            return self._on_new_sample_out_queue_full(sink)
+            if not isinstance(self._out_queue, FrameMailbox):
+                return self._on_new_sample_out_queue_full(sink)
+            # latest wins, the unread sample is replaced by this one
+            self._dropped_samples += 1
         sample = sink.emit("pull-sample")
         buf = sample.get_buffer()
         caps = sample.get_caps()
@@ -174,12 +306,173 @@ class GstService:
                 "width": app_width,
                 "height": app_height,
                 "bytes": mapinfo.data,
+                "dropped": self._dropped_samples,
+                # monotonic clock is shared with the pipeline process
+                "time": time.monotonic(),
+                "pts": buf.pts,
+                "capture_time": self._capture_time(buf.pts),
+                "decoder": self._decoder,
+                "hardware_decode": self._hardware_decode,
             }
+            if self._jpeg_frames is not None:
+                # the jpeg branch does not decode and is usually ahead,
+                # frames that lose the race are saved re-encoded
+                jpeg = self._pop_jpeg_frame(buf.pts)
+                if jpeg is not None:
+                    sample["jpeg"] = jpeg
             log.info("GstService adding sample to out_queue.")
             self._out_queue.put(sample)
         buf.unmap(mapinfo)
         return Gst.FlowReturn.OK
 
+    def _on_frame_rate_probe(self, pad, info):
+        """Drop frames above the rate requested by the pipeline.
+
+        Frames are dropped right after the source, before they are
+        converted and scaled.
+        """
+        rate = self._max_rate.value
+        pts = info.get_buffer().pts
+        if rate <= 0 or pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        last_pts = self._last_frame_pts
+        # timestamps start over when a file source loops or seeks
+        if last_pts is not None and last_pts <= pts < last_pts + Gst.SECOND / rate:
+            self._dropped_samples += 1
+            return Gst.PadProbeReturn.DROP
+        self._last_frame_pts = pts
+        return Gst.PadProbeReturn.OK
+
+    def _get_framerate_caps(self):
+        """Return the framerate caps field for the configured fps or None."""
+        if not self.source.fps:
+            return None
+        rate = Fraction(self.source.fps).limit_denominator(1000)
+        return f"framerate={rate.numerator}/{rate.denominator}"
+
+    def _get_size_caps(self):
+        """Return the size caps fields for the configured frame size or None.
+
+        An exact width or height takes precedence over the max_width and
+        max_height bounding box. If only one of width or height is set,
+        the other one is left for videoscale to choose so that the
+        aspect ratio of the source is preserved.
+        """
+        src = self.source
+        fields = []
+        if src.width or src.height:
+            if src.width:
+                fields.append(f"width={int(src.width)}")
+            if src.height:
+                fields.append(f"height={int(src.height)}")
+        elif src.max_width or src.max_height:
+            if src.max_width:
+                fields.append(f"width=(int)[1,{int(src.max_width)}]")
+            if src.max_height:
+                fields.append(f"height=(int)[1,{int(src.max_height)}]")
+        if not fields:
+            return None
+        # square pixels make videoscale preserve the source aspect ratio
+        fields.append("pixel-aspect-ratio=1/1")
+        return ",".join(fields)
+
+    def _is_jpeg_passthrough(self):
+        """Return True if compressed frames are passed on with the samples."""
+        src = self.source
+        if not src.jpeg_passthrough:
+            return False
+        is_v4l2 = src.uri.startswith("/dev/video") or src.uri.startswith(
+            "file:///dev/video"
+        )
+        if not is_v4l2 or src.format != "jpeg":
+            log.warning(
+                "jpeg_passthrough is only supported for MJPEG cameras "
+                "(/dev/video* with format: jpeg). Ignoring it for %s",
+                src.uri,
+            )
+            return False
+        return True
+
+    def _set_decoder(self, name=None):
+        if name == self._decoder:
+            return
+        self._decoder = name
+        self._hardware_decode = any(name in d for d in HARDWARE_DECODERS.values())
+        log.info(
+            "Decoding %s with %s (%s)",
+            self.source.uri,
+            name,
+            "hardware" if self._hardware_decode else "software",
+        )
+
+    def _select_decoder(self, codec=None):
+        """Return the name of the preferred available decoder for codec.
+
+        Hardware decoders come first unless hardware_decode is off
+        in the source config, software decoders are the fallback.
+        """
+        candidates = SOFTWARE_DECODERS[codec]
+        if self.source.hardware_decode:
+            candidates = HARDWARE_DECODERS[codec] + candidates
+        for name in candidates:
+            if _decoder_available(name):
+                break
+        else:
+            name = SOFTWARE_DECODERS[codec][0]
+            log.warning(
+                "No usable %s decoder found among %s, trying %s",
+                codec,
+                candidates,
+                name,
+            )
+        self._set_decoder(name)
+        return name
+
+    def _rank_decoders(self):
+        """Make uridecodebin pick hardware decoders when available.
+
+        uridecodebin plugs the decoder with the highest rank, hardware
+        decoders are often ranked below software ones or not at all.
+        With hardware_decode off they are taken out of the selection.
+        """
+        for names in HARDWARE_DECODERS.values():
+            for name in names:
+                factory = Gst.ElementFactory.find(name)
+                if factory is None:
+                    continue
+                if not self.source.hardware_decode:
+                    factory.set_rank(Gst.Rank.NONE)
+                elif _decoder_available(name):
+                    factory.set_rank(Gst.Rank.PRIMARY + 1)
+                    # the first usable one wins
+                    break
+
+    def _on_deep_element_added(self, pipeline, sub_bin, element):
+        """Report the video decoder plugged by uridecodebin."""
+        factory = element.get_factory()
+        if factory is None:
+            return
+        klass = factory.get_metadata("klass") or ""
+        if "Decoder" in klass and "Video" in klass:
+            self._set_decoder(factory.get_name())
+
+    def _get_jpeg_tee_args(self, framerate_caps=None):
+        """Return the pipeline branch that passes on the compressed frames.
+
+        Frames are dropped to the target frame rate before the tee,
+        so that both branches see the same buffer timestamps.
+        """
+        args = ""
+        if framerate_caps:
+            args += f"videorate drop-only=true ! image/jpeg,{framerate_caps} ! "
+        args += """tee name=jpegtee
+             jpegtee. ! queue leaky=downstream max-size-buffers=1
+             ! appsink name=jpegsink sync=false
+                emit-signals=true max-buffers=1 drop=true
+             jpegtee. ! """
+        args += self._select_decoder("jpeg")
+        return args
+
     def _get_pipeline_args(self):
         log.debug("Preparing Gstreamer pipeline args")
 
@@ -193,26 +486,48 @@ class GstService:
         else:
             SRC_CAPS = "video/x-raw,framerate=30/1"
 
+        jpeg_passthrough = self._is_jpeg_passthrough()
         PIPELINE_SRC = "uridecodebin uri=%s use-buffering=true" % videosrc
 
         if videosrc.startswith("/dev/video") or videosrc.startswith(
             "file:///dev/video"
         ):
             PIPELINE_SRC = f"v4l2src device={videosrc} ! {SRC_CAPS}"
+            if videofmt == "h264":
+                PIPELINE_SRC += " ! h264parse ! " + self._select_decoder("h264")
+            elif videofmt == "jpeg" and not jpeg_passthrough:
+                PIPELINE_SRC += " ! " + self._select_decoder("jpeg")
+        else:
+            self._rank_decoders()
 
         PIPELINE = """
             {pipeline_src}
-             ! {leaky_q0} ! videoconvert name=vconvert ! {sink_caps}
+             ! {leaky_q0} ! {video_filters}videoconvert name=vconvert ! {sink_caps}
              ! {leaky_q1} ! {sink_element}
              """
 
         # Ask gstreamer to format the images in a way that are close
         # to the TF model tensor.
-        # Note: Having gstreamer resize doesn't appear to make
-        # a big performance difference.
-        # Need to look closer at hardware acceleration options where available.
-        # ,width={width},pixel-aspect-ratio=1/1'
+        # Dropping frames and scaling down before videoconvert
+        # saves the colorspace conversion and the transfer to the
+        # pipeline process of pixels that the AI models would discard anyway.
         SINK_CAPS = "video/x-raw,format=RGB"
+        VIDEO_FILTERS = ""
+
+        framerate_caps = self._get_framerate_caps()
+        if jpeg_passthrough:
+            PIPELINE_SRC += " ! " + self._get_jpeg_tee_args(framerate_caps)
+            # frames are already dropped before the tee
+            framerate_caps = None
+        if framerate_caps:
+            # drop-only never duplicates frames of slower sources
+            VIDEO_FILTERS += "videorate drop-only=true ! "
+            SINK_CAPS += "," + framerate_caps
+
+        size_caps = self._get_size_caps()
+        if size_caps:
+            VIDEO_FILTERS += "videoscale ! "
+            SINK_CAPS += "," + size_caps
 
         LEAKY_Q_ = "queue2 "
         LEAKY_Q0 = LEAKY_Q_ + " name=queue0"
@@ -225,6 +540,7 @@ class GstService:
         pipeline_args = PIPELINE.format(
             leaky_q0=LEAKY_Q0,
             leaky_q1=LEAKY_Q1,
+            video_filters=VIDEO_FILTERS,
             sink_caps=SINK_CAPS,
             sink_element=SINK_ELEMENT,
             pipeline_src=PIPELINE_SRC,
@@ -252,6 +568,10 @@ class GstService:
         #     'autoplug-continue', self.on_autoplug_continue)
         # assert self.gst_video_source_connect_id
         self.gst_queue0 = self.gst_pipeline.get_by_name("queue0")
+        if self._max_rate is not None:
+            self.gst_queue0.get_static_pad("src").add_probe(
+                Gst.PadProbeType.BUFFER, self._on_frame_rate_probe
+            )
         self.gst_vconvert = self.gst_pipeline.get_by_name("vconvert")
         self.gst_queue1 = self.gst_pipeline.get_by_name("queue1")
         self.gst_appsink = self.gst_pipeline.get_by_name("appsink")
@@ -261,6 +581,13 @@ class GstService:
         self._gst_appsink_connect_id = self.gst_appsink.connect(
             "new-sample", self._on_new_sample
         )
+        self._deep_element_added_connect_id = self.gst_pipeline.connect(
+            "deep-element-added", self._on_deep_element_added
+        )
+        self.gst_jpegsink = self.gst_pipeline.get_by_name("jpegsink")
+        if self.gst_jpegsink:
+            self._jpeg_frames = OrderedDict()
+            self.gst_jpegsink.connect("new-sample", self._on_new_jpeg_sample)
         self.mainloop = GLib.MainLoop()
 
         self._set_gst_debug_level()
@@ -324,6 +651,9 @@ class GstService:
                     self.gst_appsink.set_state(Gst.State.NULL)
                     # self.gst_appsink.disconnect(self._gst_appsink_connect_id)
                     self.gst_appsink = None
+                if self.gst_jpegsink:
+                    self.gst_jpegsink.set_state(Gst.State.NULL)
+                    self.gst_jpegsink = None
                 log.debug("gst_queue1.set_state(Gst.State.NULL)")
                 if self.gst_queue1:
                     self.gst_queue1.set_state(Gst.State.NULL)
@@ -404,13 +734,14 @@ class GstService:
 
 
 def start_gst_service(
-    source_conf=None, out_queue=None, stop_signal=None, eos_reached=None
+    source_conf=None, out_queue=None, stop_signal=None, eos_reached=None, max_rate=None
 ):
     svc = GstService(
         source_conf=source_conf,
         out_queue=out_queue,
         stop_signal=stop_signal,
         eos_reached=eos_reached,
+        max_rate=max_rate,
     )
     # set priority level below parent process
     # in order to preserve UX responsiveness
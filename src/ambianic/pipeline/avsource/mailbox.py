@@ -0,0 +1,219 @@
+"""Latest wins shared memory mailbox for image samples between OS processes."""
+
+import logging
+import multiprocessing
+import pickle
+import queue
+import time
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# a segment grows by at least this factor, so that samples with
+# varying size (e.g. passthrough JPEG frames) rarely reallocate it
+GROWTH_FACTOR = 1.5
+
+
+def _unlink_segment(name=None):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+class FrameMailbox:
+    """Single slot mailbox that carries the latest image sample.
+
+    A new sample overwrites the one waiting in the mailbox if the consumer
+    has not read it yet, so the consumer always gets the freshest frame and
+    the producer never waits for the consumer.
+
+    Samples go through three shared memory buffers (triple buffering):
+    the producer writes into its back buffer and swaps it with the ready
+    buffer, the consumer swaps the ready buffer with its front buffer when
+    there is a new sample in it. The consumer reads the pixels in place
+    from its front buffer, which stays valid until its next get().
+
+    Drop-in replacement for the multiprocessing.Queue that carries
+    image samples from GstService to AVSourceElement.
+    """
+
+    def __init__(self):
+        # make sure the resource tracker is shared with forked producer
+        # processes, otherwise a producer exit would unlink
+        # segments that the consumer is still reading
+        resource_tracker.ensure_running()
+        self._prefix = "ambianic_" + uuid.uuid4().hex[:12]
+        self._cond = multiprocessing.Condition()
+        # guarded by the condition lock
+        self._ready = multiprocessing.Value("i", 1, lock=False)
+        self._fresh = multiprocessing.Value("b", 0, lock=False)
+        # samples overwritten before the consumer read them
+        self._overwritten = multiprocessing.Value("q", 0, lock=False)
+        # per buffer segment generation, pixel and metadata sizes,
+        # written by the producer before it hands over the buffer
+        self._generation = multiprocessing.Array("q", 3, lock=False)
+        self._nbytes = multiprocessing.Array("q", 3, lock=False)
+        self._meta_size = multiprocessing.Array("q", 3, lock=False)
+        # buffer index owned by each side
+        self._back = 0
+        self._front = 2
+        # segments mapped by this process keyed by buffer index
+        self._producer_shm = {}
+        self._consumer_shm = {}
+
+    @property
+    def overwritten_count(self) -> int:
+        """Number of samples replaced by a newer one before they were read."""
+        return self._overwritten.value
+
+    def full(self):
+        """Return True if the next sample overwrites an unread one."""
+        return bool(self._fresh.value)
+
+    def empty(self):
+        """Return True if there is no new sample to read."""
+        return not self._fresh.value
+
+    def _segment_name(self, index=None, generation=None):
+        return f"{self._prefix}_{index}_{generation}"
+
+    def _back_buffer(self, size=None):
+        index = self._back
+        shm = self._producer_shm.get(index, None)
+        if shm is not None and shm.size >= size:
+            return shm
+        if shm is not None:
+            # the back buffer is never read by the consumer, its mapping
+            # of an earlier generation stays valid after unlink
+            shm.close()
+            shm.unlink()
+            size = max(size, int(shm.size * GROWTH_FACTOR))
+        generation = self._generation[index] + 1
+        name = self._segment_name(index, generation)
+        log.debug("Allocating shared memory buffer %s with %d bytes", name, size)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._producer_shm[index] = shm
+        self._generation[index] = generation
+        return shm
+
+    def put(self, sample=None):
+        """Write an image sample and make it the latest one.
+
+        Called on the producer side. Never blocks on the consumer.
+        The sample has the same format as the samples
+        GstService puts on a regular out queue:
+        {'type', 'format', 'width', 'height', 'bytes', ...}
+        """
+        assert sample
+        # the mapped gstreamer buffer is copied straight into the buffer
+        data = memoryview(sample["bytes"]).cast("B")
+        nbytes = data.nbytes
+        meta = pickle.dumps(
+            {key: val for key, val in sample.items() if key != "bytes"},
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        shm = self._back_buffer(size=nbytes + len(meta))
+        shm.buf[:nbytes] = data
+        shm.buf[nbytes : nbytes + len(meta)] = meta
+        index = self._back
+        self._nbytes[index] = nbytes
+        self._meta_size[index] = len(meta)
+        with self._cond:
+            self._back = self._ready.value
+            self._ready.value = index
+            if self._fresh.value:
+                self._overwritten.value += 1
+            self._fresh.value = 1
+            self._cond.notify()
+
+    def _front_buffer(self, index=None):
+        generation = self._generation[index]
+        name = self._segment_name(index, generation)
+        shm = self._consumer_shm.get(index, None)
+        if shm is not None and shm.name == name:
+            return shm
+        if shm is not None:
+            # superseded by a larger segment, usually unlinked
+            # by the producer already
+            self._release_segment(shm)
+        shm = shared_memory.SharedMemory(name=name)
+        self._consumer_shm[index] = shm
+        return shm
+
+    def _release_segment(self, shm=None):
+        try:
+            shm.close()
+            shm.unlink()
+        except (BufferError, FileNotFoundError) as e:
+            log.debug("Unable to clean up shared memory %s: %s", shm.name, e)
+
+    def get(self, block=True, timeout=None):
+        """Return the latest image sample with a numpy view of its pixels.
+
+        Called on the consumer side. The sample 'frame' key holds a
+        height x width x 3 numpy array mapped directly onto the shared
+        memory buffer. It is only valid until the next get().
+
+        :Raises:
+        -------
+        queue.Empty
+            If no new sample arrives within the timeout.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._fresh.value:
+                if not block:
+                    raise queue.Empty
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                self._cond.wait(remaining)
+            index = self._ready.value
+            self._ready.value = self._front
+            self._front = index
+            self._fresh.value = 0
+        shm = self._front_buffer(index)
+        nbytes = self._nbytes[index]
+        meta_size = self._meta_size[index]
+        sample = pickle.loads(shm.buf[nbytes : nbytes + meta_size])
+        shape = (sample["height"], sample["width"], 3)
+        sample["frame"] = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf[:nbytes])
+        return sample
+
+    def get_nowait(self):
+        """Return the latest new sample without blocking."""
+        return self.get(block=False)
+
+    def release(self, sample=None):
+        """Drop the numpy view of a consumed sample."""
+        assert sample
+        sample.pop("frame", None)
+
+    def close(self):
+        """Release shared memory segments mapped by this process.
+
+        The consumer is the owner of the segments and unlinks them,
+        so that they are cleaned up even if the producer process
+        was terminated abruptly.
+        """
+        for shm in self._producer_shm.values():
+            shm.close()
+        self._producer_shm = {}
+        for shm in self._consumer_shm.values():
+            self._release_segment(shm)
+        self._consumer_shm = {}
+        # latest segments of the producer that the consumer did not map,
+        # superseded ones are unlinked by the producer
+        for index in range(3):
+            generation = self._generation[index]
+            if generation:
+                _unlink_segment(self._segment_name(index, generation))
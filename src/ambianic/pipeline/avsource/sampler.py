@@ -0,0 +1,107 @@
+"""Source frame rate adapted to the measured pipeline latency."""
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+# lowest frame rate the sampler goes down to
+MIN_FPS = 0.1
+# weight of a new measurement in the moving averages
+SMOOTHING = 0.2
+# rate adjustment per frame while latency is over or back under budget
+BACKOFF_STEP = 0.9
+RECOVERY_STEP = 1.05
+
+
+class LatencySampler:
+    """Picks the frame rate that the pipeline keeps up with.
+
+    The time the pipeline takes to process a frame is smoothed with an
+    exponential moving average. Frames are requested at the rate that
+    this processing time allows, up to the target rate. While frames are
+    older than the latency budget by the time the pipeline is done with
+    them, the rate is lowered further, and it recovers once they are
+    back within budget.
+
+    :Parameters:
+    ----------
+    target_fps : float
+        Max frame rate. No limit if not set.
+    latency_budget : float
+        Max seconds from the moment a frame leaves the gstreamer process
+        until the pipeline is done processing it.
+    min_fps : float
+        The rate never goes below this.
+
+    """
+
+    def __init__(self, target_fps=None, latency_budget=None, min_fps=MIN_FPS):
+        assert target_fps is None or target_fps > 0, "target_fps must be positive"
+        assert latency_budget and latency_budget > 0, "latency_budget must be positive"
+        assert min_fps > 0
+        self.target_fps = target_fps
+        self.latency_budget = latency_budget
+        self._min_fps = min_fps
+        self._processing_time = None
+        self._latency = None
+        self._backoff = 1.0
+        self._rate = target_fps or 0.0
+
+    @property
+    def rate(self) -> float:
+        """Frame rate to deliver, 0 for no limit."""
+        return self._rate
+
+    @property
+    def processing_time(self) -> float:
+        """Average seconds the pipeline spends on a frame."""
+        return self._processing_time or 0.0
+
+    @property
+    def latency(self) -> float:
+        """Average seconds from frame delivery to end of processing."""
+        return self._latency or 0.0
+
+    def _average(self, average=None, value=None):
+        if average is None:
+            return value
+        return average + SMOOTHING * (value - average)
+
+    def observe(self, processing_time=None, latency=None) -> float:
+        """Update the frame rate with the timing of a processed frame.
+
+        :Parameters:
+        ----------
+        processing_time : float
+            Seconds the pipeline spent processing the frame.
+        latency : float
+            Seconds from frame delivery to the end of its processing.
+
+        :Returns:
+        -------
+        float
+            The new frame rate.
+
+        """
+        self._processing_time = self._average(self._processing_time, processing_time)
+        self._latency = self._average(self._latency, latency)
+        if self._latency > self.latency_budget:
+            self._backoff = max(self._backoff * BACKOFF_STEP, 0.01)
+        else:
+            self._backoff = min(self._backoff * RECOVERY_STEP, 1.0)
+        rate = self.target_fps or math.inf
+        if self._processing_time > 0:
+            rate = min(rate, 1 / self._processing_time)
+        if math.isinf(rate):
+            rate = 0.0
+        else:
+            rate = max(rate * self._backoff, self._min_fps)
+        if abs(rate - self._rate) > 0.1 * max(rate, self._rate):
+            log.debug(
+                "Source frame rate %.2f fps, processing time %.3fs, latency %.3fs",
+                rate,
+                self._processing_time,
+                self._latency,
+            )
+        self._rate = rate
+        return rate
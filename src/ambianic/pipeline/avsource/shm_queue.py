@@ -0,0 +1,182 @@
+"""Shared memory transport for raw image samples between OS processes."""
+
+import logging
+import multiprocessing
+import queue
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class SharedMemoryFrameQueue:
+    """Ring buffer of shared memory frame slots plus a small index queue.
+
+    Drop-in replacement for the multiprocessing.Queue that carries
+    image samples from GstService to AVSourceElement.
+    Instead of pickling the raw frame bytes through a pipe, the producer
+    writes each frame once into a free shared memory slot and only sends
+    the slot index and frame metadata over the queue. The consumer maps the
+    slot as a numpy array in place and returns the slot to the free list
+    via release() when it is done reading it.
+
+    Slots are allocated lazily by the producer on the first frame
+    (and reallocated if the frame size grows), because the frame size is
+    not known until the source stream is negotiated.
+
+    :Parameters:
+    ----------
+    slots : int
+        Number of frames that can be in flight at the same time.
+        Equivalent to the maxsize of a multiprocessing.Queue.
+
+    """
+
+    def __init__(self, slots=3):
+        assert slots > 0
+        # make sure the resource tracker is shared with forked producer
+        # processes, otherwise a producer exit would unlink
+        # segments that the consumer is still reading
+        resource_tracker.ensure_running()
+        self._slots = slots
+        self._prefix = "ambianic_" + uuid.uuid4().hex[:12]
+        self._ready = multiprocessing.Queue(slots)
+        # slot ownership flags, True while a frame is in flight
+        self._in_use = multiprocessing.Array("b", slots)
+        # shared memory segments opened by this process keyed by slot index
+        self._producer_shm = {}
+        self._consumer_shm = {}
+        self._generation = 0
+
+    @property
+    def slots(self):
+        """Number of frame slots in the ring buffer."""
+        return self._slots
+
+    def _allocate_slot(self, slot=None, size=None):
+        old_shm = self._producer_shm.get(slot, None)
+        if old_shm is not None:
+            # the consumer unlinks segments when it closes
+            # the producer only drops its own mapping
+            old_shm.close()
+        self._generation += 1
+        name = f"{self._prefix}_{slot}_{self._generation}"
+        log.debug("Allocating shared memory slot %s with %d bytes", name, size)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._producer_shm[slot] = shm
+        return shm
+
+    def _acquire_slot(self):
+        with self._in_use.get_lock():
+            for slot, in_use in enumerate(self._in_use):
+                if not in_use:
+                    self._in_use[slot] = True
+                    return slot
+        raise queue.Full
+
+    def full(self):
+        """Return True if there is no free slot for a new frame."""
+        with self._in_use.get_lock():
+            return all(self._in_use)
+
+    def empty(self):
+        """Return True if there are no frames waiting to be read."""
+        return self._ready.empty()
+
+    def put(self, sample=None):
+        """Write an image sample into a free slot and announce it.
+
+        Called on the producer side.
+        The sample has the same format as the samples
+        GstService puts on a regular out queue:
+        {'type', 'format', 'width', 'height', 'bytes'}
+
+        :Raises:
+        -------
+        queue.Full
+            If all slots are still held by the consumer.
+
+        """
+        assert sample
+        slot = self._acquire_slot()
+        # the mapped gstreamer buffer is copied straight into the slot
+        data = memoryview(sample["bytes"]).cast("B")
+        size = data.nbytes
+        shm = self._producer_shm.get(slot, None)
+        if shm is None or shm.size < size:
+            shm = self._allocate_slot(slot=slot, size=size)
+        shm.buf[:size] = data
+        index = {key: val for key, val in sample.items() if key != "bytes"}
+        index["slot"] = slot
+        index["shm_name"] = shm.name
+        index["nbytes"] = size
+        self._ready.put(index)
+
+    def _release_segment(self, shm=None):
+        try:
+            shm.close()
+            shm.unlink()
+        except (BufferError, FileNotFoundError) as e:
+            log.debug("Unable to clean up shared memory %s: %s", shm.name, e)
+
+    def _attach(self, slot=None, name=None):
+        shm = self._consumer_shm.get(slot, None)
+        if shm is not None and shm.name == name:
+            return shm
+        if shm is not None:
+            # the producer reallocated the slot for larger frames,
+            # the superseded segment is no longer written or read
+            self._release_segment(shm)
+        shm = shared_memory.SharedMemory(name=name)
+        self._consumer_shm[slot] = shm
+        return shm
+
+    def get(self, block=True, timeout=None):
+        """Return the next image sample with a numpy view of its pixels.
+
+        Called on the consumer side. The sample 'frame' key holds a
+        height x width x 3 numpy array mapped directly onto the shared
+        memory slot. It is only valid until release() is called
+        for the sample.
+
+        :Raises:
+        -------
+        queue.Empty
+            If no sample arrives within the timeout.
+
+        """
+        index = self._ready.get(block=block, timeout=timeout)
+        shm = self._attach(slot=index["slot"], name=index["shm_name"])
+        shape = (index["height"], index["width"], 3)
+        index["frame"] = np.ndarray(
+            shape, dtype=np.uint8, buffer=shm.buf[: index["nbytes"]]
+        )
+        return index
+
+    def get_nowait(self):
+        """Return the next available image sample without blocking."""
+        return self.get(block=False)
+
+    def release(self, sample=None):
+        """Return the slot of a consumed sample back to the producer."""
+        assert sample
+        # drop the numpy view before the slot is reused
+        sample.pop("frame", None)
+        with self._in_use.get_lock():
+            self._in_use[sample["slot"]] = False
+
+    def close(self):
+        """Release shared memory segments mapped by this process.
+
+        The consumer is the owner of the segments and unlinks them,
+        so that they are cleaned up even if the producer process
+        was terminated abruptly.
+        """
+        for shm in self._producer_shm.values():
+            shm.close()
+        self._producer_shm = {}
+        for shm in self._consumer_shm.values():
+            self._release_segment(shm)
+        self._consumer_shm = {}
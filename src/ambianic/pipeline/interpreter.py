@@ -1,18 +1,20 @@
 """Ambianic pipeline interpreter module."""
+import importlib
 import logging
+import os
+import sys
 import threading
 import time
 
 from ambianic.configuration import DEFAULT_DATA_DIR, get_root_config
 from ambianic.pipeline import HealthChecker, PipeElement, pipeline_event
-from ambianic.pipeline.ai.face_detect import FaceDetector
-from ambianic.pipeline.ai.fall_detect import FallDetector
-from ambianic.pipeline.ai.object_detect import ObjectDetector
-from ambianic.pipeline.save_event import SaveDetectionEvents
+from ambianic.pipeline.metrics import (
+    METRICS_SOCKET_FILE_NAME,
+    MetricsServer,
+    render_metrics,
+)
 from ambianic.util import ManagedService, ThreadedJob, stacktrace
 
-from .avsource.av_element import AVSourceElement
-
 log = logging.getLogger(__name__)
 
 # Pipeline class, overridden by test
@@ -50,6 +52,69 @@ def get_pipelines(pipelines_config, data_dir=None):
     return pipelines
 
 
+def _pipeline_definition(config=None, pname=None):
+    """Return a pipeline config with the sources and AI models it refers to."""
+    pdef = config["pipelines"][pname]
+    sources = config.get("sources", None) or {}
+    ai_models = config.get("ai_models", None) or {}
+    refs = {"sources": {}, "ai_models": {}}
+    for element_def in pdef:
+        for element_name, element_config in element_def.items():
+            if element_name == "source":
+                source_id = element_config
+                if isinstance(element_config, dict):
+                    source_id = element_config.get("source_id", None)
+                if source_id is not None:
+                    refs["sources"][source_id] = sources.get(source_id, None)
+            if not isinstance(element_config, dict):
+                continue
+            ai_model_id = element_config.get("ai_model", None)
+            if isinstance(ai_model_id, dict):
+                ai_model_id = ai_model_id.get("ai_model_id", None)
+            if ai_model_id is not None:
+                refs["ai_models"][ai_model_id] = ai_models.get(ai_model_id, None)
+    return pdef, refs
+
+
+def changed_pipelines(old_config=None, new_config=None) -> set:
+    """Return the names of pipelines that differ between two configs.
+
+    A pipeline differs if it was added or removed, or if its definition
+    or any source or AI model it refers to changed.
+
+    :Parameters:
+    ----------
+    old_config : dict
+        Configuration the running pipelines were loaded from.
+    new_config : dict
+        Updated configuration.
+
+    :Returns:
+    -------
+    set
+        Names of pipelines to restart.
+
+    """
+    old_pipelines = old_config.get("pipelines", None) or {}
+    new_pipelines = new_config.get("pipelines", None) or {}
+    changed = set(old_pipelines) ^ set(new_pipelines)
+    for pname in set(old_pipelines) & set(new_pipelines):
+        if _pipeline_definition(old_config, pname) != _pipeline_definition(
+            new_config, pname
+        ):
+            changed.add(pname)
+    return changed
+
+
+def _release_unused_models():
+    # AI models are kept loaded across pipeline restarts,
+    # unload the ones that the current pipelines do not use.
+    # Nothing to unload if no model was ever loaded.
+    inference = sys.modules.get("ambianic.pipeline.ai.inference", None)
+    if inference is not None:
+        inference.release_unused_interpreters()
+
+
 class PipelineServer(ManagedService):
     """Thin wrapper around PipelineServer constructs.
 
@@ -77,6 +142,17 @@ class PipelineServer(ManagedService):
     def healthcheck(self):
         return time.monotonic(), True
 
+    def restart_pipelines(self, config=None, pipeline_names=None):
+        """Restart the given pipelines with settings from config.
+
+        See PipelineServerJob.restart_pipelines().
+        """
+        self.config = config
+        if self.pipeline_server_job:
+            self.pipeline_server_job.job.restart_pipelines(
+                config=config, pipeline_names=pipeline_names
+            )
+
     def heal(self):
         """Heal the server.
 
@@ -128,6 +204,7 @@ class PipelineServerJob(ManagedService):
         self._threaded_jobs = []
         self._pipelines = []
         self._config = None
+        self._metrics_server = None
         self.reset(config)
 
     def reset(self, config=None):
@@ -145,6 +222,46 @@ class PipelineServerJob(ManagedService):
                 for pp in self._pipelines:
                     pj = ThreadedJob(pp)
                     self._threaded_jobs.append(pj)
+        _release_unused_models()
+
+    def restart_pipelines(self, config=None, pipeline_names=None):
+        """Restart the given pipelines with settings from config.
+
+        Pipelines removed from config are stopped and new ones are started.
+        All other pipelines keep running.
+
+        :Parameters:
+        ----------
+        config : dict
+            Updated configuration.
+        pipeline_names : set
+            Names of added, removed or changed pipelines.
+
+        """
+        assert config is not None
+        self._config = config
+        for tj in list(self._threaded_jobs):
+            if tj.job.name in pipeline_names:
+                log.info("Stopping pipeline %s", tj.job.name)
+                tj.stop()
+                tj.join()
+                self._threaded_jobs.remove(tj)
+        self._pipelines = [p for p in self._pipelines if p.name not in pipeline_names]
+        pipelines_config = config.get("pipelines", None) or {}
+        pipelines_config = {
+            pname: pdef
+            for pname, pdef in pipelines_config.items()
+            if pname in pipeline_names
+        }
+        if pipelines_config:
+            data_dir = config.get("data_dir", DEFAULT_DATA_DIR)
+            for pp in get_pipelines(pipelines_config, data_dir=data_dir):
+                log.info("Starting pipeline %s", pp.name)
+                pj = ThreadedJob(pp)
+                self._pipelines.append(pp)
+                self._threaded_jobs.append(pj)
+                pj.start()
+        _release_unused_models()
 
     def _on_terminal_pipeline_health(self, pipeline=None, lapse=None):
         log.error(
@@ -214,15 +331,42 @@ class PipelineServerJob(ManagedService):
         threaded_job.heal()
         log.debug("pipeline %s healing request completed.", pipeline.name)
 
+    def metrics(self) -> str:
+        """Return runtime metrics of all pipelines in Prometheus text format."""
+        return render_metrics(self._pipelines)
+
+    def _start_metrics_server(self):
+        data_dir = DEFAULT_DATA_DIR
+        if self._config:
+            data_dir = self._config.get("data_dir", DEFAULT_DATA_DIR)
+        metrics_server = MetricsServer(
+            path=os.path.join(data_dir, METRICS_SOCKET_FILE_NAME),
+            collect=self.metrics,
+        )
+        try:
+            metrics_server.start()
+        except OSError as e:
+            # pipelines run fine without metrics
+            log.warning("Unable to start metrics server: %s", e)
+            return
+        self._metrics_server = metrics_server
+
+    def _stop_metrics_server(self):
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+            self._metrics_server = None
+
     def start(self):
         # Start pipeline interpreter threads
         log.info("pipeline jobs starting...")
         for tj in self._threaded_jobs:
             tj.start()
+        self._start_metrics_server()
         log.info("pipeline jobs started")
 
     def stop(self):
         log.info("pipeline jobs stopping...")
+        self._stop_metrics_server()
         # Signal pipeline interpreter threads to close
         for tj in self._threaded_jobs:
             tj.stop()
@@ -259,6 +403,29 @@ class HealingThread(threading.Thread):
             log.warning(stacktrace())
 
 
+def _resolve_element_class(element_class=None):
+    """Return the class of a pipeline operator.
+
+    :Parameters:
+    ----------
+    element_class : string or class
+        Dotted path of the class, e.g.
+        ambianic.pipeline.motion_detect.MotionDetector
+        or the class itself.
+
+    :Returns:
+    -------
+    class
+        The element class or None if element_class is None.
+
+    """
+    if not isinstance(element_class, str):
+        return element_class
+    module_name, _, class_name = element_class.rpartition(".")
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
 class Pipeline(ManagedService):
     """The main Ambianic data processing structure.
 
@@ -266,12 +433,19 @@ class Pipeline(ManagedService):
     """
 
     # valid pipeline operators
+    # Element classes are given by dotted path and imported on first use,
+    # so that startup does not pay for AI runtimes, GStreamer and
+    # notification libraries of operators that no pipeline uses.
+    # Class objects are accepted as well.
     PIPELINE_OPS = {
-        "source": AVSourceElement,
-        "detect_objects": ObjectDetector,
-        "save_detections": SaveDetectionEvents,
-        "detect_faces": FaceDetector,
-        "detect_falls": FallDetector,
+        "source": "ambianic.pipeline.avsource.av_element.AVSourceElement",
+        "detect_objects": "ambianic.pipeline.ai.object_detect.ObjectDetector",
+        "save_detections": "ambianic.pipeline.save_event.SaveDetectionEvents",
+        "detect_faces": "ambianic.pipeline.ai.face_detect.FaceDetector",
+        "detect_falls": "ambianic.pipeline.ai.fall_detect.FallDetector",
+        "detect_motion": "ambianic.pipeline.motion_detect.MotionDetector",
+        "track_objects": "ambianic.pipeline.object_track.ObjectTracker",
+        "record_clip": "ambianic.pipeline.record_clip.ClipRecorder",
     }
 
     def _on_unknown_pipe_element(self, name=None):
@@ -299,6 +473,11 @@ class Pipeline(ManagedService):
         self._event_log = pipeline_event.get_event_log(pipeline_context=self._context)
         self.load_elements()
 
+    @property
+    def elements(self) -> list:
+        """Pipe elements in the order samples flow through them."""
+        return list(self._pipe_elements)
+
     def load_elements(self):
         """load pipeline elements based on configuration"""
         self._pipe_elements = []
@@ -333,7 +512,9 @@ class Pipeline(ManagedService):
             if isinstance(element_config, str):
                 element_config = {element_name: element_config}
 
-            element_class = self.PIPELINE_OPS.get(element_name, None)
+            element_class = _resolve_element_class(
+                self.PIPELINE_OPS.get(element_name, None)
+            )
 
             if element_class:
                 log.info(
@@ -352,6 +533,32 @@ class Pipeline(ManagedService):
                 self._pipe_elements.append(element)
             else:
                 self._on_unknown_pipe_element(name=element_name)
+        self._scale_source_to_model()
+
+    def _scale_source_to_model(self):
+        """Let the source scale frames to fit the AI models in the pipeline."""
+        if not self._pipe_elements:
+            return
+        source = self._pipe_elements[0]
+        if not getattr(source, "scale_to_model", False):
+            return
+        from ambianic.pipeline.ai.tf_detect import TFDetectionModel
+
+        sizes = [
+            e.input_tensor_size
+            for e in self._pipe_elements[1:]
+            if isinstance(e, TFDetectionModel)
+        ]
+        if not sizes:
+            log.warning(
+                "Pipeline %s source has scale_to_model set "
+                "but there are no AI models in the pipeline.",
+                self.name,
+            )
+            return
+        width = max(w for w, _ in sizes)
+        height = max(h for _, h in sizes)
+        source.set_max_frame_size(width=width, height=height)
 
     def parse_ai_model_config(self, element_def: dict):
         """parse AI model configuration"""
@@ -479,6 +686,10 @@ class Pipeline(ManagedService):
         )
         last_element.connect_to_next_element(hc)
         self._pipe_elements[0].start()
+        # the source loop is over, let elements running in
+        # their own worker threads know that no more samples are coming
+        for e in self._pipe_elements[1:]:
+            e.stop()
         log.info("Started %s", self.__class__.__name__)
 
     def healthcheck(self):
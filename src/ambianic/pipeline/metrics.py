@@ -0,0 +1,365 @@
+"""Runtime metrics of pipeline elements in Prometheus text format."""
+import bisect
+import logging
+import os
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# unix socket in the data dir where the pipeline server serves its metrics
+METRICS_SOCKET_FILE_NAME = "metrics.sock"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+# descriptions of the element specific gauges
+GAUGE_DESCRIPTIONS = {
+    "source_frame_rate": "Frame rate requested from the source by the latency sampler.",
+    "source_target_frame_rate": "Max frame rate of the source, 0 for no limit.",
+    "source_latency_budget_seconds": "Max seconds from frame delivery to end of processing.",
+    "source_frame_latency_seconds": "Average seconds from frame delivery to end of processing.",
+}
+
+
+# descriptions of the element specific info metrics
+INFO_DESCRIPTIONS = {
+    "source_decoder": "Video decoder element of the source and whether it is hardware accelerated.",
+}
+
+
+# descriptions of the element specific histograms
+HISTOGRAM_DESCRIPTIONS = {
+    "source_capture_latency_seconds": "Time from frame capture to the end of its processing.",
+}
+
+
+class Histogram:
+    """Fixed bucket histogram updated by a single thread.
+
+    Each pipe element observes its latency only from the thread that
+    runs its process_sample(), so observations do not need a lock.
+    Readers may get a snapshot that is an observation behind,
+    which is fine for monitoring.
+
+    :Parameters:
+    ----------
+    buckets : tuple
+        Sorted upper bounds of the buckets.
+
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = tuple(buckets)
+        # the last bucket counts values above the largest bound
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value=None):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    def snapshot(self):
+        """Return cumulative (upper bound, count) pairs, sum and total count."""
+        counts = list(self._counts)
+        total_sum = self._sum
+        cumulative = []
+        total = 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative, total_sum, total
+
+
+class ElementMetrics:
+    """Sample counters and processing latency of a pipe element."""
+
+    def __init__(self):
+        # samples received from the previous element
+        self.samples_in = 0
+        # samples passed on to the next element
+        self.samples_out = 0
+        # time spent in process_sample() per processed input sample
+        # not counting the time spent in downstream elements
+        self.latency = Histogram()
+        # element specific gauges by name, see GAUGE_DESCRIPTIONS
+        self.gauges = {}
+        # element specific histograms by name, see HISTOGRAM_DESCRIPTIONS
+        self.histograms = {}
+        # element specific info labels by name, see INFO_DESCRIPTIONS,
+        # exposed as an ambianic_<name>_info gauge with value 1
+        self.info = {}
+
+
+def _escape(value=None) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+
+
+def _format_bound(bound=None) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def _render_histogram(name=None, labels=None, histogram=None) -> list:
+    buckets, total_sum, total = histogram.snapshot()
+    lines = [
+        f'{name}_bucket{{{labels},le="{_format_bound(bound)}"}} {count}'
+        for bound, count in buckets
+    ]
+    lines.append(f"{name}_sum{{{labels}}} {total_sum}")
+    lines.append(f"{name}_count{{{labels}}} {total}")
+    return lines
+
+
+def render_metrics(pipelines=None) -> str:
+    """Render metrics of pipelines and their elements in Prometheus text format.
+
+    :Parameters:
+    ----------
+    pipelines : list
+        Pipelines to report on.
+
+    :Returns:
+    -------
+    string
+        Prometheus text exposition format.
+
+    """
+    now = time.monotonic()
+    heartbeat = []
+    latency = []
+    samples_in = []
+    samples_out = []
+    dropped = []
+    queue_depth = []
+    gauges = {}
+    histograms = {}
+    info = {}
+    for pipeline in pipelines or []:
+        latest_heartbeat, _ = pipeline.healthcheck()
+        heartbeat.append(
+            f"ambianic_pipeline_heartbeat_age_seconds{{{_labels(pipeline=pipeline.name)}}}"
+            f" {now - latest_heartbeat:.3f}"
+        )
+        for index, element in enumerate(pipeline.elements):
+            labels = _labels(
+                pipeline=pipeline.name,
+                element=element.name or "",
+                index=index,
+                **{"class": element.__class__.__name__},
+            )
+            metrics = element.metrics
+            latency += _render_histogram(
+                "ambianic_element_latency_seconds", labels, metrics.latency
+            )
+            for histogram, values in list(metrics.histograms.items()):
+                histograms.setdefault(histogram, []).extend(
+                    _render_histogram(f"ambianic_{histogram}", labels, values)
+                )
+            samples_in.append(
+                f"ambianic_element_samples_in_total{{{labels}}} {metrics.samples_in}"
+            )
+            samples_out.append(
+                f"ambianic_element_samples_out_total{{{labels}}} {metrics.samples_out}"
+            )
+            dropped.append(
+                f"ambianic_element_dropped_samples_total{{{labels}}}"
+                f" {element.dropped_samples}"
+            )
+            queue_depth.append(
+                f"ambianic_element_queue_depth{{{labels}}} {element.queue_depth}"
+            )
+            for gauge, value in list(metrics.gauges.items()):
+                gauges.setdefault(gauge, []).append(
+                    f"ambianic_{gauge}{{{labels}}} {value}"
+                )
+            for name, info_labels in list(metrics.info.items()):
+                info.setdefault(name, []).append(
+                    f"ambianic_{name}_info{{{labels},{_labels(**info_labels)}}} 1"
+                )
+    families = [
+        (
+            "ambianic_pipeline_heartbeat_age_seconds",
+            "gauge",
+            "Seconds since the latest pipeline heartbeat.",
+            heartbeat,
+        ),
+        (
+            "ambianic_element_latency_seconds",
+            "histogram",
+            "Time an element spends processing a sample.",
+            latency,
+        ),
+        (
+            "ambianic_element_samples_in_total",
+            "counter",
+            "Samples received by an element.",
+            samples_in,
+        ),
+        (
+            "ambianic_element_samples_out_total",
+            "counter",
+            "Samples passed on by an element.",
+            samples_out,
+        ),
+        (
+            "ambianic_element_dropped_samples_total",
+            "counter",
+            "Samples an element dropped without processing.",
+            dropped,
+        ),
+        (
+            "ambianic_element_queue_depth",
+            "gauge",
+            "Samples waiting in the worker queue of an element.",
+            queue_depth,
+        ),
+    ]
+    for histogram, samples in histograms.items():
+        families.append(
+            (
+                f"ambianic_{histogram}",
+                "histogram",
+                HISTOGRAM_DESCRIPTIONS.get(histogram, histogram),
+                samples,
+            )
+        )
+    for gauge, samples in gauges.items():
+        families.append(
+            (
+                f"ambianic_{gauge}",
+                "gauge",
+                GAUGE_DESCRIPTIONS.get(gauge, gauge),
+                samples,
+            )
+        )
+    for name, samples in info.items():
+        families.append(
+            (
+                f"ambianic_{name}_info",
+                "gauge",
+                INFO_DESCRIPTIONS.get(name, name),
+                samples,
+            )
+        )
+    lines = []
+    for name, metric_type, description, samples in families:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves metrics to other local processes over a unix socket.
+
+    Each client connection receives a fresh rendering of the metrics,
+    then the connection is closed. The web app runs in a separate
+    process and pulls the pipeline metrics this way.
+
+    :Parameters:
+    ----------
+    path : string
+        Location of the unix socket file.
+    collect : function
+        Returns the current metrics text.
+
+    """
+
+    def __init__(self, path=None, collect=None):
+        assert path
+        assert collect
+        self._path = str(path)
+        self._collect = collect
+        self._sock = None
+        self._thread = None
+        self._stop_requested = threading.Event()
+
+    def start(self):
+        if os.path.exists(self._path):
+            # left over from a previous run
+            os.remove(self._path)
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self._path)
+        self._sock.listen()
+        # wake up once in a while to check for stop requests
+        self._sock.settimeout(1)
+        self._stop_requested.clear()
+        self._thread = threading.Thread(
+            target=self._serve, name="Metrics server", daemon=True
+        )
+        self._thread.start()
+        log.info("Serving metrics on %s", self._path)
+
+    def _serve(self):
+        while not self._stop_requested.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                with conn:
+                    conn.sendall(self._collect().encode("utf-8"))
+            except Exception:
+                log.exception("Error serving metrics")
+
+    def stop(self):
+        self._stop_requested.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+def fetch_metrics(path=None, timeout=5) -> str:
+    """Pull the metrics text from a MetricsServer.
+
+    :Raises:
+    -------
+    OSError
+        If there is no metrics server listening on path.
+
+    """
+    assert path
+    chunks = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b"".join(chunks).decode("utf-8")
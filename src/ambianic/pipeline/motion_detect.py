@@ -0,0 +1,118 @@
+"""Motion detection pipe element."""
+import logging
+import time
+from typing import Iterable
+
+import numpy as np
+from ambianic.pipeline import PipeElement
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+
+class MotionDetector(PipeElement):
+    """Passes on only image samples that differ from the recent background.
+
+    Meant to be placed in front of AI inference elements, so that
+    frames of a static scene do not go through a costly model inference.
+    Each frame is downscaled to a small grayscale image and compared to a
+    running average of the previous frames (the background).
+    A frame is passed on if enough pixels changed, or if no frame was
+    passed on for max_skip_interval seconds. The latter keeps idle samples
+    flowing to elements such as SaveDetectionEvents and keeps the
+    pipeline heartbeat alive.
+    """
+
+    def __init__(
+        self,
+        sensitivity=0.5,
+        max_skip_interval=10,
+        pixel_threshold=25,
+        frame_width=64,
+        background_rate=0.05,
+        **kwargs
+    ):
+        """Create MotionDetector element with the provided arguments.
+        :Parameters:
+        ----------
+        sensitivity: 0.5 # between 0 and 1. The higher the sensitivity,
+                the smaller the changed area of a frame has to be to count
+                as motion. At 0.5 about 2.5% of the frame has to change,
+                at 1 any changed pixel counts.
+        max_skip_interval: 10 # how often (in seconds) to pass on a sample
+                even if there is no motion.
+        pixel_threshold: 25 # min change of a pixel grayscale value (0-255)
+                to count the pixel as changed.
+        frame_width: 64 # width (in pixels) of the downscaled frame
+                used for comparison.
+        background_rate: 0.05 # how fast the background adapts to
+                changes in the scene, between 0 and 1.
+        """
+        super().__init__(**kwargs)
+        assert 0 <= sensitivity <= 1, "sensitivity must be between 0 and 1"
+        assert max_skip_interval > 0
+        assert 0 < background_rate <= 1, "background_rate must be between 0 and 1"
+        assert frame_width > 0
+        self._min_changed_area = (1 - sensitivity) / 20
+        self._max_skip_interval = max_skip_interval
+        self._pixel_threshold = pixel_threshold
+        self._frame_width = frame_width
+        self._background_rate = background_rate
+        self._background = None
+        # make sure the very first sample is passed on
+        self._time_latest_sample = time.monotonic() - max_skip_interval
+
+    def _downscale(self, image=None) -> np.ndarray:
+        width, height = image.size
+        frame_height = max(1, round(height * self._frame_width / width))
+        small = image.resize(
+            (self._frame_width, frame_height), Image.BILINEAR, reducing_gap=2.0
+        )
+        return np.asarray(small.convert("L"), dtype=np.float32)
+
+    def detect(self, image=None) -> float:
+        """Compare image to the background and update the background.
+
+        :Parameters:
+        ----------
+        image : PIL.Image
+            Input image.
+
+        :Returns:
+        -------
+        float
+            Fraction of the image area that changed, between 0 and 1.
+
+        """
+        assert image
+        frame = self._downscale(image)
+        if self._background is None or self._background.shape != frame.shape:
+            # first frame or the source resolution changed
+            self._background = frame
+            return 1.0
+        changed = np.abs(frame - self._background) > self._pixel_threshold
+        changed_area = np.count_nonzero(changed) / changed.size
+        # running average, updated in place
+        self._background *= 1 - self._background_rate
+        self._background += self._background_rate * frame
+        return changed_area
+
+    def process_sample(self, **sample) -> Iterable[dict]:
+        """Pass on sample if there is motion or it is time for an idle sample."""
+        log.debug("%s received new sample", self.__class__.__name__)
+        if not sample:
+            # pass through empty samples to next element
+            yield None
+            return
+        image = sample.get("image", None)
+        if image is None:
+            yield sample
+            return
+        changed_area = self.detect(image=image)
+        now = time.monotonic()
+        if changed_area > self._min_changed_area:
+            log.debug("Motion detected in %.1f%% of the frame", changed_area * 100)
+        elif now - self._time_latest_sample < self._max_skip_interval:
+            return
+        self._time_latest_sample = now
+        yield sample
@@ -0,0 +1,211 @@
+"""Object tracking pipe element."""
+import itertools
+import logging
+import time
+from typing import Iterable
+
+import numpy as np
+from ambianic.pipeline import PipeElement
+
+log = logging.getLogger(__name__)
+
+
+def box_iou(boxes_a=None, boxes_b=None) -> np.ndarray:
+    """Return the intersection over union of each pair of boxes.
+
+    :Parameters:
+    ----------
+    boxes_a : numpy.ndarray
+        Array of shape (N, 4) with xmin, ymin, xmax, ymax per box.
+    boxes_b : numpy.ndarray
+        Array of shape (M, 4).
+
+    :Returns:
+    -------
+    numpy.ndarray
+        Array of shape (N, M).
+
+    """
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+    width = np.clip(
+        np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None
+    )
+    height = np.clip(
+        np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None
+    )
+    intersection = width * height
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - intersection
+    return np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+
+
+def _centroid_distance(boxes_a=None, boxes_b=None) -> np.ndarray:
+    centers_a = (boxes_a[:, :2] + boxes_a[:, 2:]) / 2
+    centers_b = (boxes_b[:, :2] + boxes_b[:, 2:]) / 2
+    return np.linalg.norm(centers_a[:, None, :] - centers_b[None, :, :], axis=-1)
+
+
+def _greedy_match(scores=None, valid=None):
+    """Pair rows and columns with the best scores first.
+
+    Return a list of (row, column) pairs, each row and column used once.
+    """
+    rows, cols = np.nonzero(valid)
+    order = np.argsort(-scores[rows, cols], kind="stable")
+    used_rows = set()
+    used_cols = set()
+    matches = []
+    for row, col in zip(rows[order], cols[order]):
+        if row in used_rows or col in used_cols:
+            continue
+        used_rows.add(row)
+        used_cols.add(col)
+        matches.append((row, col))
+    return matches
+
+
+class ObjectTracker(PipeElement):
+    """Assigns stable track ids to detections across frames.
+
+    Each detection box is matched to the track of the same label that it
+    overlaps most (intersection over union) in the previous frames.
+    Boxes that do not overlap enough are matched by the distance
+    between box centers instead, which helps with fast moving objects
+    at low frame rates. Unmatched detections start new tracks.
+
+    Each detection in the inference_result is passed on with a
+    track_id and a new_track flag. SaveDetectionEvents saves and
+    notifies only samples with new tracks, so an object that stays in
+    view produces one event instead of one event every
+    positive_interval seconds.
+    """
+
+    def __init__(
+        self,
+        iou_threshold=0.3,
+        max_distance=0.1,
+        max_age=5,
+        **kwargs,
+    ):
+        """Create ObjectTracker element with the provided arguments.
+        :Parameters:
+        ----------
+        iou_threshold: 0.3 # min intersection over union (0-1) of a
+                detection box with the latest box of a track to
+                count as the same object.
+        max_distance: 0.1 # max distance between box centers, relative
+                to the image size, to count as the same object when
+                the boxes do not overlap enough. 0 turns it off.
+        max_age: 5 # how long (in seconds) to keep a track
+                after its object was last detected.
+        """
+        super().__init__(**kwargs)
+        assert 0 < iou_threshold <= 1, "iou_threshold must be between 0 and 1"
+        assert max_distance >= 0
+        assert max_age > 0
+        self._iou_threshold = iou_threshold
+        self._max_distance = max_distance
+        self._max_age = max_age
+        self._track_ids = itertools.count(1)
+        # parallel per track arrays
+        self._boxes = np.zeros((0, 4), dtype=np.float32)
+        self._labels = np.zeros((0,), dtype=object)
+        self._ids = np.zeros((0,), dtype=np.int64)
+        self._last_seen = np.zeros((0,), dtype=np.float64)
+
+    @property
+    def track_count(self) -> int:
+        """Number of live tracks."""
+        return len(self._ids)
+
+    def _expire_tracks(self, now=None):
+        alive = now - self._last_seen <= self._max_age
+        if not alive.all():
+            self._boxes = self._boxes[alive]
+            self._labels = self._labels[alive]
+            self._ids = self._ids[alive]
+            self._last_seen = self._last_seen[alive]
+
+    def update(self, inference_result=None, now=None) -> list:
+        """Match detections to tracks.
+
+        :Parameters:
+        ----------
+        inference_result : list
+            Detections with label and box keys.
+        now : float
+            Monotonic time of the detections.
+
+        :Returns:
+        -------
+        list
+            Copies of the detections with track_id and new_track keys.
+
+        """
+        if now is None:
+            now = time.monotonic()
+        self._expire_tracks(now)
+        if not inference_result:
+            return inference_result
+        boxes = np.array(
+            [
+                [d["box"]["xmin"], d["box"]["ymin"], d["box"]["xmax"], d["box"]["ymax"]]
+                for d in inference_result
+            ],
+            dtype=np.float32,
+        )
+        labels = np.array([d["label"] for d in inference_result], dtype=object)
+        same_label = self._labels[:, None] == labels[None, :]
+        track_of = np.full(len(inference_result), -1)
+        iou = box_iou(self._boxes, boxes)
+        for t, d in _greedy_match(iou, same_label & (iou >= self._iou_threshold)):
+            track_of[d] = t
+        if self._max_distance > 0:
+            unmatched_tracks = np.ones(len(self._ids), dtype=bool)
+            unmatched_tracks[track_of[track_of >= 0]] = False
+            distance = _centroid_distance(self._boxes, boxes)
+            valid = (
+                same_label
+                & (distance <= self._max_distance)
+                & unmatched_tracks[:, None]
+                & (track_of < 0)[None, :]
+            )
+            for t, d in _greedy_match(-distance, valid):
+                track_of[d] = t
+        new = track_of < 0
+        new_count = int(np.count_nonzero(new))
+        new_ids = np.array(
+            [next(self._track_ids) for _ in range(new_count)], dtype=np.int64
+        )
+        # update matched tracks in place and append the new ones
+        matched = ~new
+        self._boxes[track_of[matched]] = boxes[matched]
+        self._last_seen[track_of[matched]] = now
+        ids = np.empty(len(inference_result), dtype=np.int64)
+        ids[matched] = self._ids[track_of[matched]]
+        ids[new] = new_ids
+        self._boxes = np.concatenate([self._boxes, boxes[new]])
+        self._labels = np.concatenate([self._labels, labels[new]])
+        self._ids = np.concatenate([self._ids, new_ids])
+        self._last_seen = np.concatenate([self._last_seen, np.full(new_count, now)])
+        if new_count:
+            log.debug("Started %d new object tracks", new_count)
+        return [
+            {**d, "track_id": int(track_id), "new_track": bool(is_new)}
+            for d, track_id, is_new in zip(inference_result, ids, new)
+        ]
+
+    def process_sample(self, **sample) -> Iterable[dict]:
+        """Add track ids to the detections of the sample and pass it on."""
+        log.debug("%s received new sample", self.__class__.__name__)
+        if not sample:
+            # pass through empty samples to next element
+            yield None
+            return
+        inference_result = sample.get("inference_result", None)
+        sample["inference_result"] = self.update(inference_result=inference_result)
+        yield sample
@@ -6,7 +6,11 @@ import pathlib
 import uuid
 
 import yaml
-from concurrent_log_handler import ConcurrentRotatingFileHandler
+from ambianic.pipeline.timeline_store import (
+    DEFAULT_MAX_EVENTS,
+    TIMELINE_STORE_FILE_NAME,
+    TimelineStore,
+)
 
 log = logging.getLogger(__name__)
 TIMELINE_EVENT_LOGGER_NAME = __name__ + "__timeline__event__logger__"
@@ -88,10 +92,8 @@ class PipelineContext:
 class PipelineEventFormatter(logging.Formatter):
     """Custom logging formatter for pipeline events."""
 
-    def format(self, record: logging.LogRecord = None) -> str:
-        """Populate event information and return as yaml formatted string."""
-        # s = super().format(record)
-        s = None
+    def format_event(self, record: logging.LogRecord = None) -> dict:
+        """Populate event information from a log record."""
         e = {}
         e["id"] = uuid.uuid4().hex
         e["message"] = record.getMessage()
@@ -109,6 +111,11 @@ class PipelineEventFormatter(logging.Formatter):
         ctx = record.args.get(PIPELINE_CONTEXT_KEY, None)
         if ctx:
             e[PIPELINE_CONTEXT_KEY] = ctx.toDict()
+        return e
+
+    def format(self, record: logging.LogRecord = None) -> str:
+        """Populate event information and return as yaml formatted string."""
+        e = self.format_event(record)
         # use array enclosure a[] to mainain the log file
         # yaml compliant as new events are appended
         # - event1:
@@ -119,6 +126,30 @@ class PipelineEventFormatter(logging.Formatter):
         return s
 
 
+class TimelineStoreHandler(logging.Handler):
+    """Logging handler that appends pipeline events to a TimelineStore."""
+
+    def __init__(self, store: TimelineStore = None):
+        super().__init__()
+        assert store
+        self.store = store
+        self.setFormatter(PipelineEventFormatter())
+
+    def emit(self, record: logging.LogRecord = None):
+        try:
+            event = self.formatter.format_event(record)
+            # LoggerAdapter from get_event_log() attaches the pipeline context
+            ctx = getattr(record, PIPELINE_CONTEXT_KEY, None)
+            pipeline = ctx.unique_pipeline_name if ctx else None
+            self.store.append(event=event, pipeline=pipeline)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.store.close()
+        super().close()
+
+
 def configure_timeline(config: dict = None):
     """Initialize timeline event logger.
 
@@ -144,24 +175,23 @@ def configure_timeline(config: dict = None):
     log_directory = os.path.dirname(log_filename)
     with pathlib.Path(log_directory) as log_dir:
         log_dir.mkdir(parents=True, exist_ok=True)
-    log.debug(f"Timeline event log messages directed to {log_filename}")
+    # Events are stored in an indexed database next to the legacy
+    # YAML event log files, which are imported once on first start.
+    store_filename = os.path.join(log_directory, TIMELINE_STORE_FILE_NAME)
+    log.debug(f"Timeline event log messages directed to {store_filename}")
+    store = TimelineStore(
+        path=store_filename, max_events=config.get("max_events", DEFAULT_MAX_EVENTS)
+    )
+    store.import_legacy_timeline(log_directory or ".")
     event_log = logging.getLogger(TIMELINE_EVENT_LOGGER_NAME)
     event_log.setLevel(logging.INFO)
-    # Use rotating files as log message handler
-    handler = ConcurrentRotatingFileHandler(
-        log_filename,
-        # each event file will keep up to 100K data
-        maxBytes=100 * 1024,
-        # 100 backup files will be kept. Older will be erased.
-        backupCount=100,
-    )
-    fmt = PipelineEventFormatter()
-    handler.setFormatter(fmt)
     # remove any other handlers that may be assigned previously
     # and could cause unexpected log collisions
+    for handler in event_log.handlers:
+        handler.close()
     event_log.handlers = []
     # add custom event handler
-    event_log.addHandler(handler)
+    event_log.addHandler(TimelineStoreHandler(store=store))
 
 
 def get_event_log(pipeline_context: PipelineContext = None) -> logging.Logger:
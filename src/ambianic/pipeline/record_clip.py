@@ -0,0 +1,412 @@
+"""Video clip recording pipe element."""
+import collections
+import datetime
+import io
+import logging
+import pathlib
+import struct
+import threading
+import time
+from typing import Iterable
+
+from ambianic.configuration import DEFAULT_DATA_DIR
+from ambianic.pipeline import (
+    WORKER_OVERFLOW_BLOCK,
+    WORKER_OVERFLOW_DROP_OLDEST,
+    PipeElement,
+    PipeElementWorker,
+)
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+# frames waiting to be encoded, older ones are skipped
+# when encoding falls behind the camera
+ENCODER_QUEUE_SIZE = 2
+
+# Matroska element ids
+_EBML = 0x1A45DFA3
+_EBML_VERSION = 0x4286
+_EBML_READ_VERSION = 0x42F7
+_EBML_MAX_ID_LENGTH = 0x42F2
+_EBML_MAX_SIZE_LENGTH = 0x42F3
+_DOC_TYPE = 0x4282
+_DOC_TYPE_VERSION = 0x4287
+_DOC_TYPE_READ_VERSION = 0x4285
+_SEGMENT = 0x18538067
+_INFO = 0x1549A966
+_TIMECODE_SCALE = 0x2AD7B1
+_DURATION = 0x4489
+_MUXING_APP = 0x4D80
+_WRITING_APP = 0x5741
+_TRACKS = 0x1654AE6B
+_TRACK_ENTRY = 0xAE
+_TRACK_NUMBER = 0xD7
+_TRACK_UID = 0x73C5
+_TRACK_TYPE = 0x83
+_FLAG_LACING = 0x9C
+_CODEC_ID = 0x86
+_VIDEO = 0xE0
+_PIXEL_WIDTH = 0xB0
+_PIXEL_HEIGHT = 0xBA
+_CLUSTER = 0x1F43B675
+_CLUSTER_TIMECODE = 0xE7
+_SIMPLE_BLOCK = 0xA3
+
+# block timecodes are 16 bit offsets (in ms) from the cluster timecode
+_CLUSTER_DURATION_MS = 30000
+
+
+def _ebml_size(size=None) -> bytes:
+    for length in range(1, 9):
+        # all ones is reserved for unknown size
+        if size < (1 << (7 * length)) - 1:
+            return (size | (1 << (7 * length))).to_bytes(length, "big")
+    raise ValueError(f"EBML element size too large: {size}")
+
+
+def _ebml_header(element_id=None, size=None) -> bytes:
+    id_length = (element_id.bit_length() + 7) // 8
+    return element_id.to_bytes(id_length, "big") + _ebml_size(size)
+
+
+def _ebml_element(element_id=None, payload=None) -> bytes:
+    return _ebml_header(element_id, len(payload)) + payload
+
+
+def _ebml_uint(element_id=None, value=None) -> bytes:
+    length = max(1, (value.bit_length() + 7) // 8)
+    return _ebml_element(element_id, value.to_bytes(length, "big"))
+
+
+def _ebml_float(element_id=None, value=None) -> bytes:
+    return _ebml_element(element_id, struct.pack(">d", value))
+
+
+def _ebml_string(element_id=None, value=None) -> bytes:
+    return _ebml_element(element_id, value.encode("ascii"))
+
+
+def write_mjpeg_mkv(path=None, frames=None, width=None, height=None):
+    """Save JPEG frames as a Motion JPEG video in a Matroska (.mkv) file.
+
+    The frames are stored as they are, without decoding or re-encoding.
+
+    :Parameters:
+    ----------
+    path : pathlib.Path
+        Output file path.
+    frames : list
+        (timestamp in seconds, JPEG bytes) tuples in timestamp order.
+    width : int
+        Frame width in pixels.
+    height : int
+        Frame height in pixels.
+
+    """
+    assert frames, "At least one frame required"
+    start = frames[0][0]
+    timecodes = [round((ts - start) * 1000) for ts, _ in frames]
+    # the last frame is shown for the average frame duration
+    last_frame_ms = timecodes[-1] / (len(frames) - 1) if len(frames) > 1 else 0
+    header = b"".join(
+        [
+            _ebml_uint(_EBML_VERSION, 1),
+            _ebml_uint(_EBML_READ_VERSION, 1),
+            _ebml_uint(_EBML_MAX_ID_LENGTH, 4),
+            _ebml_uint(_EBML_MAX_SIZE_LENGTH, 8),
+            _ebml_string(_DOC_TYPE, "matroska"),
+            _ebml_uint(_DOC_TYPE_VERSION, 2),
+            _ebml_uint(_DOC_TYPE_READ_VERSION, 2),
+        ]
+    )
+    info = b"".join(
+        [
+            # timecodes in milliseconds
+            _ebml_uint(_TIMECODE_SCALE, 1000000),
+            _ebml_float(_DURATION, float(timecodes[-1] + last_frame_ms)),
+            _ebml_string(_MUXING_APP, "ambianic"),
+            _ebml_string(_WRITING_APP, "ambianic"),
+        ]
+    )
+    video = _ebml_uint(_PIXEL_WIDTH, width) + _ebml_uint(_PIXEL_HEIGHT, height)
+    track = b"".join(
+        [
+            _ebml_uint(_TRACK_NUMBER, 1),
+            _ebml_uint(_TRACK_UID, 1),
+            # video
+            _ebml_uint(_TRACK_TYPE, 1),
+            _ebml_uint(_FLAG_LACING, 0),
+            _ebml_string(_CODEC_ID, "V_MJPEG"),
+            _ebml_element(_VIDEO, video),
+        ]
+    )
+    segment_head = _ebml_element(_INFO, info) + _ebml_element(
+        _TRACKS, _ebml_element(_TRACK_ENTRY, track)
+    )
+    # group frames in clusters, block headers are small so they are built
+    # up front to know the element sizes, frame data is written as is
+    clusters = []
+    for timecode, (_, jpeg) in zip(timecodes, frames):
+        if not clusters or timecode - clusters[-1][0] >= _CLUSTER_DURATION_MS:
+            clusters.append((timecode, []))
+        cluster_timecode, blocks = clusters[-1]
+        # track 1, keyframe
+        block_head = b"\x81" + struct.pack(">hB", timecode - cluster_timecode, 0x80)
+        block_head = _ebml_header(_SIMPLE_BLOCK, len(block_head) + len(jpeg)) + (
+            block_head
+        )
+        blocks.append((block_head, jpeg))
+    cluster_heads = []
+    segment_size = len(segment_head)
+    for cluster_timecode, blocks in clusters:
+        cluster_timecode = _ebml_uint(_CLUSTER_TIMECODE, cluster_timecode)
+        cluster_size = len(cluster_timecode) + sum(
+            len(block_head) + len(jpeg) for block_head, jpeg in blocks
+        )
+        cluster_head = _ebml_header(_CLUSTER, cluster_size) + cluster_timecode
+        cluster_heads.append(cluster_head)
+        segment_size += len(cluster_head) - len(cluster_timecode) + cluster_size
+    with open(path, "wb") as f:
+        f.write(_ebml_element(_EBML, header))
+        f.write(_ebml_header(_SEGMENT, segment_size))
+        f.write(segment_head)
+        for cluster_head, (_, blocks) in zip(cluster_heads, clusters):
+            f.write(cluster_head)
+            for block_head, jpeg in blocks:
+                f.write(block_head)
+                f.write(jpeg)
+
+
+class ClipRecorder(PipeElement):
+    """Saves video clips of detections with the frames before and after them.
+
+    The latest camera frames are kept in memory as JPEG images. When a
+    sample with a non-empty inference_result arrives, a clip starts with
+    the buffered frames (pre roll) and goes on until no detection has been
+    made for post_roll seconds. Clips are saved as Motion JPEG .mkv files
+    in the clips directory under the data dir.
+
+    Cameras with a jpeg_passthrough source provide the frames already
+    compressed, so they are stored without decoding or re-encoding.
+    For other sources the frames are encoded to JPEG once, in a background
+    thread, so that detection does not wait for it. If encoding falls
+    behind the camera, the oldest waiting frames are skipped.
+
+    The element goes after a detection element, which passes on
+    every frame with its inference_result.
+    """
+
+    def __init__(
+        self,
+        pre_roll=5,
+        post_roll=5,
+        max_clip_length=60,
+        max_memory=64,
+        jpeg_quality=75,
+        **kwargs,
+    ):
+        """Create ClipRecorder element with the provided arguments.
+        :Parameters:
+        ----------
+        pre_roll: 5 # how many seconds of video to save
+                before the first detection of a clip.
+        post_roll: 5 # how many seconds of video to save
+                after the last detection of a clip.
+        max_clip_length: 60 # clips are cut after this many seconds,
+                a new clip starts if detections go on.
+        max_memory: 64 # max memory (in MB) used for the frames of
+                this camera, buffered and waiting to be saved.
+                Clips are cut short when it runs out.
+        jpeg_quality: 75 # quality (1-95) of the encoded frames
+                for cameras that do not provide JPEG frames.
+        """
+        super().__init__(**kwargs)
+        assert pre_roll >= 0
+        assert post_roll >= 0
+        assert max_clip_length > 0
+        assert max_memory > 0
+        assert 1 <= jpeg_quality <= 95, "jpeg_quality must be between 1 and 95"
+        self._pre_roll = pre_roll
+        self._post_roll = post_roll
+        self._max_clip_length = max_clip_length
+        self._max_memory = max_memory * 1024 * 1024
+        self._jpeg_quality = jpeg_quality
+        # (timestamp, jpeg) of the latest frames
+        self._frames = collections.deque()
+        self._frames_size = 0
+        # frames of the clip being recorded
+        self._clip = None
+        self._clip_size = 0
+        self._clip_start_time = None
+        self._clip_end = None
+        self._clip_last_detection = None
+        if self.context:
+            data_dir = self.context.data_dir
+        else:
+            data_dir = DEFAULT_DATA_DIR
+        self._output_directory = pathlib.Path(data_dir) / "clips"
+        self._output_directory.mkdir(parents=True, exist_ok=True)
+        self._output_directory = self._output_directory.resolve()
+        # saved clips take memory until written, wait for the disk
+        # instead of piling them up
+        self._writer = PipeElementWorker(
+            name=f"{self.name or self.__class__.__name__} writer",
+            target=self._write_clip,
+            queue_size=1,
+            overflow=WORKER_OVERFLOW_BLOCK,
+        )
+        self._writing_size = 0
+        self._writing_size_lock = threading.Lock()
+        # frames are encoded and added to clips in this thread only
+        self._encoder = PipeElementWorker(
+            name=f"{self.name or self.__class__.__name__} encoder",
+            target=self._encode_update,
+            queue_size=ENCODER_QUEUE_SIZE,
+            overflow=WORKER_OVERFLOW_DROP_OLDEST,
+        )
+
+    @property
+    def memory_size(self) -> int:
+        """Size (in bytes) of the frames held by this element."""
+        return self._frames_size + self._clip_size + self._writing_size
+
+    @property
+    def dropped_samples(self) -> int:
+        """Number of input samples or frames skipped by the encoder."""
+        return super().dropped_samples + self._encoder.dropped_count
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of input samples and frames waiting to be encoded."""
+        return super().queue_depth + self._encoder.queue_depth
+
+    @property
+    def recording(self) -> bool:
+        """True while a clip is being recorded."""
+        return self._clip is not None
+
+    def _encode_frame(self, image=None) -> bytes:
+        with io.BytesIO() as buf:
+            image.save(buf, format="JPEG", quality=self._jpeg_quality)
+            return buf.getvalue()
+
+    def _buffer_frame(self, now=None, jpeg=None):
+        self._frames.append((now, jpeg))
+        self._frames_size += len(jpeg)
+        while len(self._frames) > 1 and (
+            self._frames[0][0] < now - self._pre_roll
+            or self.memory_size > self._max_memory
+        ):
+            _, dropped = self._frames.popleft()
+            self._frames_size -= len(dropped)
+
+    def _start_clip(self, now=None):
+        self._clip = list(self._frames)
+        self._clip_size = self._frames_size
+        self._frames.clear()
+        self._frames_size = 0
+        self._clip_start_time = datetime.datetime.now() - datetime.timedelta(
+            seconds=now - self._clip[0][0]
+        )
+        self._clip_end = now + self._max_clip_length
+        log.debug("Started video clip with %d pre roll frames", len(self._clip))
+
+    def _save_clip(self):
+        clip = {
+            "frames": self._clip,
+            "clip_path": self._output_directory
+            / self._clip_start_time.strftime("%Y%m%d-%H%M%S.%f%z-clip.mkv"),
+        }
+        with self._writing_size_lock:
+            self._writing_size += self._clip_size
+        # the end of the clip is the pre roll of the next one
+        last_frame_time = self._clip[-1][0]
+        for frame_time, jpeg in self._clip:
+            if frame_time >= last_frame_time - self._pre_roll:
+                self._frames.append((frame_time, jpeg))
+                self._frames_size += len(jpeg)
+        self._clip = None
+        self._clip_size = 0
+        self._clip_last_detection = None
+        self._writer.put(clip)
+
+    def _write_clip(self, frames=None, clip_path=None):
+        """Save clip frames to a video file."""
+        try:
+            width, height = Image.open(io.BytesIO(frames[0][1])).size
+            write_mjpeg_mkv(clip_path, frames, width, height)
+            log.info("Saved video clip %s", clip_path)
+        except Exception as e:
+            log.warning("Unable to save video clip %s: %s", clip_path, e)
+        finally:
+            with self._writing_size_lock:
+                self._writing_size -= sum(len(jpeg) for _, jpeg in frames)
+
+    def update(self, jpeg=None, detected=False, now=None):
+        """Add a frame and start, go on with or save a clip.
+
+        :Parameters:
+        ----------
+        jpeg : bytes
+            JPEG image of the frame.
+        detected : bool
+            Whether there is a detection in the frame.
+        now : float
+            Monotonic time of the frame.
+
+        """
+        if now is None:
+            now = time.monotonic()
+        if self._clip is None:
+            self._buffer_frame(now, jpeg)
+            if not detected:
+                return
+            self._start_clip(now)
+        else:
+            self._clip.append((now, jpeg))
+            self._clip_size += len(jpeg)
+        if detected:
+            self._clip_last_detection = now
+        if (
+            now >= self._clip_end
+            or now - self._clip_last_detection >= self._post_roll
+            or self.memory_size > self._max_memory
+        ):
+            self._save_clip()
+
+    def _encode_update(self, image=None, jpeg=None, detected=False, now=None):
+        """Encode the frame if needed and add it, in the encoder thread."""
+        try:
+            if jpeg is None:
+                jpeg = self._encode_frame(image)
+            self.update(jpeg=jpeg, detected=detected, now=now)
+        except Exception as e:
+            log.exception("Error %r while recording video clip", e)
+
+    def process_sample(self, **sample) -> Iterable[dict]:
+        """Queue frame for the clips and pass the sample on right away."""
+        image = sample.get("image", None)
+        if image:
+            self._encoder.put(
+                {
+                    "image": image,
+                    "jpeg": sample.get("image_jpeg", None),
+                    "detected": bool(sample.get("inference_result", None)),
+                    "now": time.monotonic(),
+                }
+            )
+        yield sample
+
+    def start(self):
+        super().start()
+        self._encoder.start()
+        self._writer.start()
+
+    def stop(self):
+        """Save the clip being recorded and stop."""
+        super().stop()
+        self._encoder.stop(timeout=30, drain=True)
+        if self._clip is not None:
+            self._save_clip()
+        self._writer.stop(timeout=30, drain=True)
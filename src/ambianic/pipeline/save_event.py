@@ -1,35 +1,94 @@
 """Pipeline sample storage elements."""
 import datetime
-import json
 import logging
+import os
 import pathlib
 import uuid
 from typing import Iterable
 
 from ambianic.configuration import DEFAULT_DATA_DIR
-from ambianic.notification import Notification, NotificationHandler
-from ambianic.pipeline import PipeElement
+from ambianic.notification import (
+    Notification,
+    NotificationDispatcher,
+    NotificationHandler,
+)
+from ambianic.pipeline import PipeElement, PipeElementWorker
 from ambianic.util import jsonify
 
 log = logging.getLogger(__name__)
 
+# Pillow default JPEG quality
+DEFAULT_JPEG_QUALITY = 75
+
+
+def _fsync_files(paths=None):
+    """Flush written files and their directories to disk."""
+    dirs = set()
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        dirs.add(os.path.dirname(path))
+    for dir_path in dirs:
+        fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
 
 class SaveDetectionEvents(PipeElement):
     """Saves AI detection events(inference samples) to an external storage location."""
 
-    def __init__(self, positive_interval=2, idle_interval=600, notify=None, **kwargs):
+    def __init__(
+        self,
+        positive_interval=2,
+        idle_interval=600,
+        notify=None,
+        jpeg_quality=DEFAULT_JPEG_QUALITY,
+        writer=None,
+        **kwargs,
+    ):
         """Create SaveDetectionEvents element with the provided arguments.
         :Parameters:
         ----------
         output_directory: *object_detect_dir
         positive_interval: 2 # how often (in seconds) to save samples
                 with ANY results above the confidence threshold.
-                Default is 2 seconds.
+                Default is 2 seconds. Not used for detections tracked
+                by a track_objects element, these are saved only
+                when a new object is tracked.
         idle_interval: 600 # how often (in seconds) to save samples
                 with NO results above the confidence threshold.
                 Default it 10 minutes (600 seconds.)
+        jpeg_quality: 75 # quality (1-95) of the saved JPEG images.
+                Lower values save disk space and CPU time.
+        writer: # optional. Save events in a background thread,
+                so that slow disk writes and notifications do not hold back
+                the camera thread. Samples are passed on to the next
+                element right away. For example:
+                queue_size: 10 # max number of events waiting to be saved
+                overflow: drop_oldest # or drop_newest, block
+                fsync: true # flush saved files to disk in batches
+                    whenever the queue runs empty
         """
         super().__init__(**kwargs)
+        assert 1 <= jpeg_quality <= 95, "jpeg_quality must be between 1 and 95"
+        self._jpeg_quality = jpeg_quality
+        self._writer = None
+        self._fsync = False
+        self._unsynced_files = []
+        if writer is not None:
+            writer = dict(writer)
+            self._fsync = writer.pop("fsync", True)
+            writer.setdefault("queue_size", 10)
+            self._writer = PipeElementWorker(
+                name=f"{self.name or self.__class__.__name__} writer",
+                target=self._write_event,
+                **writer,
+            )
 
         log.info("Loading pipe element %r ", self.__class__.__name__)
         if self.context:
@@ -77,6 +136,13 @@ class SaveDetectionEvents(PipeElement):
             self.notification_config["providers"] = ["default"]
 
         self.notifier = NotificationHandler()
+        # send notifications from worker threads, slow endpoints
+        # should not hold back the pipeline
+        self._dispatcher = NotificationDispatcher(
+            handler=self.notifier,
+            workers=self.notification_config.get("workers", 2),
+            queue_size=self.notification_config.get("queue_size", 100),
+        )
 
     def _save_sample(
         self,
@@ -85,6 +151,7 @@ class SaveDetectionEvents(PipeElement):
         thumbnail=None,
         inference_result=None,
         inference_meta=None,
+        image_jpeg=None,
     ):
         time_prefix = inf_time.strftime("%Y%m%d-%H%M%S.%f%z-{suffix}.{fext}")
         image_file = time_prefix.format(suffix="image", fext="jpg")
@@ -108,20 +175,51 @@ class SaveDetectionEvents(PipeElement):
             "inference_meta": inference_meta,
         }
 
-        image.save(image_path)
-        thumbnail.save(thumbnail_path)
-        # save samples to local disk
-
-        json_str = jsonify(save_json)
+        event = {
+            "save_json": save_json,
+            "image": image,
+            "image_jpeg": image_jpeg,
+            "image_path": image_path,
+            "thumbnail": thumbnail,
+            "thumbnail_path": thumbnail_path,
+            "json_path": json_path,
+        }
+        if self._writer is not None:
+            self._writer.put(event)
+        else:
+            self._write_event(**event)
+        return image_path, json_path
 
+    def _write_event(
+        self,
+        save_json=None,
+        image=None,
+        image_jpeg=None,
+        image_path=None,
+        thumbnail=None,
+        thumbnail_path=None,
+        json_path=None,
+    ):
+        """Save event files, log the event and send out notifications."""
+        # save samples to local disk
+        if image_jpeg is not None:
+            # already encoded by the camera
+            with open(image_path, "wb") as f:
+                f.write(image_jpeg)
+        else:
+            image.save(image_path, quality=self._jpeg_quality)
+        thumbnail.save(thumbnail_path, quality=self._jpeg_quality)
         with open(json_path, "w", encoding="utf-8") as f:
-            f.write(json_str)
-        # e = PipelineEvent('Detected Objects', type='ObjectDetection')
-
-        json_encoded_obj = json.loads(json_str)
+            f.write(jsonify(save_json))
+        if self._fsync:
+            self._unsynced_files += [image_path, thumbnail_path, json_path]
+            # batch fsync calls while events keep coming in
+            if self._writer.queue_depth == 0:
+                self._sync_files()
         log_message = "Detection Event"
         event_priority = logging.INFO
-        self.event_log.log(event_priority, log_message, json_encoded_obj)
+        # the timeline store takes care of numpy types in the event
+        self.event_log.log(event_priority, log_message, save_json)
         log.debug("Saved sample (detection event): %r ", save_json)
         # format notification message in a way consistent with event log file formatting
         # used by PipelineEventFormatter
@@ -131,13 +229,58 @@ class SaveDetectionEvents(PipeElement):
             "args": save_json,
         }
         # only send notification if there is a non-empty inference result
-        if inference_result:
+        if save_json["inference_result"]:
             self.notify(event_data)
-        return image_path, json_path
+
+    def _sync_files(self):
+        files = self._unsynced_files
+        self._unsynced_files = []
+        try:
+            _fsync_files(files)
+        except OSError as e:
+            log.warning("Unable to flush saved detection files to disk: %s", e)
+
+    @property
+    def dropped_samples(self) -> int:
+        """Number of input samples or detection events dropped without saving."""
+        dropped = super().dropped_samples
+        if self._writer is not None:
+            dropped += self._writer.dropped_count
+        return dropped
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of input samples and detection events waiting."""
+        depth = super().queue_depth
+        if self._writer is not None:
+            depth += self._writer.queue_depth
+        return depth
+
+    def start(self):
+        super().start()
+        if self._writer is not None:
+            self._writer.start()
+
+    def stop(self):
+        """Save waiting detection events, send out notifications and stop."""
+        super().stop()
+        if self._writer is not None:
+            self._writer.stop(timeout=30, drain=True)
+            if self._unsynced_files:
+                self._sync_files()
+        self._dispatcher.stop()
+
+    def _is_new_detection(self, inference_result=None, now=None) -> bool:
+        if "track_id" in inference_result[0]:
+            # detections tracked by an upstream track_objects element,
+            # save as soon as a new object shows up and only then
+            return any(d["new_track"] for d in inference_result)
+        return now - self._time_latest_saved_detection >= self._positive_interval
 
     def process_sample(self, **sample) -> Iterable[dict]:
         """Process next detection sample."""
         image = sample.get("image", None)
+        image_jpeg = sample.get("image_jpeg", None)
         thumbnail = sample.get("thumbnail", None)
         inference_result = sample.get("inference_result", None)
         inference_meta = sample.get("inference_meta", None)
@@ -157,16 +300,14 @@ class SaveDetectionEvents(PipeElement):
                     # non-empty result, there is a detection
                     # let's save it if its been longer than
                     # the user specified positive_interval
-                    if (
-                        now - self._time_latest_saved_detection
-                        >= self._positive_interval
-                    ):
+                    if self._is_new_detection(inference_result, now):
                         self._save_sample(
                             inf_time=now,
                             image=image,
                             thumbnail=thumbnail,
                             inference_result=inference_result,
                             inference_meta=inference_meta,
+                            image_jpeg=image_jpeg,
                         )
                         self._time_latest_saved_detection = now
                 else:
@@ -180,6 +321,7 @@ class SaveDetectionEvents(PipeElement):
                             thumbnail=thumbnail,
                             inference_result=inference_result,
                             inference_meta=inference_meta,
+                            image_jpeg=image_jpeg,
                         )
                         self._time_latest_saved_idle = now
             except Exception as e:
@@ -211,4 +353,4 @@ class SaveDetectionEvents(PipeElement):
             envelope=event_data,
             providers=self.notification_config["providers"],
         )
-        self.notifier.send(notification)
+        self._dispatcher.submit(notification)
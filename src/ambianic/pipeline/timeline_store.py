@@ -0,0 +1,326 @@
+"""Indexed storage for pipeline timeline events."""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import yaml
+from ambianic.util import jsonify
+
+log = logging.getLogger(__name__)
+
+TIMELINE_STORE_FILE_NAME = "timeline-event-log.db"
+LEGACY_TIMELINE_GLOB = "timeline-event-log.yaml*"
+
+# by default keep about as many events as the legacy
+# 100 rotated YAML files of 100KB each used to hold
+DEFAULT_MAX_EVENTS = 50000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS timeline_event (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL NOT NULL,
+    pipeline TEXT,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timeline_event_time
+    ON timeline_event (timestamp, seq);
+CREATE INDEX IF NOT EXISTS timeline_event_pipeline_time
+    ON timeline_event (pipeline, timestamp, seq);
+CREATE TABLE IF NOT EXISTS timeline_label (
+    seq INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    label TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timeline_label_time
+    ON timeline_label (label, timestamp, seq);
+CREATE INDEX IF NOT EXISTS timeline_label_seq
+    ON timeline_label (seq);
+CREATE TABLE IF NOT EXISTS timeline_import (
+    file_name TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    file_mtime REAL NOT NULL,
+    PRIMARY KEY (file_name, file_size, file_mtime)
+);
+"""
+
+
+def _event_timestamp(event: dict = None) -> float:
+    """Return the sort timestamp of an event in epoch seconds.
+
+    Detection events carry the time of the inference in args.datetime,
+    which is when the event actually happened. Fall back to the
+    time the event was logged.
+    """
+    args = event.get("args", None)
+    if isinstance(args, dict) and args.get("datetime", None):
+        try:
+            return datetime.fromisoformat(str(args["datetime"])).timestamp()
+        except ValueError:
+            log.debug("Unable to parse event datetime %r", args["datetime"])
+    return float(event.get("created", 0))
+
+
+def _event_labels(event: dict = None) -> set:
+    labels = set()
+    args = event.get("args", None)
+    if isinstance(args, dict):
+        for inf in args.get("inference_result", None) or []:
+            if isinstance(inf, dict) and inf.get("label", None):
+                labels.add(str(inf["label"]))
+    return labels
+
+
+def _legacy_file_order(file_path: Path) -> int:
+    """Sort key that puts the oldest rotated YAML file first."""
+    suffix = file_path.suffix.lstrip(".")
+    if suffix.isdigit():
+        return -int(suffix)
+    # the file without a numeric suffix is the one currently written to
+    return 1
+
+
+class TimelineStore:
+    """Append-only SQLite store of timeline events with a time index.
+
+    Events are kept in insertion order and indexed by event time,
+    pipeline name and detection label, so that a page of the most
+    recent events or events before a given time can be looked up
+    without reading the whole history.
+
+    :Parameters:
+    ----------
+    path : string
+        Location of the SQLite database file.
+    max_events : int
+        Number of most recent events to keep. Older events are pruned.
+
+    """
+
+    def __init__(self, path=None, max_events=DEFAULT_MAX_EVENTS):
+        assert path
+        self._path = Path(path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._max_events = max_events
+        self._inserts_since_prune = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            str(self._path), timeout=10, check_same_thread=False
+        )
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            # WAL allows the web app to read while pipelines write
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+
+    @property
+    def path(self):
+        """Location of the database file."""
+        return self._path
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _insert(self, event: dict = None, pipeline: str = None):
+        timestamp = _event_timestamp(event)
+        cur = self._conn.execute(
+            "INSERT INTO timeline_event (timestamp, pipeline, event) "
+            "VALUES (?, ?, ?)",
+            (timestamp, pipeline, jsonify(event)),
+        )
+        seq = cur.lastrowid
+        self._conn.executemany(
+            "INSERT INTO timeline_label (seq, timestamp, label) VALUES (?, ?, ?)",
+            [(seq, timestamp, label) for label in _event_labels(event)],
+        )
+        self._inserts_since_prune += 1
+
+    def _prune(self):
+        # pruning is relatively expensive, only do it once in a while
+        if self._inserts_since_prune < max(1, self._max_events // 100):
+            return
+        self._inserts_since_prune = 0
+        row = self._conn.execute(
+            "SELECT seq FROM timeline_event ORDER BY seq DESC LIMIT 1 OFFSET ?",
+            (self._max_events,),
+        ).fetchone()
+        if row:
+            self._conn.execute("DELETE FROM timeline_event WHERE seq <= ?", (row[0],))
+            self._conn.execute("DELETE FROM timeline_label WHERE seq <= ?", (row[0],))
+
+    def append(self, event: dict = None, pipeline: str = None):
+        """Append a new event to the timeline.
+
+        :Parameters:
+        ----------
+        event : dict
+            Event as formatted by PipelineEventFormatter.
+        pipeline : string
+            Unique name of the pipeline that fired the event.
+
+        """
+        assert event
+        with self._lock:
+            self._insert(event=event, pipeline=pipeline)
+            self._prune()
+            self._conn.commit()
+
+    def query(
+        self, before_datetime=None, page=1, page_size=5, pipeline=None, label=None
+    ):
+        """Return a page of events ordered from most recent to oldest.
+
+        :Parameters:
+        ----------
+        before_datetime : datetime
+            Only return events that happened strictly before this time.
+        page : positive integer
+            Page number counting from the most recent events.
+        page_size : positive integer
+            Number of events per page.
+        pipeline : string
+            Only return events fired by this pipeline.
+        label : string
+            Only return events with a detection of this label.
+
+        :Returns:
+        -------
+        list: dict
+            Timeline events.
+
+        """
+        assert isinstance(page, int)
+        assert page > 0
+        if label is None:
+            from_clause = "timeline_event e"
+            index = "e"
+        else:
+            # walk the label index instead of the event index
+            from_clause = "timeline_label i JOIN timeline_event e ON e.seq = i.seq"
+            index = "i"
+        conditions = []
+        params = []
+        if label is not None:
+            conditions.append("i.label = ?")
+            params.append(label)
+        if pipeline is not None:
+            conditions.append("e.pipeline = ?")
+            params.append(pipeline)
+        if before_datetime is not None:
+            conditions.append(f"{index}.timestamp < ?")
+            params.append(before_datetime.timestamp())
+        sql = f"SELECT e.event FROM {from_clause}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {index}.timestamp DESC, {index}.seq DESC LIMIT ? OFFSET ?"
+        params += [page_size, (page - 1) * page_size]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _is_imported(self, file_name=None, stat=None) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM timeline_import "
+            "WHERE file_name = ? AND file_size = ? AND file_mtime = ?",
+            (file_name, stat.st_size, stat.st_mtime),
+        ).fetchone()
+        return row is not None
+
+    def _import_yaml_events(self, file_path: Path = None) -> int:
+        with file_path.open() as pf:
+            try:
+                events = yaml.safe_load(pf) or []
+            except (
+                yaml.reader.ReaderError,
+                yaml.scanner.ScannerError,
+                yaml.composer.ComposerError,
+                yaml.constructor.ConstructorError,
+            ):
+                log.exception("Detected unreadable timeline, removing %s", file_path)
+                _remove_file(file_path)
+                return 0
+        count = 0
+        for event in events:
+            if not isinstance(event, dict):
+                continue
+            context = event.get("pipeline_context", None) or {}
+            try:
+                self._insert(
+                    event=event, pipeline=context.get("unique_pipeline_name", None)
+                )
+                count += 1
+            except (TypeError, ValueError) as e:
+                log.warning("Skipping timeline event %r: %s", event, e)
+        return count
+
+    def import_yaml(self, file_path: Path = None) -> int:
+        """Import events from a legacy YAML timeline file once.
+
+        Files that were already imported are skipped.
+        Unreadable files are removed, same as the legacy reader did.
+
+        :Returns:
+        -------
+        int
+            Number of imported events.
+
+        """
+        file_path = Path(file_path)
+        stat = file_path.stat()
+        with self._lock:
+            if self._is_imported(file_name=file_path.name, stat=stat):
+                return 0
+            # lock the database for writing so that the web app
+            # and the pipeline server do not import the same file twice
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # check again now that no other process can write
+                if self._is_imported(file_name=file_path.name, stat=stat):
+                    count = 0
+                else:
+                    count = self._import_yaml_events(file_path)
+                    # unreadable files are removed instead of imported
+                    if file_path.exists():
+                        self._conn.execute(
+                            "INSERT INTO timeline_import "
+                            "(file_name, file_size, file_mtime) VALUES (?, ?, ?)",
+                            (file_path.name, stat.st_size, stat.st_mtime),
+                        )
+                    self._prune()
+                    log.info("Imported %d timeline events from %s", count, file_path)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return count
+
+    def import_legacy_timeline(self, data_dir=None) -> int:
+        """Import legacy YAML timeline files from data_dir.
+
+        Files are imported oldest first to preserve event order.
+        """
+        files = sorted(
+            Path(data_dir).glob(LEGACY_TIMELINE_GLOB), key=_legacy_file_order
+        )
+        count = 0
+        for file_path in files:
+            count += self.import_yaml(file_path)
+        return count
+
+
+def _remove_file(file_path):
+    try:
+        os.remove(file_path)
+    except Exception:
+        log.exception("Error removing %s", file_path)
+
+
+def has_legacy_timeline(data_dir=None) -> bool:
+    return any(Path(data_dir).glob(LEGACY_TIMELINE_GLOB))
@@ -1,4 +1,5 @@
 """Main Ambianic server module."""
+import copy
 import logging
 import logging.handlers
 import os
@@ -7,7 +8,7 @@ import time
 from ambianic import logger
 from ambianic.configuration import get_all_config_files, get_root_config, reload_config
 from ambianic.pipeline import pipeline_event
-from ambianic.pipeline.interpreter import PipelineServer
+from ambianic.pipeline.interpreter import PipelineServer, changed_pipelines
 from ambianic.util import ServiceExit
 from watchdog.observers import Observer
 
@@ -21,6 +22,44 @@ ROOT_SERVERS = {
     # web server is now started as a separted uvicorn process from the OS shell
     # "web": FastapiServer,
 }
+# seconds without further config file events before changes are applied
+CONFIG_CHANGE_DEBOUNCE = 1
+# config sections applied by restarting only the affected pipelines
+PIPELINE_SETTINGS = {"pipelines", "sources", "ai_models"}
+# config sections read by pipelines that save detections
+NOTIFICATION_SETTINGS = {"notifications", "display_name", "peerid", "ui"}
+
+
+def _config_snapshot(config=None) -> dict:
+    """Return a copy of the config settings to compare with later changes."""
+    settings = copy.deepcopy(config.as_dict())
+    return {key.lower(): value for key, value in settings.items()}
+
+
+def _config_changes(old_config=None, new_config=None):
+    """Compare config snapshots.
+
+    :Returns:
+    -------
+    (bool, set)
+        Whether the whole server has to restart
+        and otherwise the names of pipelines to restart.
+
+    """
+    changed_sections = {
+        key
+        for key in old_config.keys() | new_config.keys()
+        if old_config.get(key, None) != new_config.get(key, None)
+    }
+    if changed_sections - PIPELINE_SETTINGS - NOTIFICATION_SETTINGS:
+        return True, set()
+    pipeline_names = changed_pipelines(old_config, new_config)
+    if changed_sections & NOTIFICATION_SETTINGS:
+        pipelines = new_config.get("pipelines", None) or {}
+        for pname, pdef in pipelines.items():
+            if any("save_detections" in element_def for element_def in pdef):
+                pipeline_names.add(pname)
+    return False, pipeline_names
 
 
 class AmbianicServer:
@@ -43,6 +82,10 @@ class AmbianicServer:
         self._service_restart_requested = False
         self._latest_heartbeat = time.monotonic()
         self._config_observer = None
+        # settings the running servers were started with
+        self._config_snapshot = None
+        # time of the latest config file event not applied yet
+        self._config_changed_time = None
 
     def stop_watch_config(self):
         if self._config_observer:
@@ -108,9 +151,47 @@ class AmbianicServer:
             raise ServiceExit
 
     def dispatch(self, event):
-        """Callback called by watchdog.Observer when a config file changes"""
-        log.info("Configuration file changed, stopping Ambianic server")
-        self.restart()
+        """Callback called by watchdog.Observer when a config file changes.
+
+        Editors and save_config() may write a file several times in a row.
+        Changes are applied from the main thread once no more events
+        arrive for CONFIG_CHANGE_DEBOUNCE seconds.
+        """
+        if getattr(event, "event_type", None) in ("opened", "closed_no_write"):
+            # config files are read on reload, ignore our own reads
+            return
+        log.info("Configuration file changed")
+        self._config_changed_time = time.monotonic()
+
+    def _apply_config_change(self, servers):
+        """Reload the config and restart only what the changes affect."""
+        if self._config_changed_time is None:
+            return
+        if time.monotonic() - self._config_changed_time < CONFIG_CHANGE_DEBOUNCE:
+            return
+        self._config_changed_time = None
+        reload_config()
+        config = get_root_config()
+        config_snapshot = _config_snapshot(config)
+        restart_all, pipeline_names = _config_changes(
+            self._config_snapshot, config_snapshot
+        )
+        pipeline_server = servers.get("pipelines", None)
+        if pipeline_names and not hasattr(pipeline_server, "restart_pipelines"):
+            restart_all = True
+        if restart_all:
+            log.info("Configuration changed, restarting Ambianic server")
+            self.restart()
+            return
+        self._config_snapshot = config_snapshot
+        if not pipeline_names:
+            log.info("Configuration reloaded, no pipeline changes.")
+            return
+        log.info(
+            "Configuration changed, restarting pipelines: %s",
+            ", ".join(sorted(pipeline_names)),
+        )
+        pipeline_server.restart_pipelines(config=config, pipeline_names=pipeline_names)
 
     def restart(self):
         self._service_restart_requested = True
@@ -132,6 +213,9 @@ class AmbianicServer:
         logger.configure(config.get("logging"))
 
         pipeline_event.configure_timeline(config.get("timeline"))
+        # taken before pipelines resolve their source and model references
+        self._config_snapshot = _config_snapshot(config)
+        self._config_changed_time = None
 
         # watch configuration changes
         self.start_watch_config()
@@ -154,6 +238,7 @@ class AmbianicServer:
             while True:
                 time.sleep(0.5)
                 self._healthcheck(servers)
+                self._apply_config_change(servers)
                 self._heartbeat()
         except ServiceExit:
 
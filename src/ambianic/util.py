@@ -2,13 +2,12 @@
 import asyncio
 import json
 import logging
+import sys
 import time
 import traceback
 from abc import abstractmethod
 from threading import Event, Thread
 
-import numpy as np
-
 log = logging.getLogger(__name__)
 
 
@@ -61,7 +60,8 @@ class ThreadedJob(Thread, ManagedService):
     # Reminder: even though multiple processes can work well for pipelines,
     # since they are mostly independent,
     # Google Coral does not allow access to it from different processes yet.
-    # Consider moving access to coral in a separate process that can serve
+    # Pipeline threads share one interpreter per AI model via
+    # ambianic.pipeline.ai.inference.SharedInterpreter, which serves
     # an inference task queue from multiple pipelines.
 
     def __init__(self, job=None, **kwargs):
@@ -152,6 +152,10 @@ def stacktrace():
 
 class JsonEncoder(json.JSONEncoder):
     def default(self, obj):
+        # numpy values can only show up once numpy is imported
+        np = sys.modules.get("numpy", None)
+        if np is None:
+            return super().default(obj)
         if isinstance(obj, np.integer):
             return int(obj)
         if isinstance(obj, np.floating):
@@ -15,6 +15,7 @@ from ambianic.configuration import (
 )
 from ambianic.device import DeviceInfo
 from ambianic.notification import Notification, NotificationHandler
+from ambianic.pipeline import metrics
 from ambianic.webapp.server import config_sources, timeline_dao
 from ambianic.webapp.server.config_sources import SensorSource
 from fastapi import FastAPI, HTTPException, Response, status
@@ -157,21 +158,58 @@ class TimelineResponse(BaseResponse):
 
 @app.get("/api/timeline.json", response_model=TimelineResponse, include_in_schema=False)
 @app.get("/api/timeline", response_model=TimelineResponse)
-def get_timeline(page: int = 1):
+def get_timeline(
+    page: int = 1,
+    before_datetime: str = None,
+    pipeline: str = None,
+    label: str = None,
+):
     """
     Get timeline items in groups of 5 in reverse chronographical order.
 
     For example **page**=1 returns the latest 5 detected events, **page**=2 gets the previous 5 and so on.
+
+    Optionally only return events before a given ISO 8601 **before_datetime**,
+    fired by a given **pipeline** or with a detection of a given **label**.
     """
     response_object = {"status": "success"}
     log.debug('Requested timeline events page" %d', page)
-    resp = timeline_dao.get_timeline(page=page, data_dir=app.data_dir)
+    timeline_config = get_root_config().get("timeline", None) or {}
+    resp = timeline_dao.get_timeline(
+        before_datetime=before_datetime,
+        page=page,
+        data_dir=app.data_dir,
+        pipeline=pipeline,
+        label=label,
+        max_events=timeline_config.get("max_events", timeline_dao.DEFAULT_MAX_EVENTS),
+    )
     response_object["timeline"] = resp
     log.debug("Returning %d timeline events", len(resp))
     # log.debug('Returning samples: %s ', response_object)
     return response_object
 
 
+@app.get("/api/metrics", response_class=Response)
+def get_metrics():
+    """
+    Get runtime metrics of the pipelines in Prometheus text format.
+
+    Includes per element processing latency histograms,
+    samples in and out, dropped samples and worker queue depths.
+    """
+    socket_path = Path(app.data_dir, metrics.METRICS_SOCKET_FILE_NAME)
+    try:
+        # pipelines run in a separate process
+        text = metrics.fetch_metrics(path=socket_path)
+    except OSError as e:
+        log.debug("Unable to fetch pipeline metrics: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Pipeline metrics are not available.",
+        )
+    return Response(content=text, media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+
 @app.get("/api/config", response_model=dict)
 def get_config():
     """
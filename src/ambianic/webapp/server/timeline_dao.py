@@ -1,22 +1,55 @@
 """REST API for timeline events fired by pipelines."""
 import logging
 import os
+import threading
 from datetime import datetime
 from pathlib import Path
 
-import yaml
+from ambianic.pipeline.timeline_store import (
+    DEFAULT_MAX_EVENTS,
+    TIMELINE_STORE_FILE_NAME,
+    TimelineStore,
+    has_legacy_timeline,
+)
 
 log = logging.getLogger()
 
+# open timeline stores keyed by database file location
+_stores = {}
+_stores_lock = threading.Lock()
 
-def _remove_timeline(file_path):
-    try:
-        os.remove(file_path)
-    except Exception:
-        logging.exception("Error removing %s" % file_path)
 
+def _get_store(data_dir=None, max_events=DEFAULT_MAX_EVENTS):
+    """Return the timeline store in data_dir or None if there is no timeline yet.
 
-def get_timeline(before_datetime=None, page=1, data_dir=None):
+    Legacy YAML timeline files found in data_dir are imported into the store
+    once, when it is opened by this process. The pipeline server imports them
+    on start as well, so files are not expected to show up later.
+    """
+    store_path = Path(data_dir, TIMELINE_STORE_FILE_NAME).resolve()
+    with _stores_lock:
+        store = _stores.get(store_path, None)
+        if store is not None and not store_path.exists():
+            # the database was removed from under us
+            store.close()
+            store = None
+        if store is None:
+            if not store_path.exists() and not has_legacy_timeline(data_dir):
+                return None
+            store = TimelineStore(path=store_path, max_events=max_events)
+            store.import_legacy_timeline(data_dir)
+            _stores[store_path] = store
+    return store
+
+
+def get_timeline(
+    before_datetime=None,
+    page=1,
+    data_dir=None,
+    pipeline=None,
+    label=None,
+    max_events=DEFAULT_MAX_EVENTS,
+):
     """Get stored pipeline timeline events.
 
     :Parameters:
@@ -28,6 +61,12 @@ def get_timeline(before_datetime=None, page=1, data_dir=None):
         sample.
     page : positive integer
         Paginates samples in batches of 5. Defaults to page=1.
+    pipeline : string
+        Only return events fired by the pipeline with this name.
+    label : string
+        Only return events with a detection of this label, e.g. 'person'.
+    max_events : int
+        Number of most recent events the timeline store keeps.
 
     :Returns:
     -------
@@ -54,72 +93,19 @@ def get_timeline(before_datetime=None, page=1, data_dir=None):
                 before_datetime,
                 str(e),
             )
-    page_start_position = (page - 1) * page_size
-    page_end_position = page_start_position + page_size
 
     if not parsed_datetime:
         log.debug("Fetching most recent saved samples")
-    log.debug(
-        "Fetching samples page %d. Page size %d. " "Sample index range [%d:%d]. ",
-        page,
-        page_size,
-        page_start_position,
-        page_end_position,
-    )
-
-    files = list(Path(data_dir).glob("./timeline-event-log.yaml*"))
-    files = sorted(files, reverse=False)
-
-    page_count = 1
-    events_queue = []
-
-    # load the event history, older first
-    for file_path in files:
-        with file_path.open() as pf:
-
-            try:
-                timeline_events = yaml.safe_load(pf)
-                timeline_events += events_queue
-            except (
-                yaml.reader.ReaderError,
-                yaml.scanner.ScannerError,
-                yaml.composer.ComposerError,
-                yaml.constructor.ConstructorError,
-            ):
-                log.exception("Detected unreadable timeline, removing %s" % file_path)
-                _remove_timeline(file_path)
-                continue
-
-            events_queue = []
-            events_len = len(timeline_events)
-            if events_len < page_end_position:
-
-                pages_mod = events_len % page_size
-                if pages_mod > 0:
-                    events_queue = timeline_events[0:pages_mod]
-                    page_start_position += pages_mod
-                    page_end_position += pages_mod
+    log.debug("Fetching samples page %d. Page size %d.", page, page_size)
 
-                page_start_position -= events_len
-                page_end_position -= events_len
-                page_count += 1
-
-            else:
-
-                if page_start_position >= events_len:
-                    return []
-
-                # events are appended to the file as they arrive
-                # we need to read in reverse order to get the latest one first
-
-                return timeline_events[
-                    -1 * page_start_position - 1 : -1 * page_end_position - 1 : -1
-                ]
-
-    page_count += 1
-
-    if page_count < page:
+    store = _get_store(data_dir, max_events=max_events)
+    if store is None:
         return []
 
-    # return the remaining queue if there are no more files to process
-    return events_queue
+    return store.query(
+        before_datetime=parsed_datetime,
+        page=page,
+        page_size=page_size,
+        pipeline=pipeline,
+        label=label,
+    )
@@ -717,3 +717,52 @@ def test_fall_detection_2_frame_back_case_3():
     fall_detector.receive_next_sample(image=img_3)
 
     assert not result
+
+
+def _fall_detection_rotated(rotation_batch=False, file_names=None):
+    config = _fall_detect_config()
+    config["rotation_mode"] = "tensor"
+    config["rotation_batch"] = rotation_batch
+    result = None
+
+    def sample_callback(image=None, inference_result=None, **kwargs):
+        nonlocal result
+        result = inference_result
+
+    fall_detector = FallDetector(**config)
+    output = _OutPipeElement(sample_callback=sample_callback)
+    fall_detector.connect_to_next_element(output)
+    img_1 = _get_image(file_name=file_names[0])
+    img_2 = _get_image(file_name=file_names[1])
+    fall_detector.receive_next_sample(image=img_1)
+    fall_detector.min_time_between_frames = 0.01
+    time.sleep(fall_detector.min_time_between_frames)
+    fall_detector.receive_next_sample(image=img_2)
+    return fall_detector, result
+
+
+def test_fall_detection_tensor_rotation_clockwise():
+    """Expect to detect a fall with key-points found in the
+    input tensor image rotated clockwise."""
+    fall_detector, result = _fall_detection_rotated(
+        file_names=["fall_img_11.png", "fall_img_12.png"]
+    )
+    assert result
+    assert len(result) == 1
+    assert result[0]["label"] == "FALL"
+    assert result[0]["keypoint_corr"]
+    assert result[0]["leaning_angle"] > 60
+    # the next frame starts with the rotation that found the fallen person
+    assert fall_detector._latest_rotation != 0
+
+
+def test_fall_detection_tensor_rotation_counter_clockwise_batch():
+    """Expect to detect a fall with key-points found in the input
+    tensor image rotated counter clockwise, all rotations in one batch."""
+    fall_detector, result = _fall_detection_rotated(
+        rotation_batch=True, file_names=["fall_img_11_flip.png", "fall_img_12_flip.png"]
+    )
+    assert result
+    assert len(result) == 1
+    assert result[0]["label"] == "FALL"
+    assert result[0]["leaning_angle"] > 60
@@ -1,9 +1,18 @@
 """Test image detection pipe element."""
 import os
+import tracemalloc
 
+import numpy as np
 import pytest
-from ambianic.pipeline.ai.image_boundingBox_detection import TFBoundingBoxDetection
-from ambianic.pipeline.ai.tf_detect import TFDetectionModel
+from ambianic.pipeline.ai.image_boundingBox_detection import (
+    TFBoundingBoxDetection,
+    crop_region,
+    map_box_from_region,
+    non_max_suppression,
+    parse_roi,
+    tile_boxes,
+)
+from ambianic.pipeline.ai.tf_detect import TFDetectionModel, thumbnail_size
 from PIL import Image
 
 
@@ -138,3 +147,156 @@ def test_load_labels():
     labels = img_detect._labels
     assert labels[0] == "person"
     assert labels[15] == "bird"
+
+
+def test_parse_roi():
+    assert parse_roi(None) == []
+    [(box, polygon)] = parse_roi([{"xmin": 0.5, "ymin": 0, "xmax": 1, "ymax": 0.5}])
+    assert box == (0.5, 0, 1, 0.5)
+    assert polygon is None
+    [(box, polygon)] = parse_roi([{"polygon": [[0.2, 0.2], [0.6, 0.2], [0.2, 0.4]]}])
+    assert box == pytest.approx((0.2, 0.2, 0.6, 0.4))
+    assert [pytest.approx(p) for p in polygon] == [(0, 0), (1, 0), (0, 1)]
+    with pytest.raises(AssertionError):
+        parse_roi([{"xmin": 0.5, "ymin": 0, "xmax": 0.5, "ymax": 0.5}])
+    with pytest.raises(AssertionError):
+        parse_roi([{"polygon": [[0.2, 0.2], [0.6, 0.2]]}])
+    with pytest.raises(AssertionError):
+        parse_roi([{"polygon": [[0.2, 0.2], [1.6, 0.2], [0.2, 0.4]]}])
+
+
+def test_crop_region():
+    image = Image.new("RGB", (200, 100), color="white")
+    region = crop_region(image=image, box=(0.5, 0, 1, 0.5))
+    assert region.size == (100, 50)
+    # keep the original resolution
+    assert region.getpixel((0, 0)) == (255, 255, 255)
+    [(box, polygon)] = parse_roi([{"polygon": [[0.5, 0], [1, 0], [0.5, 0.5]]}])
+    region = crop_region(image=image, box=box, polygon=polygon)
+    assert region.size == (100, 50)
+    assert region.getpixel((5, 5)) == (255, 255, 255)
+    # outside of the polygon
+    assert region.getpixel((95, 45)) == (0, 0, 0)
+    assert image.getpixel((195, 45)) == (255, 255, 255)
+
+
+def test_map_box_from_region():
+    box = map_box_from_region(box=(0, 0.5, 1, 1), region_box=(0.5, 0, 1, 0.5))
+    assert box == (0.5, 0.25, 1, 0.5)
+
+
+def test_tile_boxes():
+    tiles = tile_boxes(size=(1000, 500), tile_size=300, overlap=0.25)
+    xs = sorted({x0 for x0, _, _, _ in tiles})
+    ys = sorted({y0 for _, y0, _, _ in tiles})
+    assert xs == [0, 175, 350, 525, 700]
+    assert ys == [0, 200]
+    assert len(tiles) == 10
+    for x0, y0, x1, y1 in tiles:
+        assert x1 - x0 == 300 and y1 - y0 == 300
+        assert x1 <= 1000 and y1 <= 500
+    # neighbors overlap by at least a quarter of a tile
+    assert all(b - a <= 225 for a, b in zip(xs, xs[1:]))
+    assert tile_boxes(size=(200, 100), tile_size=300, overlap=0.25) == [
+        (0, 0, 200, 100)
+    ]
+
+
+def test_non_max_suppression():
+    boxes = np.array(
+        [
+            [0, 0, 0.5, 0.5],
+            [0.02, 0, 0.52, 0.5],
+            [0.6, 0.6, 1, 1],
+            [0, 0, 0.5, 0.5],
+        ]
+    )
+    scores = np.array([0.7, 0.9, 0.8, 0.6])
+    labels = np.array(["person", "person", "person", "car"])
+    keep = non_max_suppression(boxes=boxes, scores=scores, labels=labels)
+    assert keep == [1, 2, 3]
+    keep = non_max_suppression(boxes=boxes, scores=scores)
+    assert keep == [1, 2]
+    keep = non_max_suppression(boxes=boxes, scores=scores, iou_threshold=0.99)
+    # identical boxes
+    assert keep == [1, 2, 0]
+
+
+def _classifier_model():
+    """TFDetectionModel with a small quantized model that ships with the repo."""
+    _dir = os.path.dirname(os.path.abspath(__file__))
+    models_dir = os.path.join(_dir, "..", "..", "..", "ai_models")
+    return TFDetectionModel(
+        model={"tflite": os.path.join(models_dir, "mobilenet_v2_1.0_224_quant.tflite")},
+        labels=os.path.join(models_dir, "imagenet_labels.txt"),
+    )
+
+
+def test_thumbnail_size():
+    for size, desired_size in (
+        ((1280, 720), (300, 300)),
+        ((720, 1280), (300, 300)),
+        ((1001, 333), (224, 224)),
+        ((200, 100), (300, 300)),
+        ((400, 100), (300, 300)),
+    ):
+        image = Image.new("RGB", size)
+        image.thumbnail(desired_size)
+        assert thumbnail_size(size, desired_size) == image.size
+
+
+def test_prepare_input_tensor():
+    model = _classifier_model()
+    image = Image.new("RGB", (640, 480), color=(10, 20, 30))
+    input_data, thumbnail = model.prepare_input_tensor(image=image)
+    assert thumbnail.size == (224, 168)
+    expected = np.expand_dims(
+        TFDetectionModel.resize_to_input_tensor(image=image, desired_size=(224, 224))[
+            0
+        ],
+        axis=0,
+    )
+    assert input_data.shape == expected.shape
+    assert input_data.dtype == expected.dtype
+    assert np.array_equal(input_data, expected)
+    # a smaller image of a different size clears the previous padding
+    small = Image.new("L", (100, 50), color=255)
+    input_data2, thumbnail = model.prepare_input_tensor(image=small)
+    assert input_data2 is input_data
+    # images that fit are not copied
+    assert thumbnail.size == (100, 50)
+    assert input_data[0, :50, :100].min() == 255
+    assert input_data[0, 50:, :].max() == 0
+    assert input_data[0, :, 100:].max() == 0
+    other, _ = model.prepare_input_tensor(image=image, buffer_index=1)
+    assert other is not input_data
+
+
+def test_prepare_input_tensor_allocations():
+    """Reusing the input tensor allocates less than the tensor size per frame."""
+    model = _classifier_model()
+    # wide image, so the resized image is much smaller than the tensor
+    image = Image.new("RGB", (1280, 320), color=(10, 20, 30))
+    input_data, _ = model.prepare_input_tensor(image=image)
+
+    def peak_allocation(preprocess):
+        tracemalloc.start()
+        try:
+            for _ in range(5):
+                preprocess()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return peak
+
+    def legacy_preprocess():
+        new_im, _ = TFDetectionModel.resize_to_input_tensor(
+            image=image, desired_size=(224, 224)
+        )
+        return np.expand_dims(new_im, axis=0)
+
+    reused_peak = peak_allocation(lambda: model.prepare_input_tensor(image=image))
+    legacy_peak = peak_allocation(legacy_preprocess)
+    print(f"peak allocation reused: {reused_peak} bytes, legacy: {legacy_peak} bytes")
+    assert reused_peak < input_data.nbytes
+    assert legacy_peak >= input_data.nbytes
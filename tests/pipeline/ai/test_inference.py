@@ -1,7 +1,14 @@
+import gc
 import os
+import queue
+import threading
+import weakref
+from concurrent.futures import Future
 
+import numpy as np
 import pytest
-from ambianic.pipeline.ai.inference import TFInferenceEngine
+from ambianic.pipeline.ai import inference
+from ambianic.pipeline.ai.inference import TFInferenceEngine, _InferenceWorker
 
 
 def test_inference_init_no_params():
@@ -76,3 +83,287 @@ def test_inference_init_other_params():
     assert tf_engine.top_k == 678
     assert tf_engine.is_quantized
     assert tf_engine._model_labels_path == _good_labels()
+
+
+def _classification_model():
+    _dir = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(
+        _dir, "..", "..", "..", "ai_models", "mobilenet_v2_1.0_224_quant.tflite"
+    )
+    return path
+
+
+def _classification_labels():
+    _dir = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(_dir, "..", "..", "..", "ai_models", "imagenet_labels.txt")
+    return path
+
+
+def _infer(tf_engine, value):
+    input_details = tf_engine.input_details[0]
+    input_data = np.full(input_details["shape"], value, dtype=input_details["dtype"])
+    tf_engine.set_tensor(input_details["index"], input_data)
+    tf_engine.infer()
+    return tf_engine.get_tensor(tf_engine.output_details[0]["index"])
+
+
+def test_engines_share_interpreter():
+    model = {"tflite": _classification_model()}
+    tf_engine1 = TFInferenceEngine(model=model, labels=_classification_labels())
+    tf_engine2 = TFInferenceEngine(
+        model=model, labels=_classification_labels(), top_k=1
+    )
+    assert tf_engine1._tf_interpreter is tf_engine2._tf_interpreter
+    tf_engine3 = TFInferenceEngine(
+        model=model, labels=_classification_labels(), shared=False
+    )
+    assert tf_engine3._tf_interpreter is not tf_engine1._tf_interpreter
+    # engines keep their own input and output tensors
+    out_black = _infer(tf_engine1, 0)
+    out_white = _infer(tf_engine2, 255)
+    assert np.array_equal(
+        tf_engine1.get_tensor(tf_engine1.output_details[0]["index"]), out_black
+    )
+    assert np.array_equal(_infer(tf_engine3, 255), out_white)
+    assert not np.array_equal(out_black, out_white)
+
+
+def test_shared_interpreter_concurrent_requests():
+    model = {"tflite": _classification_model()}
+    tf_engine = TFInferenceEngine(model=model, labels=_classification_labels())
+    expected = {value: _infer(tf_engine, value) for value in (0, 128, 255)}
+    engines = [
+        TFInferenceEngine(model=model, labels=_classification_labels())
+        for _ in range(3)
+    ]
+    errors = []
+
+    def _run(engine, value):
+        for _ in range(10):
+            if not np.array_equal(_infer(engine, value), expected[value]):
+                errors.append(value)
+
+    threads = [
+        threading.Thread(target=_run, args=(engine, value))
+        for engine, value in zip(engines, expected.keys())
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=60)
+    assert not errors
+
+
+def test_shared_interpreter_released():
+    model = {"tflite": _classification_model()}
+    tf_engine = TFInferenceEngine(model=model, labels=_classification_labels())
+    shared = weakref.ref(tf_engine._tf_interpreter)
+    worker = tf_engine._tf_interpreter._worker
+    # still in use
+    inference.release_unused_interpreters()
+    assert shared() is not None
+    del tf_engine
+    gc.collect()
+    # kept loaded for the next pipeline restart
+    assert shared() is not None
+    assert inference.release_unused_interpreters() >= 1
+    assert shared() is None
+    worker.join(timeout=10)
+    assert not worker.is_alive()
+
+
+def test_shared_interpreter_survives_restart():
+    model = {"tflite": _classification_model()}
+    tf_engine = TFInferenceEngine(model=model, labels=_classification_labels())
+    shared = tf_engine._tf_interpreter
+    # pipelines are torn down before the new ones load
+    del tf_engine
+    gc.collect()
+    tf_engine = TFInferenceEngine(model=model, labels=_classification_labels())
+    assert tf_engine._tf_interpreter is shared
+    inference.release_unused_interpreters()
+    assert (
+        TFInferenceEngine(model=model, labels=_classification_labels())._tf_interpreter
+        is shared
+    )
+
+
+def test_shared_interpreter_reloads_changed_model(tmp_path):
+    model_path = tmp_path / "model.tflite"
+    model_path.write_bytes(open(_classification_model(), "rb").read())
+    model = {"tflite": str(model_path)}
+    tf_engine1 = TFInferenceEngine(model=model, labels=_classification_labels())
+    tf_engine2 = TFInferenceEngine(model=model, labels=_classification_labels())
+    assert tf_engine1._tf_interpreter is tf_engine2._tf_interpreter
+    stat = os.stat(model_path)
+    os.utime(model_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    tf_engine3 = TFInferenceEngine(model=model, labels=_classification_labels())
+    assert tf_engine3._tf_interpreter is not tf_engine1._tf_interpreter
+    # engines loaded before the change keep working
+    assert _infer(tf_engine1, 0).shape == _infer(tf_engine3, 0).shape
+
+
+def test_warm_up():
+    tf_interpreter = _TestBatchInterpreter()
+    inference._warm_up(tf_interpreter, "test")
+    assert tf_interpreter.invoke_count == 1
+    assert not tf_interpreter.tensor.any()
+
+
+class _TestBatchInterpreter:
+    """Interpreter that doubles its input and counts invocations."""
+
+    def __init__(self, batchable=True):
+        self.batchable = batchable
+        self.batch_size = 1
+        self.invoke_count = 0
+        self.tensor = None
+
+    def get_input_details(self):
+        return [{"index": 0, "shape": np.array([1, 2, 2, 3]), "dtype": np.uint8}]
+
+    def resize_tensor_input(self, index, shape):
+        self.batch_size = shape[0]
+
+    def allocate_tensors(self):
+        if self.batch_size > 1 and not self.batchable:
+            raise RuntimeError("Batch size is fixed.")
+
+    def set_tensor(self, index, tensor_data):
+        assert tensor_data.shape[0] == self.batch_size
+        self.tensor = tensor_data
+
+    def invoke(self):
+        self.invoke_count += 1
+
+    def get_tensor(self, index):
+        return self.tensor * 2
+
+
+def _batch_requests(count=None, batch_window=None):
+    requests = queue.Queue()
+    futures = []
+    for value in range(count):
+        future = Future()
+        futures.append(future)
+        inputs = {0: np.full((1, 2, 2, 3), value)}
+        requests.put((inputs, [1], future, batch_window))
+    requests.put(None)
+    return requests, futures
+
+
+def test_batched_inference():
+    tf_interpreter = _TestBatchInterpreter()
+    requests, futures = _batch_requests(count=3, batch_window=1)
+    _InferenceWorker(tf_interpreter=tf_interpreter, requests=requests).serve()
+    assert tf_interpreter.invoke_count == 1
+    for value, future in enumerate(futures):
+        assert np.array_equal(future.result()[1], np.full((1, 2, 2, 3), value * 2))
+
+
+def test_batched_inference_not_supported():
+    tf_interpreter = _TestBatchInterpreter(batchable=False)
+    requests, futures = _batch_requests(count=3, batch_window=1)
+    _InferenceWorker(tf_interpreter=tf_interpreter, requests=requests).serve()
+    assert tf_interpreter.invoke_count == 3
+    assert tf_interpreter.batch_size == 1
+    for value, future in enumerate(futures):
+        assert np.array_equal(future.result()[1], np.full((1, 2, 2, 3), value * 2))
+
+
+def test_no_batch_window():
+    tf_interpreter = _TestBatchInterpreter()
+    requests, futures = _batch_requests(count=3, batch_window=0)
+    _InferenceWorker(tf_interpreter=tf_interpreter, requests=requests).serve()
+    assert tf_interpreter.invoke_count == 3
+    assert all(future.done() for future in futures)
+
+
+class _TestFailingInterpreter(_TestBatchInterpreter):
+    """Interpreter that fails with an unexpected error until told otherwise."""
+
+    def __init__(self):
+        super().__init__()
+        self.fail = True
+
+    def invoke(self):
+        super().invoke()
+        if self.fail:
+            raise TypeError("Unexpected input type.")
+
+
+def test_invoke_error_resolves_futures():
+    tf_interpreter = _TestFailingInterpreter()
+    requests = queue.Queue()
+    futures = [Future() for _ in range(3)]
+    # queued before the worker starts, so that they run as one batch
+    for value, future in enumerate(futures):
+        requests.put(({0: np.full((1, 2, 2, 3), value)}, [1], future, 1))
+    worker = threading.Thread(
+        target=_InferenceWorker(tf_interpreter=tf_interpreter, requests=requests).serve,
+        daemon=True,
+    )
+    worker.start()
+    for future in futures:
+        with pytest.raises(TypeError):
+            future.result(timeout=10)
+    assert tf_interpreter.invoke_count == 1
+    # the worker keeps serving new requests
+    tf_interpreter.fail = False
+    future = Future()
+    requests.put(({0: np.full((1, 2, 2, 3), 1)}, [1], future, None))
+    assert np.array_equal(future.result(timeout=10)[1], np.full((1, 2, 2, 3), 2))
+    requests.put(None)
+    worker.join(timeout=10)
+    assert not worker.is_alive()
+
+
+def test_engine_batch_window_real_model():
+    # the classification model has a fixed batch size,
+    # batched requests fall back to one frame at a time
+    model = {"tflite": _classification_model()}
+    engines = [
+        TFInferenceEngine(
+            model=model, labels=_classification_labels(), batch_window_ms=50
+        )
+        for _ in range(3)
+    ]
+    expected = _infer(
+        TFInferenceEngine(model=model, labels=_classification_labels(), shared=False),
+        128,
+    )
+    results = []
+    threads = [
+        threading.Thread(target=lambda e=engine: results.append(_infer(e, 128)))
+        for engine in engines
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=60)
+    assert len(results) == 3
+    for result in results:
+        assert np.array_equal(result, expected)
+
+
+def test_infer_batch():
+    model = {"tflite": _classification_model()}
+    tf_engine = TFInferenceEngine(model=model, labels=_classification_labels())
+    input_details = tf_engine.input_details[0]
+    output_index = tf_engine.output_details[0]["index"]
+    expected = [_infer(tf_engine, value) for value in (0, 255)]
+    outputs = tf_engine.infer_batch(
+        [
+            {
+                input_details["index"]: np.full(
+                    input_details["shape"], value, dtype=input_details["dtype"]
+                )
+            }
+            for value in (0, 255)
+        ]
+    )
+    assert len(outputs) == 2
+    for output, expected_output in zip(outputs, expected):
+        assert np.array_equal(output[output_index], expected_output)
+    # the engine current output is not affected
+    assert np.array_equal(tf_engine.get_tensor(output_index), expected[1])
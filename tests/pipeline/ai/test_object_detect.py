@@ -1,6 +1,8 @@
 """Test object detection pipe element."""
 import os
+import time
 
+import pytest
 from ambianic.pipeline import PipeElement
 from ambianic.pipeline.ai.object_detect import ObjectDetector
 from PIL import Image
@@ -27,6 +29,12 @@ def _object_detect_config():
     return config
 
 
+requires_ssd_model = pytest.mark.skipif(
+    not os.path.exists(_object_detect_config()["model"]["tflite"]),
+    reason="SSD object detection model is not available",
+)
+
+
 def _get_image(file_name=None):
     assert file_name
     _dir = os.path.dirname(os.path.abspath(__file__))
@@ -385,3 +393,154 @@ def test_one_label_not_in_picture():
     img = _get_image(file_name="person-couch.jpg")
     object_detector.receive_next_sample(image=img)
     assert not result
+
+
+@requires_ssd_model
+def test_roi():
+    """Expect boxes detected in a region to map back to the whole image."""
+    config = _object_detect_config()
+    result = None
+    thumbnail = None
+
+    def sample_callback(image=None, inference_result=None, **kwargs):
+        nonlocal result, thumbnail
+        result = inference_result
+        thumbnail = kwargs["thumbnail"]
+
+    img = _get_image(file_name="person.jpg")
+    object_detector = ObjectDetector(**config)
+    output = _OutPipeElement(sample_callback=sample_callback)
+    object_detector.connect_to_next_element(output)
+    object_detector.receive_next_sample(image=img)
+    [full_frame_person] = result
+    # a region around the person, padded by the background on the left
+    box = full_frame_person["box"]
+    xmin = max(0, box["xmin"] - 0.2)
+    config["roi"] = [{"xmin": xmin, "ymin": 0, "xmax": 1, "ymax": 1}]
+    object_detector = ObjectDetector(**config)
+    output = _OutPipeElement(sample_callback=sample_callback)
+    object_detector.connect_to_next_element(output)
+    object_detector.receive_next_sample(image=img)
+    [person] = result
+    assert person["label"] == "person"
+    assert person["box"]["xmin"] >= xmin
+    assert abs(person["box"]["xmin"] - box["xmin"]) < 0.1
+    assert abs(person["box"]["xmax"] - box["xmax"]) < 0.1
+    # the thumbnail shows the whole image
+    assert thumbnail.size[0] / thumbnail.size[1] == pytest.approx(
+        img.size[0] / img.size[1], rel=0.02
+    )
+
+
+@requires_ssd_model
+def test_roi_excludes_object():
+    """Expect no detections outside of the regions of interest."""
+    config = _object_detect_config()
+    result = None
+
+    def sample_callback(image=None, inference_result=None, **kwargs):
+        nonlocal result
+        result = inference_result
+
+    img = _get_image(file_name="person.jpg")
+    object_detector = ObjectDetector(**config)
+    output = _OutPipeElement(sample_callback=sample_callback)
+    object_detector.connect_to_next_element(output)
+    object_detector.receive_next_sample(image=img)
+    [person] = result
+    box = person["box"]
+    # two small regions in the corners away from the person
+    regions = []
+    if box["xmin"] > 0.1:
+        regions.append({"xmin": 0, "ymin": 0, "xmax": box["xmin"], "ymax": 0.3})
+    if box["xmax"] < 0.9:
+        regions.append({"xmin": box["xmax"], "ymin": 0, "xmax": 1, "ymax": 0.3})
+    config["roi"] = regions
+    object_detector = ObjectDetector(**config)
+    output = _OutPipeElement(sample_callback=sample_callback)
+    object_detector.connect_to_next_element(output)
+    object_detector.receive_next_sample(image=img)
+    assert not result
+
+
+def _detect_persons(config=None, images=None, runs=3):
+    """Return person detections per image and mean latency per image."""
+    object_detector = ObjectDetector(**config)
+    persons = []
+    start = time.monotonic()
+    for _ in range(runs):
+        persons = []
+        for img in images:
+            _, inference_result = object_detector.detect(image=img)
+            persons.append([r for r in inference_result if r[0] == "person"])
+    latency = (time.monotonic() - start) / (runs * len(images))
+    return persons, latency
+
+
+def _distant_person_image():
+    """Person far away in a high resolution frame."""
+    person = _get_image(file_name="person.jpg").convert("RGB")
+    frame = _get_image(file_name="background.jpg").convert("RGB")
+    frame = frame.resize((2400, 1600))
+    person.thumbnail((240, 240))
+    frame.paste(person, (1500, 900))
+    return frame
+
+
+@requires_ssd_model
+def test_tiling():
+    """Expect tiling to find a distant person in a high resolution frame."""
+    config = _object_detect_config()
+    config["tiling"] = {"tile_size": 600}
+    [persons], _ = _detect_persons(config=config, images=[_distant_person_image()])
+    assert persons
+    _, _, (x0, y0, x1, y1) = persons[0]
+    assert 0.6 < (x0 + x1) / 2 < 0.7
+    assert 0.55 < (y0 + y1) / 2 < 0.7
+
+
+@requires_ssd_model
+def test_tiling_benchmark():
+    """Compare detections and latency with and without tiling."""
+    images = [
+        _distant_person_image(),
+        _get_image(file_name="person.jpg"),
+        _get_image(file_name="person-couch.jpg"),
+        _get_image(file_name="person2-face1.jpg"),
+        _get_image(file_name="background.jpg"),
+    ]
+    config = _object_detect_config()
+    results = {"full frame": _detect_persons(config=config, images=images)}
+    for tile_size in (600, 300):
+        config = _object_detect_config()
+        config["tiling"] = {"tile_size": tile_size}
+        results[f"tiles of {tile_size}px"] = _detect_persons(
+            config=config, images=images
+        )
+    for name, (persons, latency) in results.items():
+        print(
+            f"{name}: persons per image {[len(p) for p in persons]}, "
+            f"{latency * 1000:.1f} ms per image"
+        )
+    full_frame_persons, full_frame_latency = results["full frame"]
+    tiled_persons, tiled_latency = results["tiles of 600px"]
+    # the distant person is only found in tiles
+    assert tiled_persons[0]
+    # people found in the whole frame are still found
+    for full, tiled in zip(full_frame_persons, tiled_persons):
+        assert len(tiled) >= len(full)
+    # no duplicates of the same person from overlapping tiles
+    assert len(tiled_persons[1]) == 1
+    assert tiled_latency > full_frame_latency
+
+
+@requires_ssd_model
+def test_detect():
+    object_detector = ObjectDetector(**_object_detect_config())
+    thumbnail, inference_result = object_detector.detect(
+        image=_get_image(file_name="person.jpg")
+    )
+    assert isinstance(thumbnail, Image.Image)
+    [(label, confidence, box)] = inference_result
+    assert label == "person"
+    assert confidence > 0.9
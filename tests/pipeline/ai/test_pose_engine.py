@@ -0,0 +1,212 @@
+"""Test cases for PoseEngine keypoint decoding."""
+import timeit
+
+import numpy as np
+import pytest
+from ambianic.pipeline.ai.pose_engine import (
+    KEYPOINTS,
+    ROTATE_0,
+    ROTATE_90,
+    ROTATE_270,
+    Pose,
+    PoseEngine,
+)
+from ambianic.pipeline.pipeline_event import PipelineContext
+from PIL import Image
+
+
+class _TestTFEngine:
+    confidence_threshold = 0.6
+    input_details = [
+        {"index": 0, "shape": np.array([1, 257, 257, 3]), "dtype": np.uint8}
+    ]
+
+
+def _pose_engine():
+    return PoseEngine(tfengine=_TestTFEngine())
+
+
+def _model_output(seed=0):
+    rng = np.random.default_rng(seed)
+    heatmap = rng.normal(size=(9, 9, len(KEYPOINTS))).astype(np.float32)
+    offset = rng.normal(scale=10, size=(9, 9, 2 * len(KEYPOINTS))).astype(np.float32)
+    return heatmap, offset
+
+
+def _parse_output_loop(pose_engine, heatmap_data, offset_data, threshold):
+    """Reference implementation decoding one joint at a time."""
+    height = pose_engine._tensor_image_height
+    width = pose_engine._tensor_image_width
+    joint_num = heatmap_data.shape[-1]
+    pose_kps = np.zeros((joint_num, 4), np.float32)
+    for i in range(joint_num):
+        joint_heatmap = heatmap_data[..., i]
+        max_val_pos = np.squeeze(np.argwhere(joint_heatmap == np.max(joint_heatmap)))
+        remap_pos = np.array(max_val_pos / 8 * height, dtype=np.int32)
+        pose_kps[i, 0] = int(
+            remap_pos[0] + offset_data[max_val_pos[0], max_val_pos[1], i]
+        )
+        pose_kps[i, 1] = int(
+            remap_pos[1] + offset_data[max_val_pos[0], max_val_pos[1], i + joint_num]
+        )
+        max_prob = np.max(joint_heatmap)
+        pose_kps[i, 3] = max_prob
+        if max_prob > threshold:
+            if pose_kps[i, 0] < height and pose_kps[i, 1] < width:
+                pose_kps[i, 2] = 1
+    return pose_kps
+
+
+def test_parse_output_matches_per_joint_decoding():
+    pose_engine = _pose_engine()
+    for seed in range(20):
+        heatmap, offset = _model_output(seed)
+        expected = _parse_output_loop(pose_engine, heatmap, offset, 0.3)
+        kps = pose_engine.parse_output(heatmap, offset, 0.3)
+        assert kps.shape == (len(KEYPOINTS), 4)
+        assert np.array_equal(kps, expected)
+
+
+def test_parse_output_keypoint_out_of_image():
+    pose_engine = _pose_engine()
+    heatmap = np.zeros((9, 9, len(KEYPOINTS)), dtype=np.float32)
+    offset = np.zeros((9, 9, 2 * len(KEYPOINTS)), dtype=np.float32)
+    # joint 0 at the bottom right corner, pushed outside by the offset
+    heatmap[8, 8, 0] = 1
+    offset[8, 8, 0] = 10
+    # joint 1 in the middle
+    heatmap[4, 3, 1] = 1
+    kps = pose_engine.parse_output(heatmap, offset, 0.5)
+    assert kps[0, 0] == 267
+    assert kps[0, 1] == 257
+    assert kps[0, 2] == 0
+    assert kps[1, 0] == 128
+    assert kps[1, 1] == 96
+    assert kps[1, 2] == 1
+    assert kps[1, 3] == 1
+    # joints below threshold
+    assert not kps[2:, 2].any()
+
+
+def test_pose_keypoints_are_array_views():
+    coords = np.arange(2 * len(KEYPOINTS), dtype=np.float32).reshape(-1, 2)
+    scores = np.linspace(0, 1, len(KEYPOINTS), dtype=np.float32)
+    pose = Pose(coords, scores, 0.5)
+    assert pose.score == 0.5
+    keypoint = pose.keypoints["left hip"]
+    i = KEYPOINTS.index("left hip")
+    assert keypoint.k == "left hip"
+    assert list(keypoint.yx) == [2 * i, 2 * i + 1]
+    assert keypoint.score == scores[i]
+    assert pose.keypoints is pose.keypoints
+    keypoint.yx[0] = -1
+    assert pose.keypoint_coords[i, 0] == -1
+
+
+def test_parse_output_benchmark():
+    pose_engine = _pose_engine()
+    heatmap, offset = _model_output()
+    loop_time = min(
+        timeit.repeat(
+            lambda: _parse_output_loop(pose_engine, heatmap, offset, 0.3),
+            number=200,
+            repeat=3,
+        )
+    )
+    vectorized_time = min(
+        timeit.repeat(
+            lambda: pose_engine.parse_output(heatmap, offset, 0.3),
+            number=200,
+            repeat=3,
+        )
+    )
+    print(
+        f"parse_output per call: per joint loop {loop_time / 200 * 1e6:.1f} us, "
+        f"vectorized {vectorized_time / 200 * 1e6:.1f} us"
+    )
+    assert vectorized_time < loop_time
+
+
+class _TestMarkerTFEngine(_TestTFEngine):
+    """Places joint 0 on the brightest pixel of the input image."""
+
+    output_details = [{"index": 1}, {"index": 2}]
+
+    def __init__(self):
+        self.invoke_count = 0
+        self.batch_sizes = []
+        self._outputs = {}
+
+    def _outputs_for(self, input_data):
+        size = 257
+        py, px = np.unravel_index(np.argmax(input_data[0, ..., 0]), (size, size))
+        hy, hx = round(py * 8 / size), round(px * 8 / size)
+        heatmap = np.zeros((1, 9, 9, len(KEYPOINTS)), dtype=np.float32)
+        offset = np.zeros((1, 9, 9, 2 * len(KEYPOINTS)), dtype=np.float32)
+        heatmap[0, hy, hx, 0] = 5
+        offset[0, hy, hx, 0] = py - int(hy / 8 * size)
+        offset[0, hy, hx, len(KEYPOINTS)] = px - int(hx / 8 * size)
+        return {1: heatmap, 2: offset}
+
+    def set_tensor(self, index, tensor_data):
+        self._input = tensor_data
+
+    def infer(self):
+        self.invoke_count += 1
+        self._outputs = self._outputs_for(self._input)
+
+    def get_tensor(self, index):
+        return self._outputs[index]
+
+    def infer_batch(self, inputs_list):
+        self.batch_sizes.append(len(inputs_list))
+        return [self._outputs_for(inputs[0]) for inputs in inputs_list]
+
+
+def _context(data_dir=None):
+    # debug images are saved in the data dir
+    context = PipelineContext(unique_pipeline_name="test")
+    context.data_dir = data_dir
+    return context
+
+
+def _marker_image(x=None, y=None):
+    pixels = np.zeros((128, 257, 3), dtype=np.uint8)
+    pixels[y, x] = 255
+    return Image.fromarray(pixels)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_detect_rotated_poses(batch, tmp_path):
+    tfengine = _TestMarkerTFEngine()
+    pose_engine = PoseEngine(tfengine=tfengine, context=_context(tmp_path))
+    thumbnail, template_image = pose_engine.resize_to_input_tensor(
+        _marker_image(x=40, y=100)
+    )
+    assert thumbnail.size == (257, 128)
+    assert template_image.size == (257, 257)
+    rotations = [ROTATE_0, ROTATE_90, ROTATE_270]
+    results = pose_engine.detect_rotated_poses(
+        template_image, rotations=rotations, batch=batch
+    )
+    assert len(results) == 3
+    if batch:
+        assert tfengine.batch_sizes == [3]
+    else:
+        assert tfengine.invoke_count == 3
+    for poses, pose_score in results:
+        nose = poses[0].keypoints["nose"]
+        # coordinates are mapped back to the exact pixel of the upright image
+        assert list(nose.yx) == [40, 100]
+        assert nose.score > 0.9
+        assert pose_score == 1 / len(KEYPOINTS)
+
+
+def test_detect_poses_same_as_upright_rotation(tmp_path):
+    pose_engine = PoseEngine(tfengine=_TestMarkerTFEngine(), context=_context(tmp_path))
+    image = _marker_image(x=200, y=30)
+    poses, thumbnail, pose_score = pose_engine.detect_poses(image)
+    _, template_image = pose_engine.resize_to_input_tensor(image)
+    [(rotated_poses, rotated_score)] = pose_engine.detect_rotated_poses(template_image)
+    assert np.array_equal(poses[0].keypoint_coords, rotated_poses[0].keypoint_coords)
+    assert pose_score == rotated_score
@@ -2,11 +2,12 @@
 import logging
 import os
 import pathlib
+import queue
 import threading
 import time
 
 import pytest
-from ambianic.pipeline import PipeElement
+from ambianic.pipeline import PipeElement, metrics
 from ambianic.pipeline.ai.object_detect import ObjectDetector
 from ambianic.pipeline.avsource import picam
 from ambianic.pipeline.avsource.av_element import MIN_HEALING_INTERVAL, AVSourceElement
@@ -45,6 +46,95 @@ def test_no_config():
         AVSourceElement()
 
 
+def test_bad_transport_config():
+    with pytest.raises(AssertionError):
+        AVSourceElement(uri="rstp://blah", type="video", transport="carrier_pigeon")
+
+
+def test_shared_memory_sample():
+    avsource = AVSourceElement(
+        uri="rstp://blah", type="video", transport="shared_memory"
+    )
+    sample_image = None
+
+    def sample_callback(image=None, **kwargs):
+        nonlocal sample_image
+        sample_image = image
+
+    avsource.connect_to_next_element(_OutPipeElement(sample_callback=sample_callback))
+    avsource._gst_out_queue = avsource._get_sample_queue()
+    width, height = 4, 2
+    avsource._gst_out_queue.put(
+        {
+            "type": "image",
+            "format": "RGB",
+            "width": width,
+            "height": height,
+            "bytes": bytes([10, 20, 30] * width * height),
+        }
+    )
+    avsource._on_new_sample(sample=avsource._gst_out_queue.get(timeout=5))
+    assert sample_image.size == (width, height)
+    assert sample_image.getpixel((0, 0)) == (10, 20, 30)
+    # slot is released as soon as the frame is read
+    assert not avsource._gst_out_queue.full()
+    avsource._close_sample_queue()
+
+
+def test_dropped_samples():
+    """Samples dropped by the gst process are reported by the source."""
+    avsource = AVSourceElement(uri="rstp://blah", type="video")
+    avsource.connect_to_next_element(_OutPipeElement(sample_callback=lambda **s: s))
+    sample = {
+        "type": "image",
+        "format": "RGB",
+        "width": 1,
+        "height": 1,
+        "bytes": bytes([10, 20, 30]),
+    }
+    assert avsource.dropped_samples == 0
+    avsource._on_new_sample(sample={**sample, "dropped": 3})
+    assert avsource.dropped_samples == 3
+
+
+class _TestPipeline:
+    def __init__(self, name=None, elements=None):
+        self.name = name
+        self.elements = elements
+
+    def healthcheck(self):
+        return time.monotonic(), True
+
+
+def test_decoder_metrics():
+    """The decoder chosen by the gst process is reported in the metrics."""
+    avsource = AVSourceElement(uri="rstp://blah", type="video", element_name="cam")
+    avsource.connect_to_next_element(_OutPipeElement(sample_callback=lambda **s: s))
+    sample = {
+        "type": "image",
+        "format": "RGB",
+        "width": 1,
+        "height": 1,
+        "bytes": bytes([10, 20, 30]),
+    }
+    pipeline = _TestPipeline(name="front", elements=[avsource])
+    avsource._on_new_sample(sample=sample)
+    assert "ambianic_source_decoder_info" not in metrics.render_metrics([pipeline])
+    avsource._on_new_sample(
+        sample={**sample, "decoder": "vaapih264dec", "hardware_decode": True}
+    )
+    text = metrics.render_metrics([pipeline])
+    labels = 'pipeline="front",element="cam",index="0",class="AVSourceElement"'
+    assert "# TYPE ambianic_source_decoder_info gauge" in text
+    assert (
+        f'ambianic_source_decoder_info{{{labels},decoder="vaapih264dec",'
+        'hardware_decode="true"} 1' in text
+    )
+    # health status keeps its documented shape
+    _, status = avsource.healthcheck()
+    assert status == "OK"
+
+
 def test_start_stop_dummy_source():
     avsource = _TestAVSourceElement(uri="rstp://blah", type="video")
     t = threading.Thread(
@@ -743,3 +833,66 @@ def test_gst_process_terminate():
     assert not t.is_alive()
     assert avsource._terminate_requested
     assert avsource._clean_terminate
+
+
+def test_latency_sampler_freshest_sample():
+    avsource = _TestAVSourceElement(uri="rtsp://somehost/cam", latency_budget=0.5)
+    avsource._gst_out_queue = queue.Queue()
+    for n in range(1, 4):
+        avsource._gst_out_queue.put({"n": n})
+    sample = avsource._latest_sample({"n": 0})
+    assert sample == {"n": 3}
+    assert avsource.dropped_samples == 3
+    assert avsource._latest_sample(sample) is sample
+
+
+def test_latency_sampler_frame_rate():
+    avsource = _TestAVSourceElement(
+        uri="rtsp://somehost/cam", fps=10, latency_budget=0.5
+    )
+    assert avsource._max_rate.value == 10
+    assert avsource.metrics.gauges["source_target_frame_rate"] == 10
+    assert avsource.metrics.gauges["source_latency_budget_seconds"] == 0.5
+    now = time.monotonic()
+    # the pipeline took 0.25 seconds for a frame delivered 0.3 seconds ago
+    avsource._on_sample_processed({"time": now - 0.3}, start_time=now - 0.25)
+    assert avsource._max_rate.value == pytest.approx(4, rel=0.05)
+    assert avsource.metrics.gauges["source_frame_rate"] == avsource._max_rate.value
+    assert avsource.metrics.gauges["source_frame_latency_seconds"] >= 0.3
+    # turned off by default
+    avsource = _TestAVSourceElement(uri="rtsp://somehost/cam", fps=10)
+    assert avsource._max_rate is None
+    assert not avsource.metrics.gauges
+
+
+def test_latency_sampler_off_with_worker_elements():
+    avsource = _TestAVSourceElement(
+        uri="rtsp://somehost/cam", fps=10, latency_budget=0.5
+    )
+    detect = PipeElement()
+    save = PipeElement(worker={"queue_size": 1})
+    avsource.connect_to_next_element(detect)
+    detect.connect_to_next_element(save)
+    avsource._check_latency_sampler()
+    # processing time of the save element would not be measured
+    assert avsource._sampler is None
+    assert avsource._max_rate is None
+    assert not avsource.metrics.gauges
+    # on as long as all elements run in the source thread
+    avsource = _TestAVSourceElement(
+        uri="rtsp://somehost/cam", fps=10, latency_budget=0.5
+    )
+    avsource.connect_to_next_element(PipeElement())
+    avsource._check_latency_sampler()
+    assert avsource._sampler is not None
+
+
+def test_capture_latency():
+    avsource = _TestAVSourceElement(uri="rtsp://somehost/cam")
+    latency = avsource.metrics.histograms["source_capture_latency_seconds"]
+    now = time.monotonic()
+    avsource._on_sample_processed({"capture_time": now - 0.3}, start_time=now)
+    avsource._on_sample_processed({"capture_time": None}, start_time=now)
+    _, latency_sum, count = latency.snapshot()
+    assert count == 1
+    assert latency_sum >= 0.3
@@ -3,13 +3,19 @@ import logging
 import multiprocessing
 import os
 import pathlib
+import queue
+import resource
 import signal
 import sys
 import threading
+import time
+from collections import OrderedDict
 
 import gi
 import pytest
+from ambianic.pipeline.avsource import gst_process
 from ambianic.pipeline.avsource.gst_process import GstService
+from ambianic.pipeline.avsource.mailbox import FrameMailbox
 from PIL import Image
 
 if "gi" in sys.modules:
@@ -289,7 +295,7 @@ def test_gst_debug_level():
 
 class _TestGstService6(GstService):
     def __init__(self):
-        pass
+        self._dropped_samples = 0
 
 
 class _TestSink6:
@@ -307,6 +313,7 @@ def test2_on_new_sample_out_queue_full():
     result = gst._on_new_sample_out_queue_full(sink)
     assert sink._last_command == "pull-sample"
     assert result == Gst.FlowReturn.OK
+    assert gst._dropped_samples == 1
 
 
 class _TestGstService7(GstService):
@@ -345,6 +352,8 @@ def test_service_terminate_no_stop_signal():
 class _TestGstService9(GstService):
     def __init__(self):
         self._out_queue = multiprocessing.Queue(1)
+        self._dropped_samples = 0
+        self.gst_pipeline = None
 
 
 class _TestMapInfo:
@@ -482,3 +491,377 @@ def test_dev_video_source():
 
     pipeline = create_gst(None)
     assert "raw" in pipeline
+
+
+def _pipeline_args(**source_conf):
+    gst = GstService(
+        source_conf=source_conf,
+        out_queue=multiprocessing.Queue(1),
+        stop_signal=multiprocessing.Event(),
+        eos_reached=multiprocessing.Event(),
+    )
+    return gst._get_pipeline_args()
+
+
+def test_default_source_caps():
+    pipeline = _pipeline_args(uri="rtsp://somehost/cam")
+    assert "videorate" not in pipeline
+    assert "videoscale" not in pipeline
+    assert "video/x-raw,format=RGB\n" in pipeline
+
+
+def test_source_fps_caps():
+    pipeline = _pipeline_args(uri="rtsp://somehost/cam", fps=5)
+    assert "videorate drop-only=true ! videoconvert" in pipeline
+    assert "video/x-raw,format=RGB,framerate=5/1" in pipeline
+    assert "videoscale" not in pipeline
+    pipeline = _pipeline_args(uri="rtsp://somehost/cam", fps=0.5)
+    assert "framerate=1/2" in pipeline
+
+
+def test_source_size_caps():
+    pipeline = _pipeline_args(uri="rtsp://somehost/cam", width=640, height=480)
+    assert "videoscale ! videoconvert" in pipeline
+    assert "format=RGB,width=640,height=480,pixel-aspect-ratio=1/1" in pipeline
+    # height follows the source aspect ratio
+    pipeline = _pipeline_args(uri="rtsp://somehost/cam", width=640)
+    assert "format=RGB,width=640,pixel-aspect-ratio=1/1" in pipeline
+    assert "height=" not in pipeline
+
+
+def test_source_max_size_caps():
+    pipeline = _pipeline_args(
+        uri="rtsp://somehost/cam", max_width=300, max_height=300, fps=2
+    )
+    assert "videorate drop-only=true ! videoscale ! videoconvert" in pipeline
+    assert (
+        "format=RGB,framerate=2/1,width=(int)[1,300],height=(int)[1,300]"
+        ",pixel-aspect-ratio=1/1"
+    ) in pipeline
+    # explicit size takes precedence over the model size
+    pipeline = _pipeline_args(
+        uri="rtsp://somehost/cam", max_width=300, max_height=300, width=640
+    )
+    assert "(int)[1,300]" not in pipeline
+    assert "width=640" in pipeline
+
+
+def _run_video_source(**source_conf):
+    """Stream the test video through a gst process until EOS.
+
+    Returns the number of frames received, their total size in bytes and
+    the CPU seconds spent in the gst process and in this process.
+    """
+    dir_name = os.path.dirname(os.path.abspath(__file__))
+    source_file = os.path.join(dir_name, "test2-cam-person1.mkv")
+    source_uri = pathlib.Path(os.path.abspath(source_file)).as_uri()
+    source_conf.update({"uri": source_uri, "type": "video"})
+    out_queue = multiprocessing.Queue(3)
+    stop_signal = multiprocessing.Event()
+    eos_reached = multiprocessing.Event()
+    children_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_cpu = resource.getrusage(resource.RUSAGE_SELF)
+    gst = multiprocessing.Process(
+        target=gst_process.start_gst_service,
+        kwargs={
+            "source_conf": source_conf,
+            "out_queue": out_queue,
+            "stop_signal": stop_signal,
+            "eos_reached": eos_reached,
+        },
+        daemon=True,
+    )
+    gst.start()
+    frames = 0
+    nbytes = 0
+    while not (eos_reached.is_set() and out_queue.empty()):
+        try:
+            sample = out_queue.get(timeout=1)
+        except queue.Empty:
+            if not gst.is_alive():
+                break
+            continue
+        Image.frombytes(
+            sample["format"], (sample["width"], sample["height"]), sample["bytes"]
+        )
+        frames += 1
+        nbytes += len(sample["bytes"])
+    stop_signal.set()
+    gst.join(timeout=30)
+    assert not gst.is_alive()
+    children_cpu_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+    gst_cpu = (children_cpu_end.ru_utime + children_cpu_end.ru_stime) - (
+        children_cpu.ru_utime + children_cpu.ru_stime
+    )
+    consumer_cpu = (self_cpu_end.ru_utime + self_cpu_end.ru_stime) - (
+        self_cpu.ru_utime + self_cpu.ru_stime
+    )
+    return frames, nbytes, gst_cpu, consumer_cpu
+
+
+def test_source_caps_cpu_benchmark():
+    """Scaling and dropping frames in gstreamer saves CPU per camera."""
+    full = _run_video_source()
+    scaled = _run_video_source(fps=5, max_width=300, max_height=300)
+    for name, (frames, nbytes, gst_cpu, consumer_cpu) in (
+        ("full resolution", full),
+        ("fps=5, scaled to 300x300", scaled),
+    ):
+        print(
+            f"{name}: {frames} frames, {nbytes / 2**20:.1f} MB, "
+            f"gst process CPU {gst_cpu:.2f} s, consumer CPU {consumer_cpu:.2f} s"
+        )
+    assert full[0] > 0 and scaled[0] > 0
+    assert scaled[1] / scaled[0] < full[1] / full[0]
+    assert scaled[2] + scaled[3] < full[2] + full[3]
+
+
+def test_jpeg_passthrough_pipeline(monkeypatch):
+    monkeypatch.setattr(
+        gst_process, "_decoder_available", lambda name: name == "jpegdec"
+    )
+    pipeline = _pipeline_args(
+        uri="/dev/video0", format="jpeg", jpeg_passthrough=True, fps=5
+    )
+    assert "videorate drop-only=true ! image/jpeg,framerate=5/1 ! tee" in pipeline
+    assert "appsink name=jpegsink" in pipeline
+    assert "jpegtee. ! jpegdec" in pipeline
+    # frames are dropped once, before the tee
+    assert pipeline.count("videorate") == 1
+    assert "video/x-raw,format=RGB\n" in pipeline
+    # not supported for other sources
+    pipeline = _pipeline_args(uri="rtsp://somehost/cam", jpeg_passthrough=True)
+    assert "jpegsink" not in pipeline
+
+
+class _TestJpegBuf(_TestBuf):
+    def __init__(self, pts=None, data=None):
+        self.pts = pts
+        self.data = data
+
+    def map(self, flag):
+        mapinfo = _TestMapInfo()
+        mapinfo.data = self.data
+        return True, mapinfo
+
+    def unmap(self, mapinfo):
+        pass
+
+
+class _TestJpegSink:
+    def __init__(self, buf=None):
+        self.buf = buf
+
+    def emit(self, command):
+        assert command == "pull-sample"
+        sample = _TestGstSample()
+        sample.get_buffer = lambda: self.buf
+        return sample
+
+
+def test_jpeg_passthrough_sample():
+    gst = _TestGstService9()
+    gst._jpeg_frames = OrderedDict()
+    gst._jpeg_frames_lock = threading.Lock()
+    for pts in range(6):
+        buf = _TestJpegBuf(pts=pts, data=memoryview(b"jpeg %d" % pts))
+        gst._on_new_jpeg_sample(_TestJpegSink(buf))
+    # only the latest frames are kept
+    assert list(gst._jpeg_frames) == [2, 3, 4, 5]
+    gst._on_new_sample(_TestJpegSink(_TestJpegBuf(pts=3, data=b"rgb")))
+    sample = gst._out_queue.get(timeout=1)
+    assert sample["bytes"] == b"rgb"
+    assert sample["jpeg"] == b"jpeg 3"
+    # older frames are discarded
+    assert list(gst._jpeg_frames) == [4, 5]
+    gst._on_new_sample(_TestJpegSink(_TestJpegBuf(pts=9, data=b"rgb")))
+    sample = gst._out_queue.get(timeout=1)
+    assert "jpeg" not in sample
+
+
+def _v4l2_decoder(monkeypatch, available=(), **source_conf):
+    monkeypatch.setattr(
+        gst_process, "_decoder_available", lambda name: name in available
+    )
+    gst = GstService(
+        source_conf={"uri": "/dev/video0", **source_conf},
+        out_queue=multiprocessing.Queue(1),
+        stop_signal=multiprocessing.Event(),
+        eos_reached=multiprocessing.Event(),
+    )
+    pipeline = gst._get_pipeline_args()
+    return pipeline, gst._decoder, gst._hardware_decode
+
+
+def test_hardware_decoder_preferred(monkeypatch):
+    pipeline, decoder, hardware = _v4l2_decoder(
+        monkeypatch, available=("avdec_h264", "vaapih264dec"), format="h264"
+    )
+    assert "video/x-h264,framerate=30/1 ! h264parse ! vaapih264dec" in pipeline
+    assert decoder == "vaapih264dec"
+    assert hardware
+    pipeline, decoder, hardware = _v4l2_decoder(
+        monkeypatch, available=("jpegdec", "v4l2jpegdec"), format="jpeg"
+    )
+    assert "image/jpeg,framerate=30/1 ! v4l2jpegdec" in pipeline
+    assert hardware
+
+
+def test_software_decoder_fallback(monkeypatch):
+    pipeline, decoder, hardware = _v4l2_decoder(
+        monkeypatch, available=("avdec_h264",), format="h264"
+    )
+    assert "h264parse ! avdec_h264" in pipeline
+    assert decoder == "avdec_h264"
+    assert not hardware
+    # hardware decoding turned off
+    pipeline, decoder, hardware = _v4l2_decoder(
+        monkeypatch,
+        available=("avdec_h264", "v4l2h264dec"),
+        format="h264",
+        hardware_decode=False,
+    )
+    assert decoder == "avdec_h264"
+    assert not hardware
+    # nothing found, the default software decoder reports the error
+    pipeline, decoder, hardware = _v4l2_decoder(monkeypatch, format="jpeg")
+    assert "image/jpeg,framerate=30/1 ! jpegdec" in pipeline
+    # raw video needs no decoder
+    pipeline, decoder, hardware = _v4l2_decoder(monkeypatch)
+    assert decoder is None
+    assert not hardware
+
+
+def test_decoder_available():
+    """Probe the decoders installed on this box."""
+    assert not gst_process._decoder_available("no-such-decoder")
+    assert gst_process._decoder_available("jpegdec")
+
+
+def test_video_file_decoder_reported():
+    """uridecodebin falls back to software decoding without the hardware."""
+    dir_name = os.path.dirname(os.path.abspath(__file__))
+    source_file = os.path.join(dir_name, "test2-cam-person1.mkv")
+    source_uri = pathlib.Path(os.path.abspath(source_file)).as_uri()
+    software_decoders = [
+        name for names in gst_process.SOFTWARE_DECODERS.values() for name in names
+    ]
+    for hardware_decode in (True, False):
+        out_queue = multiprocessing.Queue(1)
+        stop_signal = multiprocessing.Event()
+        gst = multiprocessing.Process(
+            target=gst_process.start_gst_service,
+            kwargs={
+                "source_conf": {
+                    "uri": source_uri,
+                    "type": "video",
+                    "hardware_decode": hardware_decode,
+                },
+                "out_queue": out_queue,
+                "stop_signal": stop_signal,
+                "eos_reached": multiprocessing.Event(),
+            },
+            daemon=True,
+        )
+        gst.start()
+        sample = out_queue.get(timeout=30)
+        stop_signal.set()
+        gst.join(timeout=30)
+        assert sample["decoder"]
+        assert sample["hardware_decode"] == (sample["decoder"] not in software_decoders)
+        if not hardware_decode:
+            assert not sample["hardware_decode"]
+
+
+class _TestProbeInfo:
+    def __init__(self, pts=None):
+        self._buf = _TestJpegBuf(pts=pts)
+
+    def get_buffer(self):
+        return self._buf
+
+
+def test_frame_rate_probe():
+    gst = _TestGstService9()
+    gst._max_rate = multiprocessing.Value("d", 0)
+    gst._last_frame_pts = None
+
+    def probe(seconds):
+        return gst._on_frame_rate_probe(None, _TestProbeInfo(int(seconds * Gst.SECOND)))
+
+    # no limit
+    assert probe(0) == Gst.PadProbeReturn.OK
+    assert probe(0.01) == Gst.PadProbeReturn.OK
+    gst._max_rate.value = 2
+    assert probe(0.1) == Gst.PadProbeReturn.OK
+    assert probe(0.4) == Gst.PadProbeReturn.DROP
+    assert probe(0.6) == Gst.PadProbeReturn.OK
+    assert gst._dropped_samples == 1
+    # timestamps start over
+    assert probe(0.05) == Gst.PadProbeReturn.OK
+
+
+class _TestFrameSink:
+    def __init__(self, pts=None, data=None):
+        self.buf = _TestJpegBuf(pts=pts, data=data)
+
+    def emit(self, command):
+        sample = _TestGstSample()
+        sample.get_caps = lambda: _TestFrameCaps()
+        sample.get_buffer = lambda: self.buf
+        return sample
+
+
+class _TestFrameCaps:
+    def get_structure(self, index):
+        return {"width": 2, "height": 1}
+
+
+def test_on_new_sample_latest_wins():
+    gst = _TestGstService9()
+    gst._out_queue = FrameMailbox()
+    for value in range(1, 4):
+        gst._on_new_sample(_TestFrameSink(pts=value, data=bytes([value] * 6)))
+    sample = gst._out_queue.get(timeout=1)
+    assert sample["frame"].tolist() == [[[3, 3, 3], [3, 3, 3]]]
+    assert sample["pts"] == 3
+    # dropped is the running count of overwritten samples
+    assert sample["dropped"] == 2
+    assert gst._out_queue.overwritten_count == 2
+    gst._out_queue.close()
+
+
+class _TestClock:
+    def __init__(self, now=None):
+        self.now = now
+
+    def get_time(self):
+        return self.now
+
+
+class _TestPipeline:
+    def __init__(self, now=None, base_time=None):
+        self._clock = _TestClock(now)
+        self._base_time = base_time
+
+    def get_clock(self):
+        return self._clock
+
+    def get_base_time(self):
+        return self._base_time
+
+
+def test_capture_time():
+    gst = _TestGstService9()
+    gst.source = GstService.PipelineSource(source_conf={"uri": "rtsp://cam"})
+    gst.source.is_live = True
+    gst.gst_pipeline = _TestPipeline(now=12 * Gst.SECOND, base_time=10 * Gst.SECOND)
+    # the frame was captured 1.5 seconds ago
+    before = time.monotonic()
+    capture_time = gst._capture_time(pts=Gst.SECOND // 2)
+    assert before - 1.5 <= capture_time <= time.monotonic() - 1.5
+    assert gst._capture_time(pts=Gst.CLOCK_TIME_NONE) is None
+    # buffer timestamps of recorded media are not capture times
+    gst.source.is_live = False
+    assert gst._capture_time(pts=Gst.SECOND // 2) is None
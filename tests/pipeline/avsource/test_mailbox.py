@@ -0,0 +1,122 @@
+"""Test latest wins shared memory frame mailbox."""
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+from ambianic.pipeline.avsource.mailbox import FrameMailbox
+
+
+def _sample(width=4, height=2, value=7, **meta):
+    pixels = np.full((height, width, 3), value, dtype=np.uint8)
+    return {
+        "type": "image",
+        "format": "RGB",
+        "width": width,
+        "height": height,
+        "bytes": pixels.tobytes(),
+        **meta,
+    }
+
+
+def test_put_get():
+    mailbox = FrameMailbox()
+    assert mailbox.empty()
+    assert not mailbox.full()
+    mailbox.put(_sample(value=5, jpeg=b"jpeg"))
+    assert mailbox.full()
+    sample = mailbox.get(timeout=5)
+    assert mailbox.empty()
+    assert sample["width"] == 4
+    assert sample["jpeg"] == b"jpeg"
+    assert "bytes" not in sample
+    frame = sample["frame"]
+    assert frame.shape == (2, 4, 3)
+    assert np.all(frame == 5)
+    del frame
+    mailbox.release(sample)
+    assert "frame" not in sample
+    mailbox.close()
+
+
+def test_put_memoryview():
+    mailbox = FrameMailbox()
+    sample = _sample(value=3)
+    # mapped gstreamer buffers are memoryviews
+    sample["bytes"] = memoryview(np.frombuffer(sample["bytes"], dtype=np.uint8))
+    mailbox.put(sample)
+    assert np.all(mailbox.get(timeout=5)["frame"] == 3)
+    mailbox.close()
+
+
+def test_latest_wins():
+    mailbox = FrameMailbox()
+    for value in range(1, 4):
+        mailbox.put(_sample(value=value))
+    assert mailbox.overwritten_count == 2
+    latest = mailbox.get(timeout=5)
+    assert np.all(latest["frame"] == 3)
+    with pytest.raises(queue.Empty):
+        mailbox.get_nowait()
+    # the frame being read is not overwritten by new ones
+    mailbox.put(_sample(value=4))
+    mailbox.put(_sample(value=5))
+    assert np.all(latest["frame"] == 3)
+    mailbox.release(latest)
+    assert np.all(mailbox.get(timeout=5)["frame"] == 5)
+    mailbox.close()
+
+
+def test_get_timeout():
+    mailbox = FrameMailbox()
+    with pytest.raises(queue.Empty):
+        mailbox.get(timeout=0.1)
+    mailbox.close()
+
+
+def test_buffer_grows_with_sample_size():
+    mailbox = FrameMailbox()
+    mailbox.put(_sample(width=2, height=2, value=1))
+    small = mailbox.get(timeout=5)
+    mailbox.release(small)
+    # write into every buffer at least once
+    for _ in range(3):
+        mailbox.put(_sample(width=8, height=6, value=9))
+        big = mailbox.get(timeout=5)
+        assert big["frame"].shape == (6, 8, 3)
+        assert np.all(big["frame"] == 9)
+        mailbox.release(big)
+    names = [shm.name for shm in mailbox._consumer_shm.values()]
+    mailbox.close()
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def _produce(mailbox=None, count=None):
+    for value in range(1, count + 1):
+        mailbox.put(_sample(width=320, height=240, value=value % 256))
+    mailbox.close()
+
+
+def test_producer_process():
+    mailbox = FrameMailbox()
+    producer = multiprocessing.Process(
+        target=_produce, kwargs={"mailbox": mailbox, "count": 50}
+    )
+    producer.start()
+    values = []
+    while producer.is_alive() or not mailbox.empty():
+        try:
+            sample = mailbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        values.append(int(sample["frame"][0, 0, 0]))
+        mailbox.release(sample)
+    producer.join()
+    # frames arrive in order, the last one is never lost
+    assert values == sorted(values)
+    assert values[-1] == 50
+    assert len(values) + mailbox.overwritten_count == 50
+    mailbox.close()
@@ -0,0 +1,51 @@
+"""Test the source frame rate latency sampler."""
+import pytest
+from ambianic.pipeline.avsource.sampler import MIN_FPS, LatencySampler
+
+
+def test_rate_follows_processing_time():
+    sampler = LatencySampler(target_fps=10, latency_budget=1)
+    assert sampler.rate == 10
+    # the pipeline keeps up with the target rate
+    assert sampler.observe(processing_time=0.05, latency=0.05) == 10
+    # slower than the target rate
+    for _ in range(50):
+        rate = sampler.observe(processing_time=0.5, latency=0.5)
+    assert rate == pytest.approx(2, rel=0.01)
+    assert sampler.processing_time == pytest.approx(0.5, rel=0.01)
+
+
+def test_no_target_rate():
+    sampler = LatencySampler(latency_budget=1)
+    assert sampler.rate == 0
+    assert sampler.observe(processing_time=0, latency=0) == 0
+    assert sampler.observe(processing_time=0.25, latency=0.25) == pytest.approx(
+        1 / 0.05
+    )
+
+
+def test_latency_over_budget():
+    sampler = LatencySampler(target_fps=10, latency_budget=0.3)
+    for _ in range(10):
+        sampler.observe(processing_time=0.2, latency=0.5)
+    assert sampler.latency > 0.3
+    # backs off below the rate the processing time allows
+    assert sampler.rate < 5
+    slow_rate = sampler.rate
+    for _ in range(100):
+        sampler.observe(processing_time=0.2, latency=0.2)
+    # and recovers once latency is back within budget
+    assert sampler.rate > slow_rate
+    assert sampler.rate == pytest.approx(5)
+
+
+def test_min_rate():
+    sampler = LatencySampler(target_fps=10, latency_budget=0.1)
+    for _ in range(100):
+        sampler.observe(processing_time=60, latency=60)
+    assert sampler.rate == MIN_FPS
+
+
+def test_latency_budget_required():
+    with pytest.raises(AssertionError):
+        LatencySampler(target_fps=10)
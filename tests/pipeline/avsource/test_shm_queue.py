@@ -0,0 +1,118 @@
+"""Test shared memory frame transport."""
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+from ambianic.pipeline.avsource.shm_queue import SharedMemoryFrameQueue
+
+
+def _sample(width=4, height=2, value=7):
+    pixels = np.full((height, width, 3), value, dtype=np.uint8)
+    return {
+        "type": "image",
+        "format": "RGB",
+        "width": width,
+        "height": height,
+        "bytes": pixels.tobytes(),
+    }
+
+
+def test_put_get_release():
+    q = SharedMemoryFrameQueue(slots=2)
+    assert q.empty()
+    assert not q.full()
+    q.put(_sample(value=5))
+    sample = q.get(timeout=5)
+    assert sample["type"] == "image"
+    assert sample["width"] == 4
+    assert sample["height"] == 2
+    assert "bytes" not in sample
+    frame = sample["frame"]
+    assert frame.shape == (2, 4, 3)
+    assert np.all(frame == 5)
+    del frame
+    q.release(sample)
+    assert "frame" not in sample
+    q.close()
+
+
+def test_full_until_released():
+    q = SharedMemoryFrameQueue(slots=2)
+    q.put(_sample(value=1))
+    q.put(_sample(value=2))
+    assert q.full()
+    with pytest.raises(queue.Full):
+        q.put(_sample(value=3))
+    first = q.get(timeout=5)
+    assert np.all(first["frame"] == 1)
+    q.release(first)
+    q.put(_sample(value=3))
+    second = q.get(timeout=5)
+    assert np.all(second["frame"] == 2)
+    q.release(second)
+    third = q.get(timeout=5)
+    assert np.all(third["frame"] == 3)
+    q.release(third)
+    q.close()
+
+
+def test_slot_grows_with_frame_size():
+    q = SharedMemoryFrameQueue(slots=1)
+    q.put(_sample(width=2, height=2, value=1))
+    small = q.get(timeout=5)
+    q.release(small)
+    q.put(_sample(width=8, height=6, value=9))
+    big = q.get(timeout=5)
+    assert big["shm_name"] != small["shm_name"]
+    assert big["frame"].shape == (6, 8, 3)
+    assert np.all(big["frame"] == 9)
+    # the superseded segment is cleaned up right away
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=small["shm_name"])
+    q.release(big)
+    q.close()
+
+
+def test_put_memoryview():
+    q = SharedMemoryFrameQueue(slots=1)
+    sample = _sample(value=3)
+    # mapped gstreamer buffers are memoryviews
+    sample["bytes"] = memoryview(np.frombuffer(sample["bytes"], dtype=np.uint8))
+    q.put(sample)
+    got = q.get(timeout=5)
+    assert np.all(got["frame"] == 3)
+    q.release(got)
+    q.close()
+
+
+def test_get_empty():
+    q = SharedMemoryFrameQueue(slots=1)
+    with pytest.raises(queue.Empty):
+        q.get_nowait()
+    q.close()
+
+
+def _produce(out_queue=None, count=None):
+    for i in range(count):
+        while out_queue.full():
+            pass
+        out_queue.put(_sample(value=i))
+    out_queue.close()
+
+
+def test_cross_process():
+    q = SharedMemoryFrameQueue(slots=2)
+    count = 5
+    p = multiprocessing.Process(
+        target=_produce, kwargs={"out_queue": q, "count": count}, daemon=True
+    )
+    p.start()
+    for i in range(count):
+        sample = q.get(timeout=10)
+        assert np.all(sample["frame"] == i)
+        q.release(sample)
+    p.join(timeout=10)
+    assert not p.is_alive()
+    q.close()
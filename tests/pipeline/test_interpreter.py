@@ -1,9 +1,13 @@
+import copy
 import logging
+import subprocess
+import sys
 
 from ambianic import pipeline
 from ambianic.configuration import get_root_config
 from ambianic.pipeline import interpreter
 from ambianic.pipeline.avsource.av_element import AVSourceElement
+from ambianic.pipeline.motion_detect import MotionDetector
 from dynaconf.utils import DynaconfDict
 
 # mocked_settings = DynaconfDict({'FOO': 'BAR'})
@@ -204,3 +208,123 @@ def test_pipeline_ai_model_config():
     assert len(p[0]._pipe_elements) == 2
     assert p[0]._pipe_elements[1]._tfengine._confidence_threshold == 0.0
     assert p[0]._pipe_elements[1]._label_filter == ["person", "car"]
+
+
+def test_motion_detection_element():
+    pipelines_config = {
+        "pipeline_one": [
+            {"source": {"uri": "test"}},
+            {"detect_motion": {"sensitivity": 0.8, "max_skip_interval": 5}},
+        ]
+    }
+    p = _one_pipeline_setup(pipelines_config=pipelines_config)
+    assert len(p[0]._pipe_elements) == 2
+    motion = p[0]._pipe_elements[1]
+    assert isinstance(motion, MotionDetector)
+    assert motion._max_skip_interval == 5
+
+
+def test_source_scale_to_model():
+    """Source frames are scaled to fit the largest AI model input."""
+    pipelines_config = {
+        "pipeline_one": [
+            {"source": {"uri": "test", "scale_to_model": True}},
+            {
+                "detect_objects": {
+                    "model": {"tflite": "ai_models/mobilenet_v2_1.0_224_quant.tflite"},
+                    "labels": "ai_models/imagenet_labels.txt",
+                }
+            },
+        ]
+    }
+    interpreter.Pipeline.PIPELINE_OPS["source"] = AVSourceElement
+    p = _one_pipeline_setup(pipelines_config=pipelines_config, set_source_el=False)
+    source = p[0]._pipe_elements[0]
+    assert isinstance(source, AVSourceElement)
+    assert p[0]._pipe_elements[1].input_tensor_size == (224, 224)
+    assert source._source_conf["max_width"] == 224
+    assert source._source_conf["max_height"] == 224
+
+
+def test_source_no_scale_to_model():
+    """Source frames keep their size unless scale_to_model is set."""
+    pipelines_config = {
+        "pipeline_one": [
+            {"source": {"uri": "test"}},
+            {
+                "detect_objects": {
+                    "model": {"tflite": "ai_models/mobilenet_v2_1.0_224_quant.tflite"},
+                    "labels": "ai_models/imagenet_labels.txt",
+                }
+            },
+        ]
+    }
+    interpreter.Pipeline.PIPELINE_OPS["source"] = AVSourceElement
+    p = _one_pipeline_setup(pipelines_config=pipelines_config, set_source_el=False)
+    source = p[0]._pipe_elements[0]
+    assert "max_width" not in source._source_conf
+    assert "max_height" not in source._source_conf
+
+
+def test_resolve_element_class():
+    assert (
+        interpreter._resolve_element_class(
+            "ambianic.pipeline.motion_detect.MotionDetector"
+        )
+        is MotionDetector
+    )
+    assert interpreter._resolve_element_class(MotionDetector) is MotionDetector
+    assert interpreter._resolve_element_class(None) is None
+
+
+def test_lazy_imports():
+    """Importing the interpreter does not load element dependencies."""
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import ambianic.pipeline.interpreter\n"
+        "print(time.perf_counter() - start)\n"
+        "heavy = ['numpy', 'PIL', 'apprise', 'requests', 'gi', 'tflite_runtime',\n"
+        "    'ambianic.pipeline.ai.tf_detect', 'ambianic.pipeline.save_event',\n"
+        "    'ambianic.pipeline.avsource.gst_process']\n"
+        "print(','.join(m for m in heavy if m in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    import_time, loaded = result.stdout.splitlines()
+    assert loaded == ""
+    log.info("Pipeline interpreter import time: %s seconds", import_time)
+    # generous bound for slow CI machines, about 0.2s on a laptop
+    assert float(import_time) < 2
+
+
+def test_changed_pipelines():
+    old_config = {
+        "sources": {"cam1": {"uri": "rtsp://cam1"}, "cam2": {"uri": "rtsp://cam2"}},
+        "ai_models": {"detect": {"labels": "labels.txt"}},
+        "pipelines": {
+            "one": [
+                {"source": "cam1"},
+                {"detect_objects": {"ai_model": "detect"}},
+            ],
+            "two": [{"source": {"source_id": "cam2"}}],
+            "three": [{"source": {"uri": "rtsp://cam3"}}],
+        },
+    }
+    assert interpreter.changed_pipelines(old_config, old_config) == set()
+    new_config = copy.deepcopy(old_config)
+    new_config["ai_models"]["detect"]["labels"] = "other.txt"
+    assert interpreter.changed_pipelines(old_config, new_config) == {"one"}
+    new_config = copy.deepcopy(old_config)
+    new_config["sources"]["cam2"]["uri"] = "rtsp://cam2/hd"
+    assert interpreter.changed_pipelines(old_config, new_config) == {"two"}
+    new_config = copy.deepcopy(old_config)
+    new_config["pipelines"]["three"][0]["source"]["uri"] = "rtsp://cam4"
+    del new_config["pipelines"]["two"]
+    new_config["pipelines"]["four"] = [{"source": "cam1"}]
+    assert interpreter.changed_pipelines(old_config, new_config) == {
+        "two",
+        "three",
+        "four",
+    }
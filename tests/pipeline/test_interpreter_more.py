@@ -4,7 +4,7 @@ import threading
 import time
 
 from ambianic import pipeline
-from ambianic.pipeline import interpreter
+from ambianic.pipeline import interpreter, metrics
 from ambianic.pipeline.avsource.av_element import AVSourceElement
 from ambianic.pipeline.interpreter import (
     HealingThread,
@@ -143,6 +143,66 @@ def test_pipeline_server_start_stop():
     assert not server._threaded_jobs[0].is_alive()
 
 
+def test_pipeline_server_restart_pipelines():
+    Pipeline.PIPELINE_OPS["source"] = _TestSourceElement2
+    conf = {
+        "pipelines": {
+            "pipeline_one": [{"source": {"uri": "test1"}}],
+            "pipeline_two": [{"source": {"uri": "test2"}}],
+        }
+    }
+    server = PipelineServerJob(conf)
+    server.start()
+    try:
+        one, two = server._pipelines
+        for p in (one, two):
+            p._pipe_elements[0]._test_element_started.wait(timeout=3)
+        new_conf = {
+            "pipelines": {
+                "pipeline_two": [{"source": {"uri": "test2/hd"}}],
+                "pipeline_three": [{"source": {"uri": "test3"}}],
+            }
+        }
+        server.restart_pipelines(
+            config=new_conf,
+            pipeline_names={"pipeline_one", "pipeline_two", "pipeline_three"},
+        )
+        assert one._pipe_elements[0].state == pipeline.PIPE_STATE_STOPPED
+        assert two._pipe_elements[0].state == pipeline.PIPE_STATE_STOPPED
+        names = sorted(p.name for p in server._pipelines)
+        assert names == ["pipeline_three", "pipeline_two"]
+        assert len(server._threaded_jobs) == 2
+        for p in server._pipelines:
+            source = p._pipe_elements[0]
+            source._test_element_started.wait(timeout=3)
+            assert source.state == pipeline.PIPE_STATE_RUNNING
+        [new_two] = [p for p in server._pipelines if p.name == "pipeline_two"]
+        assert new_two._pipe_elements[0].config["uri"] == "test2/hd"
+        # unchanged pipelines keep running
+        three = [p for p in server._pipelines if p.name == "pipeline_three"][0]
+        server.restart_pipelines(config=new_conf, pipeline_names={"pipeline_two"})
+        assert three in server._pipelines
+        assert three._pipe_elements[0].state == pipeline.PIPE_STATE_RUNNING
+    finally:
+        server.stop()
+
+
+def test_pipeline_server_metrics(tmp_path):
+    conf = _get_config(_TestSourceElement2)
+    conf["data_dir"] = str(tmp_path)
+    server = PipelineServerJob(conf)
+    server.start()
+    source_pe = server._pipelines[0]._pipe_elements[0]
+    source_pe._test_element_started.wait(timeout=3)
+    try:
+        text = metrics.fetch_metrics(path=tmp_path / metrics.METRICS_SOCKET_FILE_NAME)
+    finally:
+        server.stop()
+    assert 'ambianic_pipeline_heartbeat_age_seconds{pipeline="pipeline_one"}' in text
+    assert 'ambianic_element_samples_in_total{pipeline="pipeline_one"' in text
+    assert not (tmp_path / metrics.METRICS_SOCKET_FILE_NAME).exists()
+
+
 def test_pipeline_server_config_change():
     conf = _get_config(_TestSourceElement2)
     PipelineServer(conf)
@@ -357,3 +417,4 @@ def test_on_pipeline_job_ended():
     server.healthcheck()
     assert source_pe.state == pipeline.PIPE_STATE_STOPPED
     assert not server._threaded_jobs
+    server.stop()
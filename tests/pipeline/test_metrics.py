@@ -0,0 +1,160 @@
+"""Test pipeline runtime metrics."""
+import time
+
+import pytest
+from ambianic import pipeline
+from ambianic.pipeline import metrics
+
+
+def test_histogram_buckets():
+    h = metrics.Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        h.observe(value)
+    buckets, total_sum, total = h.snapshot()
+    assert buckets == [(0.1, 2), (1, 3), (float("inf"), 4)]
+    assert total_sum == pytest.approx(2.65)
+    assert total == h.count == 4
+
+
+class _TestElement(pipeline.PipeElement):
+    """Sleeps a little and passes on every other sample."""
+
+    def process_sample(self, **sample):
+        time.sleep(0.002)
+        if sample["n"] % 2 == 0:
+            yield sample
+
+
+class _TestPipeline:
+    def __init__(self, name=None, elements=None):
+        self.name = name
+        self.elements = elements
+
+    def healthcheck(self):
+        return time.monotonic() - 3, True
+
+
+class _TestClock:
+    """Stands in for time.perf_counter, advanced only by the test."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class _TestClockElement(pipeline.PipeElement):
+    """Takes 2ms of test clock time and passes on every other sample."""
+
+    def __init__(self, clock=None, **kwargs):
+        super().__init__(**kwargs)
+        self._clock = clock
+
+    def process_sample(self, **sample):
+        self._clock.now += 0.002
+        if sample["n"] % 2 == 0:
+            yield sample
+
+
+def test_element_metrics(monkeypatch):
+    clock = _TestClock()
+    monkeypatch.setattr(time, "perf_counter", clock)
+    pe = _TestClockElement(clock=clock)
+    pe_next = _TestClockElement(clock=clock)
+    pe.connect_to_next_element(pe_next)
+    for n in range(4):
+        pe.receive_next_sample(n=n)
+    assert pe.metrics.samples_in == 4
+    assert pe.metrics.samples_out == 2
+    assert pe.metrics.latency.count == 4
+    assert pe_next.metrics.samples_in == 2
+    _, latency_sum, _ = pe.metrics.latency.snapshot()
+    _, next_latency_sum, _ = pe_next.metrics.latency.snapshot()
+    # time spent in the next element is not counted
+    assert latency_sum == pytest.approx(0.008)
+    assert next_latency_sum == pytest.approx(0.004)
+
+
+def test_render_metrics():
+    pe = _TestElement(element_name="detect")
+    pe.receive_next_sample(n=0)
+    p = _TestPipeline(name='front "door"', elements=[pe])
+    text = metrics.render_metrics([p])
+    labels = (
+        'pipeline="front \\"door\\"",element="detect",index="0",class="_TestElement"'
+    )
+    assert "# TYPE ambianic_element_latency_seconds histogram" in text
+    assert f'ambianic_element_latency_seconds_bucket{{{labels},le="+Inf"}} 1' in text
+    assert f'ambianic_element_latency_seconds_bucket{{{labels},le="0.001"}} 0' in text
+    assert f"ambianic_element_latency_seconds_count{{{labels}}} 1" in text
+    assert f"ambianic_element_samples_in_total{{{labels}}} 1" in text
+    assert f"ambianic_element_samples_out_total{{{labels}}} 1" in text
+    assert f"ambianic_element_dropped_samples_total{{{labels}}} 0" in text
+    assert f"ambianic_element_queue_depth{{{labels}}} 0" in text
+    assert (
+        'ambianic_pipeline_heartbeat_age_seconds{pipeline="front \\"door\\""} 3.0'
+        in text
+    )
+    assert text.endswith("\n")
+
+
+def test_metrics_server(tmp_path):
+    path = tmp_path / metrics.METRICS_SOCKET_FILE_NAME
+    calls = []
+
+    def collect():
+        calls.append(1)
+        return f"test_metric {len(calls)}\n"
+
+    server = metrics.MetricsServer(path=path, collect=collect)
+    server.start()
+    try:
+        assert metrics.fetch_metrics(path=path) == "test_metric 1\n"
+        assert metrics.fetch_metrics(path=path) == "test_metric 2\n"
+    finally:
+        server.stop()
+    assert not path.exists()
+    with pytest.raises(OSError):
+        metrics.fetch_metrics(path=path)
+
+
+def test_render_gauges():
+    pe = _TestElement(element_name="source")
+    pe.metrics.gauges["source_frame_rate"] = 2.5
+    p = _TestPipeline(name="cam", elements=[pe])
+    text = metrics.render_metrics([p])
+    labels = 'pipeline="cam",element="source",index="0",class="_TestElement"'
+    assert "# TYPE ambianic_source_frame_rate gauge" in text
+    assert f"ambianic_source_frame_rate{{{labels}}} 2.5" in text
+    assert "ambianic_source_latency_budget_seconds" not in text
+
+
+def test_render_histograms():
+    pe = _TestElement(element_name="source")
+    pe.metrics.histograms["source_capture_latency_seconds"] = metrics.Histogram()
+    pe.metrics.histograms["source_capture_latency_seconds"].observe(0.2)
+    p = _TestPipeline(name="cam", elements=[pe])
+    text = metrics.render_metrics([p])
+    labels = 'pipeline="cam",element="source",index="0",class="_TestElement"'
+    name = "ambianic_source_capture_latency_seconds"
+    assert f"# TYPE {name} histogram" in text
+    assert f'{name}_bucket{{{labels},le="0.25"}} 1' in text
+    assert f'{name}_bucket{{{labels},le="0.1"}} 0' in text
+    assert f"{name}_count{{{labels}}} 1" in text
+
+
+def test_render_info():
+    pe = _TestElement(element_name="source")
+    pe.metrics.info["source_decoder"] = {
+        "decoder": "avdec_h264",
+        "hardware_decode": "false",
+    }
+    p = _TestPipeline(name="cam", elements=[pe])
+    text = metrics.render_metrics([p])
+    labels = 'pipeline="cam",element="source",index="0",class="_TestElement"'
+    assert "# TYPE ambianic_source_decoder_info gauge" in text
+    assert (
+        f'ambianic_source_decoder_info{{{labels},decoder="avdec_h264",'
+        'hardware_decode="false"} 1' in text
+    )
@@ -0,0 +1,108 @@
+"""Test cases for MotionDetector."""
+import time
+
+import numpy as np
+import pytest
+from ambianic.pipeline import PipeElement
+from ambianic.pipeline.motion_detect import MotionDetector
+from PIL import Image
+
+
+class _OutPipeElement(PipeElement):
+    def __init__(self):
+        super().__init__()
+        self.samples = []
+
+    def receive_next_sample(self, **sample):
+        self.samples.append(sample)
+
+
+def _image(value=0, square=None, size=(320, 240)):
+    pixels = np.full((size[1], size[0], 3), value, dtype=np.uint8)
+    if square:
+        x, y, side = square
+        pixels[y : y + side, x : x + side] = 255
+    return Image.fromarray(pixels)
+
+
+def _motion_detector(**kwargs):
+    motion = MotionDetector(**kwargs)
+    output = _OutPipeElement()
+    motion.connect_to_next_element(output)
+    return motion, output
+
+
+def test_first_frame_passed_on():
+    motion, output = _motion_detector()
+    motion.receive_next_sample(image=_image())
+    assert len(output.samples) == 1
+
+
+def test_static_frames_skipped():
+    motion, output = _motion_detector()
+    for _ in range(5):
+        motion.receive_next_sample(image=_image())
+    assert len(output.samples) == 1
+
+
+def test_motion_passed_on():
+    motion, output = _motion_detector()
+    motion.receive_next_sample(image=_image())
+    img = _image(square=(100, 100, 80))
+    motion.receive_next_sample(image=img, extra="value")
+    assert len(output.samples) == 2
+    assert output.samples[1]["image"] is img
+    assert output.samples[1]["extra"] == "value"
+
+
+def test_sensitivity():
+    # a 20x20 square is about 0.5% of a 320x240 frame
+    motion, output = _motion_detector(sensitivity=0.5)
+    motion.receive_next_sample(image=_image())
+    motion.receive_next_sample(image=_image(square=(100, 100, 20)))
+    assert len(output.samples) == 1
+    motion, output = _motion_detector(sensitivity=0.95)
+    motion.receive_next_sample(image=_image())
+    motion.receive_next_sample(image=_image(square=(100, 100, 20)))
+    assert len(output.samples) == 2
+
+
+def test_max_skip_interval():
+    motion, output = _motion_detector(max_skip_interval=0.1)
+    motion.receive_next_sample(image=_image())
+    motion.receive_next_sample(image=_image())
+    assert len(output.samples) == 1
+    time.sleep(0.2)
+    motion.receive_next_sample(image=_image())
+    assert len(output.samples) == 2
+
+
+def test_background_adapts():
+    motion, output = _motion_detector(background_rate=0.5)
+    motion.receive_next_sample(image=_image(value=0))
+    # a permanent change in the scene stops counting as motion
+    for _ in range(10):
+        motion.receive_next_sample(image=_image(value=200))
+    count = len(output.samples)
+    motion.receive_next_sample(image=_image(value=200))
+    assert len(output.samples) == count
+
+
+def test_resolution_change():
+    motion, output = _motion_detector()
+    motion.receive_next_sample(image=_image())
+    motion.receive_next_sample(image=_image(size=(640, 360)))
+    assert len(output.samples) == 2
+
+
+def test_empty_sample():
+    motion, output = _motion_detector()
+    motion.receive_next_sample()
+    assert output.samples == [{}]
+
+
+def test_bad_config():
+    with pytest.raises(AssertionError):
+        MotionDetector(sensitivity=2)
+    with pytest.raises(AssertionError):
+        MotionDetector(max_skip_interval=0)
@@ -100,6 +100,7 @@ class _TestSaveDetectionSamples(SaveDetectionEvents):
         thumbnail=None,
         inference_result=None,
         inference_meta=None,
+        image_jpeg=None,
     ):
         self._save_sample_called = True
         self._inf_result = inference_result
@@ -109,6 +110,7 @@ class _TestSaveDetectionSamples(SaveDetectionEvents):
             thumbnail=thumbnail,
             inference_result=inference_result,
             inference_meta=inference_meta,
+            image_jpeg=image_jpeg,
         )
 
     data = {
@@ -179,8 +181,10 @@ def test_notification_with_attachments():
         )
     )
     assert len(processed_samples) == 1
+    # notifications are sent from a background thread
+    assert called.wait(timeout=10)
+    store.stop()
     mock_server.stop()
-    assert called.is_set()
 
 
 def test_notification_without_attachments():
@@ -238,8 +242,10 @@ def test_notification_without_attachments():
         )
     )
     assert len(processed_samples) == 1
+    # notifications are sent from a background thread
+    assert called.wait(timeout=10)
+    store.stop()
     mock_server.stop()
-    assert called.is_set()
 
 
 def test_plain_notification():
@@ -296,5 +302,7 @@ def test_plain_notification():
         )
     )
     assert len(processed_samples) == 1
+    # notifications are sent from a background thread
+    assert called.wait(timeout=10)
+    store.stop()
     mock_server.stop()
-    assert called.is_set()
@@ -0,0 +1,114 @@
+"""Test cases for ObjectTracker."""
+import numpy as np
+import pytest
+from ambianic.pipeline import PipeElement
+from ambianic.pipeline.object_track import ObjectTracker, box_iou
+
+
+class _OutPipeElement(PipeElement):
+    def __init__(self):
+        super().__init__()
+        self.samples = []
+
+    def receive_next_sample(self, **sample):
+        self.samples.append(sample)
+
+
+def _detection(label="person", box=(0.1, 0.1, 0.3, 0.5)):
+    xmin, ymin, xmax, ymax = box
+    return {
+        "label": label,
+        "confidence": 0.9,
+        "box": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax},
+    }
+
+
+def test_box_iou():
+    a = np.array([[0, 0, 1, 1], [0, 0, 0.5, 0.5]])
+    b = np.array([[0, 0, 1, 1], [0.5, 0, 1, 1], [2, 2, 3, 3], [0, 0, 0, 0]])
+    iou = box_iou(a, b)
+    assert iou.shape == (2, 4)
+    assert iou[0].tolist() == pytest.approx([1, 0.5, 0, 0])
+    assert iou[1].tolist() == pytest.approx([0.25, 0, 0, 0])
+
+
+def test_same_object_keeps_track():
+    tracker = ObjectTracker()
+    [first] = tracker.update([_detection()], now=0)
+    assert first["new_track"]
+    [moved] = tracker.update([_detection(box=(0.12, 0.1, 0.32, 0.5))], now=1)
+    assert not moved["new_track"]
+    assert moved["track_id"] == first["track_id"]
+    assert tracker.track_count == 1
+
+
+def test_new_object_new_track():
+    tracker = ObjectTracker()
+    [person] = tracker.update([_detection()], now=0)
+    res = tracker.update(
+        [_detection(), _detection(box=(0.6, 0.2, 0.8, 0.7))],
+        now=1,
+    )
+    assert res[0]["track_id"] == person["track_id"]
+    assert not res[0]["new_track"]
+    assert res[1]["new_track"]
+    assert res[1]["track_id"] != person["track_id"]
+    assert tracker.track_count == 2
+
+
+def test_label_must_match():
+    tracker = ObjectTracker()
+    [person] = tracker.update([_detection(label="person")], now=0)
+    [car] = tracker.update([_detection(label="car")], now=1)
+    assert car["new_track"]
+    assert car["track_id"] != person["track_id"]
+
+
+def test_centroid_match():
+    tracker = ObjectTracker(max_distance=0.1)
+    [first] = tracker.update([_detection(box=(0.1, 0.1, 0.15, 0.15))], now=0)
+    # no overlap, but the center moved only 0.06
+    [moved] = tracker.update([_detection(box=(0.16, 0.1, 0.21, 0.15))], now=1)
+    assert moved["track_id"] == first["track_id"]
+    tracker = ObjectTracker(max_distance=0)
+    tracker.update([_detection(box=(0.1, 0.1, 0.15, 0.15))], now=0)
+    [moved] = tracker.update([_detection(box=(0.16, 0.1, 0.21, 0.15))], now=1)
+    assert moved["new_track"]
+
+
+def test_each_track_matched_once():
+    tracker = ObjectTracker()
+    tracker.update([_detection()], now=0)
+    res = tracker.update([_detection(), _detection()], now=1)
+    assert [d["new_track"] for d in res] == [False, True]
+
+
+def test_track_expires():
+    tracker = ObjectTracker(max_age=5)
+    [first] = tracker.update([_detection()], now=0)
+    assert tracker.update([], now=4) == []
+    assert tracker.track_count == 1
+    [again] = tracker.update([_detection()], now=4.5)
+    assert again["track_id"] == first["track_id"]
+    [later] = tracker.update([_detection()], now=10)
+    assert later["new_track"]
+    assert tracker.track_count == 1
+
+
+def test_process_sample():
+    tracker = ObjectTracker()
+    output = _OutPipeElement()
+    tracker.connect_to_next_element(output)
+    detections = [_detection()]
+    tracker.receive_next_sample(image="img", inference_result=detections, extra=1)
+    tracker.receive_next_sample(image="img", inference_result=None)
+    tracker.receive_next_sample()
+    assert len(output.samples) == 3
+    sample = output.samples[0]
+    assert sample["image"] == "img"
+    assert sample["extra"] == 1
+    assert sample["inference_result"][0]["track_id"] == 1
+    # upstream detections are left as is
+    assert "track_id" not in detections[0]
+    assert output.samples[1]["inference_result"] is None
+    assert output.samples[2] == {}
@@ -1,3 +1,6 @@
+import threading
+import time
+
 import pytest
 from ambianic import pipeline
 
@@ -39,3 +42,149 @@ def test_healthcheck():
     hb = pe._latest_heartbeat
     hb1, status = pe.healthcheck()
     assert hb == hb1
+
+
+class _TestSlowElement(pipeline.PipeElement):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.proceed = threading.Event()
+        self.received = []
+
+    def process_sample(self, **sample):
+        self.proceed.wait(timeout=10)
+        self.received.append(sample["n"])
+        yield sample
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 10
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_synchronous_by_default():
+    pe = _TestSlowElement()
+    pe.proceed.set()
+    pe.receive_next_sample(n=1)
+    assert pe.received == [1]
+    assert pe.dropped_samples == 0
+
+
+def test_worker_does_not_block_caller():
+    pe = _TestSlowElement(worker={"queue_size": 1})
+    pe_next = _TestSlowElement()
+    pe_next.proceed.set()
+    pe.connect_to_next_element(pe_next)
+    pe.receive_next_sample(n=1)
+    assert pe.received == []
+    pe.proceed.set()
+    assert _wait_for(lambda: pe_next.received == [1])
+    assert pe.received == [1]
+    pe.stop()
+
+
+def test_worker_drop_oldest():
+    pe = _TestSlowElement(worker={"queue_size": 2, "overflow": "drop_oldest"})
+    pe.receive_next_sample(n=1)
+    # wait until the first sample is in progress
+    assert _wait_for(lambda: pe._worker._queue.empty())
+    for n in range(2, 6):
+        pe.receive_next_sample(n=n)
+    assert pe._worker.dropped_count == 2
+    assert pe.dropped_samples == 2
+    pe.proceed.set()
+    assert _wait_for(lambda: len(pe.received) == 3)
+    assert pe.received == [1, 4, 5]
+    pe.stop()
+
+
+def test_worker_drop_newest():
+    pe = _TestSlowElement(worker={"queue_size": 2, "overflow": "drop_newest"})
+    pe.receive_next_sample(n=1)
+    assert _wait_for(lambda: pe._worker._queue.empty())
+    for n in range(2, 6):
+        pe.receive_next_sample(n=n)
+    assert pe._worker.dropped_count == 2
+    pe.proceed.set()
+    assert _wait_for(lambda: len(pe.received) == 3)
+    assert pe.received == [1, 2, 3]
+    pe.stop()
+
+
+def test_worker_block():
+    pe = _TestSlowElement(worker={"queue_size": 1, "overflow": "block"})
+    for n in range(1, 3):
+        pe.receive_next_sample(n=n)
+    producer = threading.Thread(target=pe.receive_next_sample, kwargs={"n": 3})
+    producer.start()
+    producer.join(timeout=0.2)
+    # the queue is full, the producer waits for room
+    assert producer.is_alive()
+    pe.proceed.set()
+    producer.join(timeout=10)
+    assert _wait_for(lambda: len(pe.received) == 3)
+    assert pe.received == [1, 2, 3]
+    assert pe._worker.dropped_count == 0
+    pe.stop()
+
+
+def test_worker_survives_errors():
+    class _TestFailingElement(pipeline.PipeElement):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.received = []
+
+        def process_sample(self, **sample):
+            self.received.append(sample["n"])
+            if sample["n"] == 1:
+                raise RuntimeError("Sample processing failed.")
+            yield sample
+
+    pe = _TestFailingElement(worker={"queue_size": 2, "overflow": "block"})
+    pe.receive_next_sample(n=1)
+    pe.receive_next_sample(n=2)
+    assert _wait_for(lambda: pe.received == [1, 2])
+    pe.stop()
+
+
+def test_worker_stop():
+    pe = _TestSlowElement(worker={})
+    pe.proceed.set()
+    pe.receive_next_sample(n=1)
+    worker_thread = pe._worker._thread
+    pe.stop()
+    assert not worker_thread.is_alive()
+    assert pe.state == pipeline.PIPE_STATE_STOPPED
+
+
+def test_worker_put_after_stop():
+    pe = _TestSlowElement(worker={})
+    pe.proceed.set()
+    pe.receive_next_sample(n=1)
+    assert _wait_for(lambda: pe.received == [1])
+    pe.stop()
+    # late samples do not bring the worker back
+    pe.receive_next_sample(n=2)
+    assert pe._worker._thread is None
+    assert pe.dropped_samples == 1
+    pe.start()
+    pe.receive_next_sample(n=3)
+    assert _wait_for(lambda: pe.received == [1, 3])
+    pe.stop()
+
+
+def test_worker_stop_drain():
+    pe = _TestSlowElement(worker={"queue_size": 3})
+    pe.receive_next_sample(n=1)
+    assert _wait_for(lambda: pe._worker._queue.empty())
+    pe.receive_next_sample(n=2)
+    pe.receive_next_sample(n=3)
+    pe.proceed.set()
+    pe._worker.stop(timeout=10, drain=True)
+    assert pe.received == [1, 2, 3]
+
+
+def test_bad_worker_overflow_config():
+    with pytest.raises(AssertionError):
+        _TestSlowElement(worker={"overflow": "drop_everything"})
@@ -0,0 +1,179 @@
+"""Test cases for ClipRecorder."""
+import io
+import struct
+import threading
+import time
+
+from ambianic.pipeline import PipeElement
+from ambianic.pipeline.pipeline_event import PipelineContext
+from ambianic.pipeline.record_clip import ClipRecorder, write_mjpeg_mkv
+from PIL import Image
+
+
+class _OutPipeElement(PipeElement):
+    def __init__(self):
+        super().__init__()
+        self.samples = []
+
+    def receive_next_sample(self, **sample):
+        self.samples.append(sample)
+
+
+class _TestClipRecorder(ClipRecorder):
+    def __init__(self, data_dir=None, **kwargs):
+        context = PipelineContext(unique_pipeline_name="test pipeline")
+        context.data_dir = data_dir
+        super().__init__(context=context, **kwargs)
+        self.clips = []
+
+    def _write_clip(self, frames=None, clip_path=None):
+        self.clips.append([jpeg for _, jpeg in frames])
+        super()._write_clip(frames=frames, clip_path=clip_path)
+
+
+def _read_ebml(data=None, pos=0, end=None):
+    """Return (element id, payload) tuples of the EBML elements in data."""
+    elements = []
+    end = len(data) if end is None else end
+    while pos < end:
+        id_length = 8 - data[pos].bit_length() + 1
+        element_id = int.from_bytes(data[pos : pos + id_length], "big")
+        pos += id_length
+        size_length = 8 - data[pos].bit_length() + 1
+        size = int.from_bytes(data[pos : pos + size_length], "big")
+        size &= (1 << (7 * size_length)) - 1
+        pos += size_length
+        elements.append((element_id, data[pos : pos + size]))
+        pos += size
+    assert pos == end
+    return elements
+
+
+def _jpeg(color=(255, 0, 0), size=(32, 24)):
+    with io.BytesIO() as buf:
+        Image.new("RGB", size, color).save(buf, format="JPEG")
+        return buf.getvalue()
+
+
+def test_write_mjpeg_mkv(tmp_path):
+    frames = [(10 + i * 0.5, _jpeg((i * 20, 0, 0))) for i in range(4)]
+    # one frame in the next cluster
+    frames.append((50, _jpeg()))
+    path = tmp_path / "clip.mkv"
+    write_mjpeg_mkv(path, frames, 32, 24)
+    [(ebml_id, header), (segment_id, segment)] = _read_ebml(path.read_bytes())
+    assert ebml_id == 0x1A45DFA3
+    assert (0x4282, b"matroska") in _read_ebml(header)
+    assert segment_id == 0x18538067
+    elements = _read_ebml(segment)
+    [info] = [e for i, e in elements if i == 0x1549A966]
+    [duration] = [e for i, e in _read_ebml(info) if i == 0x4489]
+    assert struct.unpack(">d", duration) == (50000.0,)
+    [tracks] = [e for i, e in elements if i == 0x1654AE6B]
+    [(_, track)] = _read_ebml(tracks)
+    assert (0x86, b"V_MJPEG") in _read_ebml(track)
+    clusters = [_read_ebml(e) for i, e in elements if i == 0x1F43B675]
+    assert len(clusters) == 2
+    assert clusters[0][0] == (0xE7, b"\x00")
+    assert clusters[1][0] == (0xE7, (40000).to_bytes(2, "big"))
+    blocks = [block for cluster in clusters for i, block in cluster if i == 0xA3]
+    assert [int.from_bytes(b[1:3], "big") for b in blocks] == [0, 500, 1000, 1500, 0]
+    assert [b[4:] for b in blocks] == [jpeg for _, jpeg in frames]
+    image = Image.open(io.BytesIO(blocks[2][4:]))
+    assert image.size == (32, 24)
+
+
+def test_clip_pre_and_post_roll(tmp_path):
+    recorder = _TestClipRecorder(data_dir=tmp_path, pre_roll=2, post_roll=3)
+    frames = [_jpeg((i * 10, 0, 0)) for i in range(20)]
+    # one frame per second, detections in frames 5 and 7
+    for i, jpeg in enumerate(frames):
+        recorder.update(jpeg=jpeg, detected=i in (5, 7), now=i)
+        if i < 5 or i > 9:
+            assert not recorder.recording
+        else:
+            assert recorder.recording
+    recorder.stop()
+    assert recorder.clips == [frames[3:11]]
+    [clip_file] = (tmp_path / "clips").glob("*-clip.mkv")
+    assert clip_file.stat().st_size > sum(len(jpeg) for jpeg in frames[3:11])
+    assert recorder.memory_size == sum(len(jpeg) for jpeg in frames[17:])
+
+
+def test_clip_max_length(tmp_path):
+    recorder = _TestClipRecorder(
+        data_dir=tmp_path, pre_roll=0, post_roll=3, max_clip_length=4
+    )
+    for i in range(7):
+        recorder.update(jpeg=b"%d" % i, detected=True, now=i)
+    assert recorder.recording
+    recorder.stop()
+    assert recorder.clips == [[b"0", b"1", b"2", b"3", b"4"], [b"5", b"6"]]
+    assert not recorder.recording
+
+
+def test_clip_memory_cap(tmp_path):
+    recorder = _TestClipRecorder(data_dir=tmp_path, pre_roll=10, max_memory=1)
+    frame = bytes(300 * 1024)
+    for i in range(6):
+        recorder.update(jpeg=frame, detected=False, now=i)
+    # older frames are dropped to stay within the cap
+    assert recorder.memory_size == 3 * len(frame)
+    for i in range(6, 8):
+        recorder.update(jpeg=frame, detected=True, now=i)
+    recorder._writer.stop(timeout=10, drain=True)
+    # the clip is cut short once it runs out of memory
+    assert [len(clip) for clip in recorder.clips] == [4]
+    recorder.stop()
+
+
+def test_process_sample(tmp_path):
+    recorder = _TestClipRecorder(data_dir=tmp_path, pre_roll=1, post_roll=0)
+    output = _OutPipeElement()
+    recorder.connect_to_next_element(output)
+    image = Image.new("RGB", (40, 30))
+    recorder.receive_next_sample(image=image, inference_result=[])
+    recorder.receive_next_sample(
+        image=image, image_jpeg=_jpeg(), inference_result=[{"label": "person"}]
+    )
+    recorder.receive_next_sample()
+    recorder.stop()
+    assert len(output.samples) == 3
+    assert output.samples[1]["image_jpeg"] == _jpeg()
+    [clip] = recorder.clips
+    # the frame without a camera JPEG is encoded
+    assert Image.open(io.BytesIO(clip[0])).size == (40, 30)
+    assert clip[1] == _jpeg()
+
+
+class _TestSlowEncoderClipRecorder(_TestClipRecorder):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.encoding = threading.Event()
+        self.proceed = threading.Event()
+
+    def _encode_frame(self, image=None):
+        self.encoding.set()
+        self.proceed.wait(timeout=10)
+        return super()._encode_frame(image)
+
+
+def test_encoding_off_pipeline_thread(tmp_path):
+    recorder = _TestSlowEncoderClipRecorder(data_dir=tmp_path, pre_roll=10)
+    output = _OutPipeElement()
+    recorder.connect_to_next_element(output)
+    image = Image.new("RGB", (40, 30))
+    recorder.receive_next_sample(image=image, inference_result=[])
+    assert recorder.encoding.wait(timeout=10)
+    # the encoder is stuck on the first frame, new frames
+    # are passed on right away and only a few wait to be encoded
+    start = time.monotonic()
+    for _ in range(20):
+        recorder.receive_next_sample(image=image, inference_result=[])
+    assert time.monotonic() - start < 1
+    assert len(output.samples) == 21
+    assert recorder.queue_depth == 2
+    assert recorder.dropped_samples == 18
+    recorder.proceed.set()
+    recorder.stop()
+    assert len(recorder._frames) == 3
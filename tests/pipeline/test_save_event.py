@@ -1,8 +1,11 @@
 """Test cases for SaveDetectionEvents."""
+import io
 import json
 import logging
 import os
 import shutil
+import threading
+import time
 from pathlib import Path
 
 import numpy as np
@@ -188,6 +191,7 @@ class _TestSaveDetectionSamples(SaveDetectionEvents):
         thumbnail=None,
         inference_result=None,
         inference_meta=None,
+        image_jpeg=None,
     ):
         self._save_sample_called = True
         self._inf_result = inference_result
@@ -197,6 +201,7 @@ class _TestSaveDetectionSamples(SaveDetectionEvents):
             thumbnail=thumbnail,
             inference_result=inference_result,
             inference_meta=inf_meta,
+            image_jpeg=image_jpeg,
         )
 
 
@@ -497,6 +502,7 @@ class _TestSaveDetectionSamples2(SaveDetectionEvents):
         thumbnail=None,
         inference_result=None,
         inference_meta=None,
+        image_jpeg=None,
     ):
         self._save_sample_called = True
 
@@ -537,3 +543,163 @@ def test_process_sample_exception():
     assert category == "person"
     assert confidence == 0.98
     assert x0 == 0 and y0 == 1 and x1 == 2 and y1 == 3
+
+
+class _TestEventLog:
+    def __init__(self):
+        self.events = []
+
+    def log(self, priority, message, args):
+        self.events.append(args)
+
+
+def _writer_store(tmp_path, **kwargs):
+    context = PipelineContext(unique_pipeline_name="test pipeline")
+    context.data_dir = str(tmp_path)
+    return SaveDetectionEvents(context=context, event_log=_TestEventLog(), **kwargs)
+
+
+def _detection_sample():
+    img = Image.new("RGB", (60, 30), color="red")
+    detections = [{"label": "person", "confidence": np.float32(0.98)}]
+    return {"image": img, "thumbnail": img, "inference_result": detections}
+
+
+class _TestBlockedWriterStore(SaveDetectionEvents):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.proceed = threading.Event()
+        self.written = []
+
+    def _write_event(self, **event):
+        self.proceed.wait(timeout=10)
+        self.written.append(event["json_path"])
+        super()._write_event(**event)
+
+
+def test_writer_does_not_block(tmp_path, mocker: MockerFixture):
+    context = PipelineContext(unique_pipeline_name="test pipeline")
+    context.data_dir = str(tmp_path)
+    store = _TestBlockedWriterStore(
+        context=context,
+        event_log=_TestEventLog(),
+        positive_interval=0,
+        writer={"queue_size": 2, "overflow": "drop_newest"},
+    )
+    notify_mock = mocker.patch.object(store, "notify")
+    list(store.process_sample(**_detection_sample()))
+    # wait until the first event is in progress
+    deadline = time.monotonic() + 10
+    while store.queue_depth and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for _ in range(3):
+        processed_samples = list(store.process_sample(**_detection_sample()))
+        assert processed_samples[0]["inference_result"]
+    assert store.written == []
+    # one event is being written, two are waiting and one was dropped
+    assert store.dropped_samples == 1
+    assert store.queue_depth == 2
+    store.proceed.set()
+    store.stop()
+    assert len(store.written) == 3
+    for json_path in store.written:
+        assert json_path.exists()
+    assert len(store.event_log.events) == 3
+    assert notify_mock.call_count == 3
+
+
+def test_writer_saves_files(tmp_path):
+    store = _writer_store(tmp_path, writer={})
+    list(store.process_sample(**_detection_sample()))
+    store.stop()
+    [json_file] = list(tmp_path.glob("detections/*/*-inference.json"))
+    with open(json_file) as f:
+        saved = json.load(f)
+    [detection] = saved["inference_result"]
+    assert detection["label"] == "person"
+    assert detection["confidence"] == pytest.approx(0.98)
+    img_path = json_file.parent / saved["image_file_name"]
+    thumbnail_path = json_file.parent / saved["thumbnail_file_name"]
+    assert Image.open(img_path).size == (60, 30)
+    assert Image.open(thumbnail_path).size == (60, 30)
+    [event] = store.event_log.events
+    assert event["json_file_name"] == json_file.name
+
+
+def test_writer_batched_fsync(tmp_path, mocker: MockerFixture):
+    fsync_mock = mocker.patch("ambianic.pipeline.save_event._fsync_files")
+    context = PipelineContext(unique_pipeline_name="test pipeline")
+    context.data_dir = str(tmp_path)
+    store = _TestBlockedWriterStore(
+        context=context,
+        event_log=_TestEventLog(),
+        positive_interval=0,
+        writer={"queue_size": 5},
+    )
+    for _ in range(3):
+        list(store.process_sample(**_detection_sample()))
+    store.proceed.set()
+    store.stop()
+    # the files of all three events are flushed together
+    # once the queue runs empty
+    fsync_mock.assert_called_once()
+    assert len(fsync_mock.call_args[0][0]) == 9
+
+
+def test_writer_no_fsync(tmp_path, mocker: MockerFixture):
+    fsync_mock = mocker.patch("ambianic.pipeline.save_event._fsync_files")
+    store = _writer_store(tmp_path, writer={"fsync": False})
+    list(store.process_sample(**_detection_sample()))
+    store.stop()
+    assert not fsync_mock.called
+    assert list(tmp_path.glob("detections/*/*-inference.json"))
+
+
+def test_jpeg_quality(tmp_path):
+    sizes = {}
+    noise = Image.fromarray(
+        np.random.default_rng(0).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    )
+    for quality in (20, 95):
+        store = _writer_store(tmp_path / str(quality), jpeg_quality=quality)
+        list(store.process_sample(image=noise, thumbnail=noise, inference_result=None))
+        [img_file] = list((tmp_path / str(quality)).glob("detections/*/*-image.jpg"))
+        sizes[quality] = img_file.stat().st_size
+    assert sizes[20] < sizes[95]
+    with pytest.raises(AssertionError):
+        _writer_store(tmp_path, jpeg_quality=0)
+
+
+def test_save_new_tracks_only(tmp_path, mocker: MockerFixture):
+    store = _writer_store(tmp_path, positive_interval=1000)
+    save_mock = mocker.patch.object(store, "_save_sample")
+    img = Image.new("RGB", (60, 30), color="red")
+    person = {"label": "person", "track_id": 1, "new_track": True}
+    list(store.process_sample(image=img, inference_result=[person]))
+    assert save_mock.call_count == 1
+    # the same person is still in view
+    person = {**person, "new_track": False}
+    list(store.process_sample(image=img, inference_result=[person]))
+    assert save_mock.call_count == 1
+    # a second person shows up within positive_interval
+    second = {"label": "person", "track_id": 2, "new_track": True}
+    list(store.process_sample(image=img, inference_result=[person, second]))
+    assert save_mock.call_count == 2
+
+
+def test_save_camera_jpeg(tmp_path, mocker: MockerFixture):
+    store = _writer_store(tmp_path)
+    save_mock = mocker.spy(Image.Image, "save")
+    camera_img = Image.new("RGB", (120, 60), color="blue")
+    jpeg = io.BytesIO()
+    camera_img.save(jpeg, format="JPEG")
+    save_mock.reset_mock()
+    list(store.process_sample(**_detection_sample(), image_jpeg=jpeg.getvalue()))
+    store.stop()
+    [json_file] = list(tmp_path.glob("detections/*/*-inference.json"))
+    with open(json_file) as f:
+        saved = json.load(f)
+    img_path = json_file.parent / saved["image_file_name"]
+    # the camera frame is saved as is, only the thumbnail is encoded
+    assert img_path.read_bytes() == jpeg.getvalue()
+    assert save_mock.call_count == 1
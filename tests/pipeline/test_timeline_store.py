@@ -0,0 +1,90 @@
+"""Test cases for the timeline event store."""
+import logging
+from datetime import datetime
+
+from ambianic.pipeline import pipeline_event
+from ambianic.pipeline.timeline_store import TIMELINE_STORE_FILE_NAME, TimelineStore
+
+
+def _event(n, day=1, labels=("person",)):
+    return {
+        "id": f"event{n}",
+        "message": "Detection Event",
+        "created": 0,
+        "args": {
+            "datetime": datetime(2021, 1, day, 10, 0, n).isoformat(),
+            "inference_result": [{"label": label} for label in labels],
+        },
+    }
+
+
+def test_append_query_most_recent_first(tmp_path):
+    store = TimelineStore(path=tmp_path / "t.db")
+    for n in range(12):
+        store.append(event=_event(n))
+    page1 = store.query(page=1)
+    assert [e["id"] for e in page1] == [f"event{n}" for n in range(11, 6, -1)]
+    page3 = store.query(page=3)
+    assert [e["id"] for e in page3] == ["event1", "event0"]
+    assert store.query(page=4) == []
+    store.close()
+
+
+def test_query_before_datetime(tmp_path):
+    store = TimelineStore(path=tmp_path / "t.db")
+    for n in range(10):
+        store.append(event=_event(n))
+    res = store.query(before_datetime=datetime(2021, 1, 1, 10, 0, 3))
+    assert [e["id"] for e in res] == ["event2", "event1", "event0"]
+    store.close()
+
+
+def test_query_filters(tmp_path):
+    store = TimelineStore(path=tmp_path / "t.db")
+    store.append(event=_event(1, labels=("person", "car")), pipeline="front")
+    store.append(event=_event(2, labels=("car",)), pipeline="back")
+    store.append(event=_event(3, labels=()), pipeline="front")
+    assert [e["id"] for e in store.query(label="car")] == ["event2", "event1"]
+    assert [e["id"] for e in store.query(label="person")] == ["event1"]
+    assert [e["id"] for e in store.query(pipeline="front")] == ["event3", "event1"]
+    res = store.query(pipeline="front", label="car")
+    assert [e["id"] for e in res] == ["event1"]
+    store.close()
+
+
+def test_prune_old_events(tmp_path):
+    store = TimelineStore(path=tmp_path / "t.db", max_events=3)
+    for n in range(10):
+        store.append(event=_event(n))
+    res = store.query(page=1)
+    assert [e["id"] for e in res] == ["event9", "event8", "event7"]
+    assert store.query(label="person", page=2) == []
+    store.close()
+
+
+def test_event_log_writes_to_store(tmp_path):
+    event_log_file = tmp_path / "timeline-event-log.yaml"
+    pipeline_event.configure_timeline({"event_log": str(event_log_file)})
+    context = pipeline_event.PipelineContext(unique_pipeline_name="test pipeline")
+    event_log = pipeline_event.get_event_log(pipeline_context=context)
+    event_log.log(logging.INFO, "Detection Event", _event(1)["args"])
+    store = TimelineStore(path=tmp_path / TIMELINE_STORE_FILE_NAME)
+    res = store.query(pipeline="test pipeline")
+    assert len(res) == 1
+    assert res[0]["message"] == "Detection Event"
+    assert res[0]["args"]["inference_result"] == [{"label": "person"}]
+    store.close()
+    # release the store held by the timeline logger
+    timeline_logger = logging.getLogger(pipeline_event.TIMELINE_EVENT_LOGGER_NAME)
+    for handler in timeline_logger.handlers:
+        handler.close()
+    timeline_logger.handlers = []
+
+
+def test_prune_uses_label_seq_index(tmp_path):
+    store = TimelineStore(path=tmp_path / "t.db")
+    plan = store._conn.execute(
+        "EXPLAIN QUERY PLAN DELETE FROM timeline_label WHERE seq <= ?", (1,)
+    ).fetchall()
+    assert any("timeline_label_seq" in row[-1] for row in plan)
+    store.close()
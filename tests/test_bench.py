@@ -0,0 +1,131 @@
+"""Test the pipeline benchmark harness."""
+import json
+import os
+import pathlib
+import time
+
+from ambianic import bench
+from ambianic.configuration import get_root_config
+from ambianic.pipeline import PipeElement, interpreter
+from ambianic.pipeline.avsource.av_element import AVSourceElement
+
+_dir = os.path.dirname(os.path.abspath(__file__))
+_video_file = os.path.join(_dir, "pipeline", "avsource", "test2-cam-person1.mkv")
+
+
+class _TestSourceElement(PipeElement):
+    """Sends a few samples down the pipe and ends like a recorded file."""
+
+    def __init__(self, uri=None, live=None, frames=10, **kwargs):
+        super().__init__(**kwargs)
+        self.frames = frames
+
+    def start(self):
+        super().start()
+        for i in range(self.frames):
+            self.receive_next_sample(frame=i)
+        super().stop()
+
+    def heal(self):
+        """Empty implementation of abstractmethod."""
+
+
+class _TestSlowElement(PipeElement):
+    """Takes a few milliseconds per sample and passes on every other one."""
+
+    def process_sample(self, **sample):
+        time.sleep(0.002)
+        if sample["frame"] % 2 == 0:
+            yield sample
+
+
+def test_latency_stats():
+    stats = bench.LatencyStats()
+    assert stats.summary() == {}
+    for ms in range(1, 101):
+        stats.add(ms / 1000)
+    summary = stats.summary()
+    assert stats.count == 100
+    assert summary["p50"] == 50.5
+    assert summary["p99"] == 99.01
+    assert summary["max"] == 100
+    assert summary["mean"] == 50.5
+
+
+def test_bench_pipelines_config():
+    config = get_root_config()
+    config.update(
+        {
+            "sources": {
+                "front_cam": {"uri": "rtsp://cam", "type": "video", "live": True}
+            },
+        }
+    )
+    pipelines_config = {
+        "front": [{"source": "front_cam"}, {"detect_motion": {}}],
+        "back": [{"source": {"uri": "rtsp://back", "live": True, "fps": 5}}],
+    }
+    res = bench.get_bench_pipelines_config(pipelines_config=pipelines_config)
+    assert res["front"][0]["source"] == {
+        "uri": "rtsp://cam",
+        "type": "video",
+        "live": False,
+    }
+    assert res["front"][1] == {"detect_motion": {}}
+    assert res["back"][0]["source"] == {"uri": "rtsp://back", "live": False, "fps": 5}
+    # the original config is left as is
+    assert pipelines_config["back"][0]["source"]["live"]
+    res = bench.get_bench_pipelines_config(
+        pipelines_config=pipelines_config, names=["back"], media=_video_file
+    )
+    assert list(res) == ["back"]
+    source = res["back"][0]["source"]
+    assert source["uri"] == pathlib.Path(_video_file).as_uri()
+    assert source["type"] == "video"
+    assert source["fps"] == 5
+
+
+def test_run_benchmark(monkeypatch, tmp_path):
+    monkeypatch.setitem(interpreter.Pipeline.PIPELINE_OPS, "source", _TestSourceElement)
+    monkeypatch.setitem(interpreter.Pipeline.PIPELINE_OPS, "slow", _TestSlowElement)
+    pipelines_config = {
+        "one": [{"source": {"uri": "test", "frames": 10}}, {"slow": {}}],
+        "two": [{"source": {"uri": "test", "frames": 4}}, {"slow": {}}, {"slow": {}}],
+    }
+    report = bench.run_benchmark(pipelines_config=pipelines_config, data_dir=tmp_path)
+    json.dumps(report)
+    assert report["duration_sec"] > 0
+    assert report["memory"]["max_rss_mb"] > 0
+    assert "percent" in report["cpu"]
+    one = report["pipelines"]["one"]
+    assert one["frames"] == 10
+    assert one["fps"] > 0
+    assert one["dropped_frames"] == 0
+    assert one["frame_latency_ms"]["p50"] >= 2
+    [slow] = one["elements"]
+    assert slow["name"] == "slow"
+    assert slow["class"] == "_TestSlowElement"
+    assert slow["samples_in"] == 10
+    assert slow["samples_out"] == 5
+    assert slow["latency_ms"]["p50"] >= 2
+    two = report["pipelines"]["two"]
+    assert [e["samples_in"] for e in two["elements"]] == [4, 2]
+
+
+def test_run_benchmark_recorded_video(monkeypatch, tmp_path):
+    monkeypatch.setitem(interpreter.Pipeline.PIPELINE_OPS, "source", AVSourceElement)
+    pipelines_config = bench.get_bench_pipelines_config(
+        pipelines_config={
+            "video": [{"source": {"uri": "test"}}, {"detect_motion": {}}],
+        },
+        media=_video_file,
+    )
+    report = bench.run_benchmark(
+        pipelines_config=pipelines_config, data_dir=tmp_path, timeout=60
+    )
+    video = report["pipelines"]["video"]
+    assert video["frames"] > 0
+    [motion] = video["elements"]
+    assert motion["class"] == "MotionDetector"
+    assert motion["samples_in"] == video["frames"]
+    assert motion["latency_ms"]
@@ -0,0 +1,226 @@
+"""Test the notification dispatcher against a local HTTP endpoint."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from ambianic.notification import (
+    Notification,
+    NotificationDispatcher,
+    NotificationHandler,
+)
+
+
+class _TestEndpoint:
+    """Local stand-in for a JSON webhook that can be slow or fail."""
+
+    def __init__(self, failures=0, delay=0):
+        self.messages = []
+        self.times = []
+        self.failures = failures
+        self.delay = delay
+        self.received = threading.Condition()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("content-length"))
+                message = json.loads(self.rfile.read(length))
+                time.sleep(endpoint.delay)
+                with endpoint.received:
+                    endpoint.times.append(time.monotonic())
+                    failed = endpoint.failures > 0
+                    if failed:
+                        endpoint.failures -= 1
+                    else:
+                        endpoint.messages.append(message)
+                    endpoint.received.notify_all()
+                self.send_response(500 if failed else 200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("localhost", 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def wait_for(self, count=1, timeout=10):
+        with self.received:
+            return self.received.wait_for(
+                lambda: len(self.messages) >= count, timeout=timeout
+            )
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+@pytest.fixture
+def endpoint():
+    endpoint = _TestEndpoint()
+    yield endpoint
+    endpoint.stop()
+
+
+def _handler(endpoint, **settings):
+    config = {
+        "display_name": "Front Door",
+        "notifications": {
+            "test": {
+                "providers": [f"json://localhost:{endpoint.port}/webhook"],
+                "templates": {
+                    "title": "${event_labels} x${event_count}",
+                    "message": "${event_details_url}",
+                },
+                **settings,
+            }
+        },
+    }
+    return NotificationHandler(config=config)
+
+
+def _notification(label="person", event_id="1"):
+    return Notification(
+        envelope={
+            "args": {
+                "id": event_id,
+                "inference_meta": {"display": "Test Detection"},
+                "inference_result": [{"label": label, "confidence": 0.9}],
+            }
+        },
+        providers=["test"],
+    )
+
+
+def test_handler_templates(endpoint):
+    handler = _handler(endpoint)
+    title, message, attachments = handler.render(_notification(), "test")
+    assert title == "Front Door: person x1"
+    assert message.startswith("https://ui.ambianic.ai/event?")
+    assert attachments == []
+    notification = _notification()
+    notification.title = "custom ${event_type}"
+    title, _, _ = handler.render(notification, "test", event_count=3)
+    assert title == "custom Test Detection"
+
+
+def test_handler_disabled_provider(endpoint):
+    handler = _handler(endpoint, enabled=False)
+    notification = _notification()
+    notification.providers = ["test", "unknown"]
+    assert handler.enabled_providers(notification) == []
+
+
+def test_submit_does_not_block():
+    endpoint = _TestEndpoint(delay=1)
+    try:
+        dispatcher = NotificationDispatcher(handler=_handler(endpoint))
+        start = time.monotonic()
+        dispatcher.submit(_notification())
+        assert time.monotonic() - start < 0.5
+        assert endpoint.wait_for(1)
+        dispatcher.stop()
+    finally:
+        endpoint.stop()
+
+
+def test_retry_with_backoff():
+    endpoint = _TestEndpoint(failures=2)
+    try:
+        handler = _handler(endpoint, retries=3, retry_backoff=0.2)
+        dispatcher = NotificationDispatcher(handler=handler)
+        dispatcher.submit(_notification())
+        assert endpoint.wait_for(1)
+        assert len(endpoint.times) == 3
+        first_retry = endpoint.times[1] - endpoint.times[0]
+        second_retry = endpoint.times[2] - endpoint.times[1]
+        assert first_retry >= 0.2
+        assert second_retry >= 0.4
+        dispatcher.stop()
+    finally:
+        endpoint.stop()
+
+
+def test_give_up_after_retries():
+    endpoint = _TestEndpoint(failures=10)
+    try:
+        handler = _handler(endpoint, retries=1, retry_backoff=0.1)
+        dispatcher = NotificationDispatcher(handler=handler)
+        dispatcher.submit(_notification())
+        time.sleep(1)
+        assert len(endpoint.times) == 2
+        assert endpoint.messages == []
+        dispatcher.stop()
+    finally:
+        endpoint.stop()
+
+
+def test_coalesce_same_labels(endpoint):
+    handler = _handler(endpoint, coalesce_window=0.5)
+    dispatcher = NotificationDispatcher(handler=handler)
+    for i in range(5):
+        dispatcher.submit(_notification(event_id=str(i)))
+    dispatcher.submit(_notification(label="cat"))
+    assert endpoint.wait_for(2)
+    time.sleep(0.3)
+    dispatcher.stop()
+    titles = sorted(m["title"] for m in endpoint.messages)
+    assert titles == ["Front Door: cat x1", "Front Door: person x5"]
+    # the message links to the latest event
+    [person] = [m for m in endpoint.messages if "person" in m["title"]]
+    assert "%22id%22%3A+%224%22" in person["message"]
+
+
+def test_rate_limit(endpoint):
+    # one message per 0.5 seconds
+    handler = _handler(endpoint, rate_limit=120)
+    dispatcher = NotificationDispatcher(handler=handler)
+    dispatcher.submit(_notification(label="person"))
+    dispatcher.submit(_notification(label="cat"))
+    dispatcher.submit(_notification(label="dog"))
+    assert endpoint.wait_for(3)
+    dispatcher.stop()
+    assert endpoint.times[1] - endpoint.times[0] >= 0.45
+    assert endpoint.times[2] - endpoint.times[1] >= 0.45
+
+
+def test_queue_full(endpoint):
+    handler = _handler(endpoint, coalesce_window=10)
+    dispatcher = NotificationDispatcher(handler=handler, queue_size=2)
+    for label in ("person", "cat", "dog"):
+        dispatcher.submit(_notification(label=label))
+    assert dispatcher.dropped_count == 1
+    assert dispatcher.queue_depth == 2
+    # waiting messages are sent out right away on stop
+    dispatcher.stop()
+    assert len(endpoint.messages) == 2
+    assert dispatcher.queue_depth == 0
+
+
+def test_stop_timeout_waits_for_busy_workers():
+    endpoint = _TestEndpoint(delay=1)
+    try:
+        dispatcher = NotificationDispatcher(handler=_handler(endpoint), workers=1)
+        dispatcher.submit(_notification())
+        time.sleep(0.2)
+        # the worker is still sending
+        dispatcher.stop(timeout=0.1)
+        dispatcher.submit(_notification(label="cat"))
+        assert dispatcher.queue_depth == 0
+        assert len(dispatcher._threads) == 1
+        dispatcher.stop()
+        assert not dispatcher._threads
+        # restarts once all workers are done
+        dispatcher.submit(_notification(label="dog"))
+        assert endpoint.wait_for(2)
+        dispatcher.stop()
+        assert [m["title"] for m in endpoint.messages] == [
+            "Front Door: person x1",
+            "Front Door: dog x1",
+        ]
+    finally:
+        endpoint.stop()
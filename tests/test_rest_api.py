@@ -12,6 +12,7 @@ from ambianic.configuration import (
     reload_config,
 )
 from ambianic.notification import NotificationHandler
+from ambianic.pipeline import metrics
 from ambianic.webapp.fastapi_app import app, set_data_dir
 from fastapi import status
 from fastapi.testclient import TestClient
@@ -109,6 +110,24 @@ def test_get_timeline(client):
     assert rv.json()["status"] == "success"
 
 
+def test_get_metrics(client):
+    socket_path = Path(app.data_dir, metrics.METRICS_SOCKET_FILE_NAME)
+    server = metrics.MetricsServer(path=socket_path, collect=lambda: "test_metric 1\n")
+    server.start()
+    try:
+        rv = client.get("/api/metrics")
+    finally:
+        server.stop()
+    assert rv.status_code == status.HTTP_200_OK
+    assert rv.text == "test_metric 1\n"
+    assert rv.headers["content-type"] == metrics.PROMETHEUS_CONTENT_TYPE
+
+
+def test_get_metrics_no_pipeline_server(client):
+    rv = client.get("/api/metrics")
+    assert rv.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+
 def test_initialize_premium_notification(client):
     testId = "auth0|123456789abed"
     endpoint = "https://localhost:5050"
@@ -184,3 +184,64 @@ def test_config_change(my_dir):
         assert srv.config_changed
     finally:
         _stop_mock_server(server=srv, thread=t)
+
+
+def test_config_changes():
+    config = {
+        "logging": {"level": "INFO"},
+        "display_name": "Home",
+        "pipelines": {
+            "save": [{"source": {"uri": "test1"}}, {"save_detections": {}}],
+            "other": [{"source": {"uri": "test2"}}],
+        },
+    }
+    assert ambianic.server._config_changes(config, config) == (False, set())
+    new_config = {**config, "display_name": "Cabin"}
+    assert ambianic.server._config_changes(config, new_config) == (False, {"save"})
+    new_config = {**config, "pipelines": {**config["pipelines"], "other": []}}
+    assert ambianic.server._config_changes(config, new_config) == (False, {"other"})
+    new_config = {**config, "logging": {"level": "DEBUG"}}
+    assert ambianic.server._config_changes(config, new_config) == (True, set())
+
+
+class _TestPipelineServer:
+    def __init__(self):
+        self.restarted = []
+
+    def restart_pipelines(self, config=None, pipeline_names=None):
+        self.restarted.append(pipeline_names)
+
+
+class _TestFileEvent:
+    def __init__(self, event_type="modified"):
+        self.event_type = event_type
+
+
+def test_config_change_debounce(my_dir, monkeypatch):
+    monkeypatch.setattr(ambianic.server, "CONFIG_CHANGE_DEBOUNCE", 0.5)
+    srv = AmbianicServer(work_dir=my_dir)
+    srv._config_snapshot = ambianic.server._config_snapshot(get_root_config())
+    pipeline_server = _TestPipelineServer()
+    servers = {"pipelines": pipeline_server}
+    srv.dispatch(_TestFileEvent(event_type="opened"))
+    assert srv._config_changed_time is None
+    for _ in range(3):
+        srv.dispatch(_TestFileEvent())
+        srv._apply_config_change(servers)
+        assert srv._config_changed_time is not None
+    time.sleep(0.6)
+    srv._apply_config_change(servers)
+    assert srv._config_changed_time is None
+    # the config files did not change
+    assert pipeline_server.restarted == []
+    assert not srv._service_restart_requested
+    new_snapshot = dict(srv._config_snapshot)
+    new_snapshot["pipelines"] = {}
+    monkeypatch.setattr(
+        ambianic.server, "_config_snapshot", lambda config: new_snapshot
+    )
+    srv._config_snapshot = {**new_snapshot, "pipelines": {"one": []}}
+    srv.dispatch(_TestFileEvent())
+    time.sleep(0.6)
+    srv._apply_config_change(servers)
+    assert pipeline_server.restarted == [{"one"}]
@@ -2,7 +2,9 @@
 
 import logging
 import os
+import shutil
 
+import pytest
 from ambianic.webapp.server import timeline_dao
 
 log = logging.getLogger(__name__)
@@ -29,6 +31,16 @@ sample = {
 }
 
 
+@pytest.fixture(autouse=True)
+def _close_stores():
+    """Start each test like a fresh web app process."""
+    yield
+    with timeline_dao._stores_lock:
+        for store in timeline_dao._stores.values():
+            store.close()
+        timeline_dao._stores.clear()
+
+
 def test_get_timeline_overflow():
     data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "./timeline")
     res = timeline_dao.get_timeline(before_datetime=None, page=7, data_dir=data_dir)
@@ -157,3 +169,39 @@ def test_get_timelines():
         )
         assert len(res) > 0
         assert res[0]["id"] == "page%d" % page
+
+
+def test_get_timelines_label_filter():
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "./timeline")
+    res = timeline_dao.get_timeline(page=1, data_dir=data_dir, label="person")
+    assert len(res) == 5
+    assert res[0]["id"] == "page1"
+    res = timeline_dao.get_timeline(page=1, data_dir=data_dir, label="cat")
+    assert len(res) == 0
+
+
+def test_legacy_timeline_imported_once(tmp_path):
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "./timeline")
+    for name in os.listdir(src_dir):
+        if name.startswith("timeline-event-log.yaml"):
+            shutil.copy(os.path.join(src_dir, name), tmp_path)
+    res1 = timeline_dao.get_timeline(page=5, data_dir=str(tmp_path))
+    # files are not imported again on every request
+    shutil.copy(
+        os.path.join(tmp_path, "timeline-event-log.yaml.1"),
+        os.path.join(tmp_path, "timeline-event-log.yaml.9"),
+    )
+    res2 = timeline_dao.get_timeline(page=5, data_dir=str(tmp_path))
+    assert len(res1) == len(res2) == 4
+    assert os.path.exists(os.path.join(tmp_path, "timeline-event-log.db"))
+
+
+def test_max_events(tmp_path):
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "./timeline")
+    for name in os.listdir(src_dir):
+        if name.startswith("timeline-event-log.yaml"):
+            shutil.copy(os.path.join(src_dir, name), tmp_path)
+    res = timeline_dao.get_timeline(page=1, data_dir=str(tmp_path), max_events=3)
+    assert [e["id"] for e in res] == ["page1"] * 3
+    res = timeline_dao.get_timeline(page=2, data_dir=str(tmp_path), max_events=3)
+    assert res == []